@@ -1,14 +1,76 @@
+import time
+from datetime import datetime, timezone
+
 import requests as rqs
 import yaml
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.admin import helpers
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.http import JsonResponse
 from django.template.response import TemplateResponse
-from django.urls import path
+from django.urls import path, reverse
 
+from . import outbox, slow_queries
+from .checkout import release_stock
+from .events import publish_order_changes
+from .mail import enqueue_email
 from .models import (Shop, Category, ProductInfo, ProductParameter, User,
                      ConfirmEmailToken, Address, Order, OrderItem, Delivery,
-                     STATE_CHOICES)
-from .tasks import send_email_task, do_import_task
+                     OrderChange, ImportRun, STATE_CHOICES)
+from .pagination import EstimatedCountPaginator
+
+
+class AutocompleteFilter(admin.FieldListFilter):
+    """
+    Фильтр списка по внешнему ключу с выбором значения через автодополнение
+    (вместо списка всех связанных объектов). Администратор связанной
+    модели должен задавать search_fields.
+    """
+    template = 'admin/backend/autocomplete_filter.html'
+
+    def __init__(self, field, request, params, model, model_admin,
+                 field_path):
+        self.lookup_kwarg = f'{field_path}__{field.target_field.name}__exact'
+        super().__init__(field, request, params, model, model_admin,
+                         field_path)
+        self.lookup_val = self.used_parameters.get(self.lookup_kwarg)
+        # остальные параметры списка сохраняются при выборе значения
+        self.hidden_params = [(name, value)
+                              for name, value in request.GET.items()
+                              if name not in (self.lookup_kwarg, 'p')]
+        form_field = field.formfield(
+            widget=AutocompleteSelect(field, model_admin.admin_site,
+                                      attrs={'onchange':
+                                             'this.form.submit()'}),
+            required=False
+        )
+        self.widget = form_field.widget
+
+    def expected_parameters(self):
+        return [self.lookup_kwarg]
+
+    def rendered_widget(self):
+        return self.widget.render(self.lookup_kwarg, self.lookup_val)
+
+    def choices(self, changelist):
+        yield {
+            'selected': self.lookup_val is None,
+            'query_string': changelist.get_query_string(
+                remove=[self.lookup_kwarg]
+            ),
+            'display': 'Все',
+        }
+
+
+class EstimatedCountAdmin(admin.ModelAdmin):
+    """
+    Список объектов большой таблицы без точного подсчета строк
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 # Register your models here.
@@ -21,7 +83,7 @@ class ProductParameterInline(admin.TabularInline):
 
 
 @admin.register(ProductInfo)
-class ProductInfoAdmin(admin.ModelAdmin):
+class ProductInfoAdmin(EstimatedCountAdmin):
     model = ProductInfo
     # extra = 0
     fields = (('id', 'external_id'), 'model', 'product', 'shop', 'quantity',
@@ -29,6 +91,7 @@ class ProductInfoAdmin(admin.ModelAdmin):
     readonly_fields = ('id', 'model', 'external_id', 'product', 'shop',
                        'quantity', 'price', 'price_rrc')
     list_display = ('product', 'shop', 'quantity', 'price')
+    list_select_related = ('product', 'shop')
     list_filter = ('shop',)
     inlines = [ProductParameterInline, ]
 
@@ -41,27 +104,51 @@ class OrderItemInline(admin.StackedInline):
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
-    fields = ('id', 'state', ('user', 'address'))
-    readonly_fields = ('id', 'user', 'address')
+class OrderAdmin(EstimatedCountAdmin):
+    fields = ('id', 'state', ('user', 'address'), 'stock_reserved')
+    readonly_fields = ('id', 'user', 'address', 'stock_reserved')
     list_display = ('id', 'user', 'state', 'dt')
-    list_filter = ('user', 'state', 'dt')
+    list_select_related = ('user',)
+    list_filter = (('user', AutocompleteFilter), 'state')
+    date_hierarchy = 'dt'
     inlines = [OrderItemInline, ]
 
-    def save_model(self, request, obj, form, change):
-        super().save_model(request, obj, form, change)
-
-        # отправляем письмо пользователю при изменении статуса заказа
-        rus_state = ''
-        for state_tuple in STATE_CHOICES:
-            if state_tuple[0] == obj.state:
-                rus_state = state_tuple[1]
-                break
+    @property
+    def media(self):
+        # скрипты автодополнения для фильтра по пользователю
+        return super().media + AutocompleteSelect(
+            Order._meta.get_field('user'), self.admin_site
+        ).media
 
-        title = f"Обновление статуса заказа {obj.id}"
-        message = f'Заказ {obj.id} получил статус {rus_state}.'
-        addressee_list = [obj.user.email]
-        send_email_task.delay(title, message, addressee_list)
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            # возвращаем на склад товары отмененного заказа; отметка
+            # о резерве снимается одним UPDATE, чтобы при одновременной
+            # отмене товары вернулись на склад только один раз
+            if obj.state == 'canceled' and Order.objects.filter(
+                pk=obj.pk, stock_reserved=True
+            ).update(stock_reserved=False):
+                release_stock(obj.id)
+            if obj.state == 'canceled':
+                obj.stock_reserved = False
+            super().save_model(request, obj, form, change)
+            # изменение статуса попадает в ленту изменений поставщиков
+            # и в поток событий их магазинов
+            if 'state' in form.changed_data:
+                publish_order_changes(OrderChange.objects.record(obj),
+                                      'state_changed')
+
+            # отправляем письмо пользователю при изменении статуса заказа
+            rus_state = ''
+            for state_tuple in STATE_CHOICES:
+                if state_tuple[0] == obj.state:
+                    rus_state = state_tuple[1]
+                    break
+
+            title = f"Обновление статуса заказа {obj.id}"
+            message = f'Заказ {obj.id} получил статус {rus_state}.'
+            addressee_list = [obj.user.email]
+            enqueue_email(title, message, addressee_list)
 
 
 class AddressInline(admin.StackedInline):
@@ -80,6 +167,8 @@ class UserAdmin(admin.ModelAdmin):
               ('date_joined', 'last_login'), 'is_superuser')
     list_display = ('__str__', 'type', 'is_active')
     list_filter = ('type', 'company')
+    # автодополнение в фильтре заказов по пользователю
+    search_fields = ('email', 'company', 'last_name')
     inlines = [AddressInline, ]
 
 
@@ -151,6 +240,7 @@ class ShopAdmin(admin.ModelAdmin):
                 already_updated.append(shop.name)
                 continue
 
+            start = time.perf_counter()
             if shop.file:
                 stream = shop.file
             elif shop.url:
@@ -158,28 +248,133 @@ class ShopAdmin(admin.ModelAdmin):
                     result = rqs.get(shop.url)
                 except rqs.exceptions.ConnectionError:
                     not_updated[shop.name] = 'Нет соединения'
-                    continue
                 else:
                     if result.ok:
                         stream = result.content
                     else:
                         not_updated[shop.name] = 'Файл не найден'
-                        continue
+                if shop.name in not_updated:
+                    ImportRun.objects.create(
+                        shop=shop, state='failed',
+                        fetch_seconds=time.perf_counter() - start,
+                        error=not_updated[shop.name]
+                    )
+                    continue
             else:
                 not_updated[shop.name] = 'Нет файла для актуализации'
                 continue
+            fetch_seconds = time.perf_counter() - start
 
+            start = time.perf_counter()
             data = yaml.safe_load(stream)
-            do_import_task.delay(shop_id, data)
-            updating.append(data['shop'])
+            run = ImportRun.objects.create(
+                shop=shop, fetch_seconds=fetch_seconds,
+                parse_seconds=time.perf_counter() - start,
+                goods_total=len(data['goods'])
+            )
+            outbox.send_task('backend.tasks.do_import_task', shop_id, data,
+                             run_id=run.id)
+            updating.append(run)
 
         context.update(updating=updating,
                        not_updated=not_updated,
-                       already_updated=already_updated)
+                       already_updated=already_updated,
+                       progress_url=reverse('admin:backend_importrun_progress'))
         return TemplateResponse(request,
                                 "admin/backend/shop/update_result.html",
                                 context)
 
 
+@admin.register(ImportRun)
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'shop', 'state', 'created_at', 'fetch_seconds',
+                    'parse_seconds', 'write_seconds', 'progress',
+                    'rows_per_second', 'rows_delta')
+    list_select_related = ('shop',)
+    list_filter = ('state', 'shop')
+    date_hierarchy = 'created_at'
+    readonly_fields = ('shop', 'state', 'created_at', 'started_at',
+                       'finished_at', 'fetch_seconds', 'parse_seconds',
+                       'write_seconds', 'goods_total', 'goods_written',
+                       'rows_deleted', 'rows_per_second', 'rows_delta',
+                       'error')
+    fields = readonly_fields
+
+    @admin.display(description='Записано')
+    def progress(self, obj):
+        return f'{obj.goods_written} из {obj.goods_total}'
+
+    @admin.display(description='Товаров в секунду')
+    def rows_per_second(self, obj):
+        return obj.rows_per_second
+
+    @admin.display(description='Изменение количества позиций')
+    def rows_delta(self, obj):
+        return obj.rows_delta
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        urls = super().get_urls()
+        my_urls = [
+            path('progress/',
+                 self.admin_site.admin_view(self.progress_view),
+                 name='backend_importrun_progress'),
+        ]
+        return my_urls + urls
+
+    def progress_view(self, request):
+        """
+        Ход загрузок (ids - номера через запятую) для страницы
+        результата актуализации прайс-листов
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            ids = [int(run_id) for run_id
+                   in request.GET.get('ids', '').split(',') if run_id]
+        except ValueError:
+            return JsonResponse({'Status': False,
+                                 'Errors': 'Неверные номера загрузок'},
+                                status=400)
+        runs = ImportRun.objects.filter(id__in=ids).order_by('id')
+        return JsonResponse({'Status': True, 'runs': [{
+            'id': run.id,
+            'state': run.state,
+            'state_display': run.get_state_display(),
+            'goods_total': run.goods_total,
+            'goods_written': run.goods_written,
+            'fetch_seconds': run.fetch_seconds,
+            'parse_seconds': run.parse_seconds,
+            'write_seconds': run.write_seconds,
+            'rows_per_second': run.rows_per_second,
+            'rows_delta': run.rows_delta,
+            'error': run.error,
+        } for run in runs]})
+
+
 admin.site.register(Category)
 admin.site.register(ConfirmEmailToken)
+
+
+def slow_queries_view(request):
+    """
+    Последние медленные SQL-запросы с планами выполнения
+    (backend.slow_queries)
+    """
+    if not request.user.is_superuser:
+        raise PermissionDenied
+    context = dict(
+        admin.site.each_context(request),
+        title='Медленные запросы',
+        threshold=settings.SLOW_QUERY_THRESHOLD_MS,
+        queries=[{**query, 'time': datetime.fromtimestamp(
+            query['time'], timezone.utc
+        )} for query in slow_queries.recent()],
+    )
+    return TemplateResponse(request, 'admin/slow_queries.html', context)
+
@@ -0,0 +1,69 @@
+"""
+Асинхронная обработка запросов на чтение в ASGI-приложении (orders.asgi).
+
+В Django 3.2 нет асинхронного ORM, а синхронные представления под ASGI
+выполняются по очереди в одном потоке (sync_to_async с thread_sensitive).
+Представление, обернутое async_read_view, становится асинхронным:
+GET-запросы выполняются параллельно в отдельном пуле потоков
+(ASYNC_READ_THREADS), не блокируя цикл событий, а отдачу ответа медленным
+клиентам обслуживает ASGI-сервер. Остальные запросы выполняются так же,
+как синхронные представления под ASGI (sync_to_async).
+
+Обернутые представления подключаются только в URL-адресах ASGI-приложения
+(orders.asgi_urls); под WSGI (orders.urls) представления вызываются
+напрямую, без перехода в асинхронный режим и обратно.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+@functools.lru_cache(maxsize=None)
+def _executor():
+    return ThreadPoolExecutor(max_workers=settings.ASYNC_READ_THREADS,
+                              thread_name_prefix='async-read')
+
+
+def _run_read(view, request, *args, **kwargs):
+    """
+    Выполнить представление в потоке пула. Соединения с базой закрываются
+    так же, как в конце обычного запроса (по CONN_MAX_AGE).
+    """
+    close_old_connections()
+    try:
+        response = view(request, *args, **kwargs)
+        # ответ DRF формируется здесь же, а не в потоке Django
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        return response
+    finally:
+        close_old_connections()
+
+
+def async_read_view(view):
+    """
+    Асинхронная обертка представления (результата as_view())
+    """
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method in READ_METHODS:
+            loop = asyncio.get_event_loop()
+            # контекст запроса (замеры PerformanceMiddleware) передается
+            # в поток пула, как и в sync_to_async
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                _executor(),
+                functools.partial(context.run, _run_read, view, request,
+                                  *args, **kwargs)
+            )
+        return await sync_to_async(view)(request, *args, **kwargs)
+
+    return wrapper
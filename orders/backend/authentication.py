@@ -0,0 +1,133 @@
+"""
+Аутентификация по токену с кэшированием пользователя.
+
+Для токена в Redis (auth:token:<ключ>, TOKEN_CACHE_TTL секунд)
+и в локальном LRU-кэше процесса (TOKEN_LOCAL_CACHE_TTL секунд) хранятся
+в JSON только поля пользователя из CACHED_FIELDS (id, is_active, тип
+и адрес почты), поэтому запрос с закэшированным токеном не обращается
+к базе. Остальные поля пользователя загружаются из базы при первом
+обращении к ним. Если Redis недоступен, пользователь ищется в базе.
+При выходе, удалении или замене токена и при изменении пользователя
+(пароль, is_active и др.) записи удаляются из Redis и из локального кэша
+текущего процесса (см. signals.py); в других процессах локальная запись
+устаревает не позже чем через TOKEN_LOCAL_CACHE_TTL секунд.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from .models import User
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+TOKEN_KEY = 'auth:token:{key}'
+# поля, которые читаются при обработке большинства запросов
+CACHED_FIELDS = ('id', 'is_active', 'type', 'email')
+
+
+class LocalCache:
+    """
+    LRU-кэш с временем жизни записей (потокобезопасный)
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+local_cache = LocalCache(settings.TOKEN_LOCAL_CACHE_SIZE,
+                         settings.TOKEN_LOCAL_CACHE_TTL)
+
+
+def invalidate_tokens(*keys):
+    """
+    Удалить пользователей токенов из кэша
+    """
+    if not keys:
+        return
+    local_cache.delete(*keys)
+    get_redis().delete(*[TOKEN_KEY.format(key=key) for key in keys])
+
+
+def cached_user(data):
+    """
+    Пользователь из записи кэша: загружены только CACHED_FIELDS,
+    остальные поля отложены (загружаются из базы при обращении)
+    """
+    fields = json.loads(data)
+    field_names = [field.attname for field in User._meta.concrete_fields
+                   if field.attname in fields]
+    return User.from_db(User.objects.db, field_names,
+                        [fields[name] for name in field_names])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication с кэшированием id пользователя в памяти процесса
+    и в Redis
+    """
+
+    def authenticate_credentials(self, key):
+        data = local_cache.get(key)
+        if data is None:
+            redis_key = TOKEN_KEY.format(key=key)
+            try:
+                data = get_redis().get(redis_key)
+            except redis.RedisError:
+                logger.warning('Redis недоступен, токен проверяется в базе')
+                data = None
+            if data is None:
+                user, token = super().authenticate_credentials(key)
+                data = json.dumps({name: getattr(user, name)
+                                   for name in CACHED_FIELDS})
+                try:
+                    get_redis().set(redis_key, data,
+                                    ex=settings.TOKEN_CACHE_TTL)
+                except redis.RedisError:
+                    logger.warning('Redis недоступен, токен не закэширован')
+                local_cache.set(key, data)
+                return user, token
+            local_cache.set(key, data)
+
+        # каждый запрос получает свой объект пользователя
+        user = cached_user(data)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.')
+            )
+        return user, self.get_model()(key=key, user=user)
@@ -0,0 +1,327 @@
+"""
+Хранение активных корзин в Redis (BASKET_STORAGE = 'redis').
+
+Корзина пользователя - хэш basket:<user_id>. Поле с id товара хранит строку
+"количество:цена:id магазина:сумма позиции", поле total - сумму корзины,
+поэтому для показа корзины не нужны агрегирующие запросы к базе.
+Измененные корзины попадают в множество basket:dirty и периодически
+переносятся в таблицы Order/OrderItem задачей flush_baskets_task.
+При оформлении заказа корзина переносится в базу сразу.
+Хэши и множество хранятся в Redis с AOF, поэтому перезапуск воркеров
+не теряет изменения: они будут перенесены при следующем запуске задачи.
+"""
+from django.conf import settings
+from django.db import transaction
+
+from .checkout import shop_delivery
+from .models import Order, OrderItem, ProductInfo, Shop
+from .redis_client import get_redis
+from .serializers import OrderProductInfoSerializer
+
+BASKET_KEY = 'basket:{user_id}'
+DIRTY_BASKETS_KEY = 'basket:dirty'
+TOTAL_FIELD = 'total'
+
+# KEYS[1] - корзина, KEYS[2] - множество измененных корзин
+# ARGV: id пользователя, '1' для замены количества, время жизни корзины,
+# далее пятерки: id товара, количество, цена, id магазина, остаток
+# (прибавленное количество не превышает остатка)
+ADD_SCRIPT = """
+local replace = ARGV[2] == '1'
+local result = {}
+for i = 4, #ARGV, 5 do
+    local quantity = tonumber(ARGV[i + 1])
+    local price = tonumber(ARGV[i + 2])
+    local old_sum, existed = 0, 0
+    local old = redis.call('HGET', KEYS[1], ARGV[i])
+    if old then
+        local old_quantity, old_line_sum = string.match(
+            old, '^(%d+):%d+:%d+:(%d+)$')
+        if not replace then
+            quantity = math.min(quantity + tonumber(old_quantity),
+                                tonumber(ARGV[i + 4]))
+        end
+        old_sum = tonumber(old_line_sum)
+        existed = 1
+    end
+    local line_sum = quantity * price
+    redis.call('HSET', KEYS[1], ARGV[i], quantity .. ':' .. price .. ':'
+               .. ARGV[i + 3] .. ':' .. line_sum)
+    redis.call('HINCRBY', KEYS[1], 'total', line_sum - old_sum)
+    table.insert(result, ARGV[i])
+    table.insert(result, quantity)
+    table.insert(result, existed)
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return result
+"""
+
+# KEYS[1] - корзина, KEYS[2] - множество измененных корзин
+# ARGV: id пользователя, время жизни корзины,
+# далее пары: id товара, новое количество (0 - удалить позицию)
+UPDATE_SCRIPT = """
+local result = {}
+for i = 3, #ARGV, 2 do
+    local status = 'not_found'
+    local old = redis.call('HGET', KEYS[1], ARGV[i])
+    if old then
+        local price, shop, old_sum = string.match(
+            old, '^%d+:(%d+):(%d+):(%d+)$')
+        local quantity = tonumber(ARGV[i + 1])
+        if quantity == 0 then
+            redis.call('HDEL', KEYS[1], ARGV[i])
+            redis.call('HINCRBY', KEYS[1], 'total', -tonumber(old_sum))
+            status = 'deleted'
+        else
+            local line_sum = quantity * tonumber(price)
+            redis.call('HSET', KEYS[1], ARGV[i], quantity .. ':' .. price
+                       .. ':' .. shop .. ':' .. line_sum)
+            redis.call('HINCRBY', KEYS[1], 'total',
+                       line_sum - tonumber(old_sum))
+            status = 'updated'
+        end
+    end
+    table.insert(result, ARGV[i])
+    table.insert(result, status)
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return result
+"""
+
+# KEYS[1] - корзина; ARGV: время жизни корзины, далее пары поле-значение.
+# Корзина загружается из базы, только если ее еще нет в Redis.
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def get_basket_store():
+    """
+    Хранилище корзин в Redis или None, если корзины хранятся в базе
+    """
+    if settings.BASKET_STORAGE == 'redis':
+        return RedisBasketStore()
+    return None
+
+
+def _line_value(quantity, price, shop_id):
+    return f'{quantity}:{price}:{shop_id}:{quantity * price}'
+
+
+class RedisBasketStore:
+    """
+    Корзины пользователей в хэшах Redis
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+        self.ttl = settings.BASKET_REDIS_TTL
+        self._add = self.client.register_script(ADD_SCRIPT)
+        self._update = self.client.register_script(UPDATE_SCRIPT)
+        self._load_script = self.client.register_script(LOAD_SCRIPT)
+
+    @staticmethod
+    def key(user_id):
+        return BASKET_KEY.format(user_id=user_id)
+
+    def _load(self, user_id):
+        """
+        Загрузить корзину из базы, если ее нет в Redis
+        """
+        key = self.key(user_id)
+        if self.client.exists(key):
+            return
+
+        mapping = {TOTAL_FIELD: 0}
+        basket_items = OrderItem.objects.filter(
+            order__user_id=user_id, order__state='basket'
+        ).values_list('product_info_id', 'quantity',
+                      'product_info__price', 'product_info__shop_id')
+        for product_info_id, quantity, price, shop_id in basket_items:
+            mapping[product_info_id] = _line_value(quantity, price, shop_id)
+            mapping[TOTAL_FIELD] += quantity * price
+
+        args = [self.ttl]
+        for field, value in mapping.items():
+            args.extend([field, value])
+        self._load_script(keys=[key], args=args)
+
+    def lines(self, user_id):
+        """
+        Позиции корзины: {id товара: (количество, цена, id магазина, сумма)}
+        """
+        self._load(user_id)
+        lines = {}
+        for field, value in self.client.hgetall(self.key(user_id)).items():
+            if field.decode() == TOTAL_FIELD:
+                continue
+            lines[int(field)] = tuple(int(part)
+                                      for part in value.decode().split(':'))
+        return lines
+
+    def add(self, user_id, quantities, product_infos, replace=False):
+        """
+        Добавить позиции в корзину.
+        :param quantities: словарь {id товара: количество}
+        :param product_infos: словарь {id товара: (цена, id магазина,
+        остаток)}
+        :return: словарь {id товара: итоговое количество}
+        и количество уже имевшихся в корзине позиций
+        """
+        self._load(user_id)
+        args = [user_id, '1' if replace else '0', self.ttl]
+        for product_info_id, quantity in quantities.items():
+            price, shop_id, stock = product_infos[product_info_id]
+            args.extend([product_info_id, quantity, price, shop_id, stock])
+        result = self._add(keys=[self.key(user_id), DIRTY_BASKETS_KEY],
+                           args=args)
+
+        saved, objects_updated = {}, 0
+        for i in range(0, len(result), 3):
+            saved[int(result[i])] = int(result[i + 1])
+            objects_updated += int(result[i + 2])
+        return saved, objects_updated
+
+    def update(self, user_id, quantities):
+        """
+        Изменить количество у позиций корзины (0 - удалить позицию).
+        :param quantities: словарь {id товара: количество}
+        :return: списки id обновленных, удаленных и ненайденных позиций
+        """
+        self._load(user_id)
+        args = [user_id, self.ttl]
+        for product_info_id, quantity in quantities.items():
+            args.extend([product_info_id, quantity])
+        result = self._update(keys=[self.key(user_id), DIRTY_BASKETS_KEY],
+                              args=args)
+
+        statuses = {'updated': [], 'deleted': [], 'not_found': []}
+        for i in range(0, len(result), 2):
+            statuses[result[i + 1].decode()].append(int(result[i]))
+        return statuses['updated'], statuses['deleted'], statuses['not_found']
+
+    def representation(self, user_id):
+        """
+        Корзина в том же формате, что и BasketSerializer для корзины в базе.
+        Идентификатор позиции совпадает с id товара.
+        """
+        lines = self.lines(user_id)
+        if not lines:
+            return []
+
+        product_infos = ProductInfo.objects.filter(
+            id__in=lines
+        ).select_related(
+            'product__category'
+        ).prefetch_related(
+            'product_parameters__parameter'
+        ).in_bulk()
+        shops = Shop.objects.filter(
+            id__in={line[2] for line in lines.values()}
+        ).prefetch_related('delivery')
+
+        shops_data, delivery_costs, invalid_deliveries = [], [], []
+        for shop in shops:
+            shop_lines = {product_info_id: line
+                          for product_info_id, line in lines.items()
+                          if line[2] == shop.id
+                          and product_info_id in product_infos}
+            shop_sum = sum(line[3] for line in shop_lines.values())
+            delivery = shop_delivery(shop, shop_sum)
+            if isinstance(delivery, str):
+                invalid_deliveries.append(delivery)
+            else:
+                delivery_costs.append(delivery)
+            shops_data.append({
+                'id': shop.id, 'name': shop.name, 'shop_sum': shop_sum,
+                'ordered_items': [
+                    {'id': product_info_id, 'quantity': line[0],
+                     'product_info': OrderProductInfoSerializer(
+                         product_infos[product_info_id]
+                     ).data}
+                    for product_info_id, line in shop_lines.items()
+                ],
+                'delivery': delivery,
+            })
+
+        return [{
+            'id': None, 'state': 'basket', 'dt': None,
+            'total_sum': int(self.client.hget(self.key(user_id),
+                                              TOTAL_FIELD) or 0),
+            'address': None,
+            'shops': shops_data,
+            'total_delivery': invalid_deliveries or sum(delivery_costs),
+        }]
+
+    def _write(self, user_id):
+        """
+        Перенести корзину из Redis в таблицы Order/OrderItem
+        """
+        if not self.client.exists(self.key(user_id)):
+            return
+        lines = self.lines(user_id)
+
+        # товары могли быть удалены при обновлении прайс-листа
+        existing = set(ProductInfo.objects.filter(
+            id__in=lines
+        ).values_list('id', flat=True))
+        stale = set(lines) - existing
+        if stale:
+            self.update(user_id, {product_info_id: 0
+                                  for product_info_id in stale})
+
+        with transaction.atomic():
+            basket, _ = Order.objects.get_or_create(user_id=user_id,
+                                                    state='basket')
+            OrderItem.objects.filter(
+                order_id=basket.id
+            ).exclude(
+                product_info_id__in=existing
+            ).delete()
+            OrderItem.objects.bulk_upsert(
+                basket.id,
+                {product_info_id: lines[product_info_id][0]
+                 for product_info_id in existing},
+                replace=True
+            )
+
+    def flush(self, user_id):
+        """
+        Перенести корзину пользователя в базу
+        """
+        self.client.srem(DIRTY_BASKETS_KEY, user_id)
+        try:
+            self._write(user_id)
+        except Exception:
+            self.client.sadd(DIRTY_BASKETS_KEY, user_id)
+            raise
+
+    def flush_dirty(self, limit=1000):
+        """
+        Перенести в базу измененные корзины (не более limit за раз)
+        """
+        user_ids = self.client.spop(DIRTY_BASKETS_KEY, limit) or []
+        for i, user_id in enumerate(user_ids):
+            try:
+                self._write(int(user_id))
+            except Exception:
+                # возвращаем необработанные корзины в очередь на перенос
+                self.client.sadd(DIRTY_BASKETS_KEY, *user_ids[i:])
+                raise
+        return len(user_ids)
+
+    def clear(self, user_id):
+        """
+        Удалить корзину из Redis после оформления заказа
+        """
+        self.client.srem(DIRTY_BASKETS_KEY, user_id)
+        self.client.delete(self.key(user_id))
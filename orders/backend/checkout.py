@@ -0,0 +1,201 @@
+"""
+Оформление заказа: фиксация цен и сумм, резервирование товаров.
+
+Остатки уменьшаются условными запросами
+UPDATE ... SET quantity = quantity - n WHERE quantity >= n,
+по одному запросу на магазин. UPDATE блокирует строки в порядке плана
+запроса, поэтому перед ним строки магазина блокируются в порядке id
+(SELECT ... FOR UPDATE): заказы с общими товарами ждут друг друга,
+а не блокируют взаимно. Блокировки держатся до конца короткой транзакции
+оформления заказа.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import (Case, Count, F, OuterRef,
+                              PositiveIntegerField, Subquery, Sum, Value,
+                              When)
+
+from .events import publish_order_changes
+from .models import OrderChange, OrderItem, OrderShop, ProductInfo, Shop
+
+
+class InsufficientStock(Exception):
+    """
+    Товаров на складе недостаточно для заказа
+    """
+
+    def __init__(self, lines=()):
+        # позиции: id товара, заказанное и доступное количество
+        self.lines = list(lines)
+        super().__init__(self.lines)
+
+
+class InvalidDelivery(Exception):
+    """
+    Для заказа в магазине недоступна доставка
+    """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__(self.errors)
+
+
+def shop_delivery(shop, shop_sum):
+    """
+    Стоимость доставки для суммы заказа в магазине или текст ошибки.
+    Стоимости доставки магазина (shop.delivery) лучше загрузить заранее
+    через prefetch_related.
+    """
+    deliveries = shop.delivery.all()
+    if not deliveries:
+        return f"{shop.name}: стоимость доставки недоступна."
+    available = [delivery for delivery in deliveries
+                 if delivery.min_sum <= shop_sum]
+    if not available:
+        return f"{shop.name}: сумма заказа меньше минимальной."
+    return max(available, key=lambda delivery: delivery.min_sum).cost
+
+
+def snapshot_order(order):
+    """
+    Зафиксировать цены позиций, суммы и стоимость доставки по магазинам
+    и итоговые суммы заказа (сам заказ не сохраняется).
+    :return: список ошибок доставки (доставка таких магазинов не заполняется)
+    """
+    OrderItem.objects.filter(order_id=order.id).update(
+        price=Subquery(ProductInfo.objects.filter(
+            id=OuterRef('product_info_id')
+        ).values('price')[:1])
+    )
+    shop_totals = {
+        shop_id: (shop_sum, items_count)
+        for shop_id, shop_sum, items_count in OrderItem.objects.filter(
+            order_id=order.id
+        ).values(
+            'product_info__shop_id'
+        ).annotate(
+            shop_sum=Sum(F('quantity') * F('price')),
+            items_count=Count('id')
+        ).values_list('product_info__shop_id', 'shop_sum', 'items_count')
+    }
+
+    order_shops, invalid_deliveries = [], []
+    for shop in Shop.objects.filter(
+        id__in=shop_totals
+    ).prefetch_related('delivery'):
+        shop_sum, items_count = shop_totals[shop.id]
+        delivery = shop_delivery(shop, shop_sum)
+        if isinstance(delivery, str):
+            invalid_deliveries.append(delivery)
+            delivery = None
+        order_shops.append(OrderShop(order_id=order.id, shop_id=shop.id,
+                                     dt=order.dt, shop_sum=shop_sum,
+                                     items_count=items_count,
+                                     delivery=delivery))
+    OrderShop.objects.filter(order_id=order.id).delete()
+    OrderShop.objects.bulk_create(order_shops)
+
+    order.total_sum = sum(order_shop.shop_sum for order_shop in order_shops)
+    order.total_delivery = sum(order_shop.delivery or 0
+                               for order_shop in order_shops)
+    return invalid_deliveries
+
+
+def place_order(order, address_id):
+    """
+    Оформить заказ из корзины: зафиксировать суммы, зарезервировать товары
+    и перевести заказ в статус "Новый" одной транзакцией.
+    Вызывает InvalidDelivery или InsufficientStock, если заказ
+    оформить нельзя, и IntegrityError, если адрес не найден.
+    """
+    with transaction.atomic():
+        invalid_deliveries = snapshot_order(order)
+        if invalid_deliveries:
+            raise InvalidDelivery(invalid_deliveries)
+        reserve_stock(order.id)
+        order.address_id = address_id
+        order.state = 'new'
+        order.stock_reserved = True
+        order.save()
+        publish_order_changes(OrderChange.objects.record(order), 'new_order')
+
+
+def _order_lines_by_shop(order_id):
+    """
+    Позиции заказа по магазинам: {id магазина: {id товара: количество}}
+    """
+    lines = defaultdict(dict)
+    for product_info_id, quantity, shop_id in OrderItem.objects.filter(
+        order_id=order_id
+    ).values_list('product_info_id', 'quantity', 'product_info__shop_id'):
+        lines[shop_id][product_info_id] = quantity
+    # одинаковый порядок магазинов снижает риск взаимных блокировок
+    return [lines[shop_id] for shop_id in sorted(lines)]
+
+
+def _quantity_case(quantities):
+    return Case(
+        *[When(id=product_info_id, then=Value(quantity))
+          for product_info_id, quantity in quantities.items()],
+        output_field=PositiveIntegerField()
+    )
+
+
+def _lock_stock(quantities):
+    """
+    Заблокировать строки остатков в порядке id
+    """
+    list(ProductInfo.objects.select_for_update().filter(
+        id__in=quantities
+    ).order_by('id').values_list('id', flat=True))
+
+
+def reserve_stock(order_id):
+    """
+    Зарезервировать товары заказа: все позиции или ни одной.
+    При нехватке товаров вызывает InsufficientStock со списком
+    недостающих позиций.
+    """
+    lines_by_shop = _order_lines_by_shop(order_id)
+    try:
+        with transaction.atomic():
+            for quantities in lines_by_shop:
+                _lock_stock(quantities)
+                needed = _quantity_case(quantities)
+                reserved = ProductInfo.objects.filter(
+                    id__in=quantities, quantity__gte=needed
+                ).update(quantity=F('quantity') - needed)
+                if reserved != len(quantities):
+                    raise InsufficientStock
+    except InsufficientStock:
+        pass
+    else:
+        return
+
+    # резервирование откатано, определяем недостающие позиции
+    ordered = {product_info_id: quantity
+               for quantities in lines_by_shop
+               for product_info_id, quantity in quantities.items()}
+    available = ProductInfo.objects.filter(
+        id__in=ordered
+    ).values_list('id', 'quantity').order_by('id')
+    raise InsufficientStock(
+        {'product_info': product_info_id,
+         'quantity': ordered[product_info_id],
+         'available': quantity}
+        for product_info_id, quantity in available
+        if quantity < ordered[product_info_id]
+    )
+
+
+def release_stock(order_id):
+    """
+    Вернуть на склад товары отмененного заказа
+    """
+    with transaction.atomic():
+        for quantities in _order_lines_by_shop(order_id):
+            _lock_stock(quantities)
+            ProductInfo.objects.filter(
+                id__in=quantities
+            ).update(quantity=F('quantity') + _quantity_case(quantities))
@@ -0,0 +1,65 @@
+"""
+Удаление устаревших данных.
+
+Токены подтверждения почты удаляются только при подтверждении,
+а токены сброса пароля - при сбросе, поэтому токены брошенных
+регистраций и запросов сброса удаляются периодической задачей
+purge_expired_tokens_task. Удаление идет пакетами по TOKEN_PURGE_BATCH_SIZE
+строк, каждый пакет в отдельной короткой транзакции.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django_rest_passwordreset.models import (
+    ResetPasswordToken, get_password_reset_token_expiry_time
+)
+
+from .metrics import increment
+from .models import ConfirmEmailToken
+
+logger = logging.getLogger(__name__)
+
+
+def purge_expired(model, expiry_time, batch_size=None):
+    """
+    Удалить записи модели, созданные раньше expiry_time (по полю
+    created_at). Возвращает количество удаленных записей.
+    """
+    batch_size = batch_size or settings.TOKEN_PURGE_BATCH_SIZE
+    expired = model.objects.filter(created_at__lt=expiry_time)
+    total = 0
+    while True:
+        ids = list(expired.order_by('created_at')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted, _ = model.objects.filter(pk__in=ids).delete()
+        total += deleted
+        if len(ids) < batch_size:
+            break
+    if total:
+        increment('tokens_purged', total, model=model._meta.model_name)
+        logger.info('Удалено устаревших записей %s: %s',
+                    model._meta.model_name, total)
+    return total
+
+
+def purge_expired_tokens(batch_size=None):
+    """
+    Удалить устаревшие токены подтверждения почты и сброса пароля
+    """
+    now = timezone.now()
+    return {
+        'confirm_email': purge_expired(
+            ConfirmEmailToken,
+            now - timedelta(hours=settings.CONFIRM_EMAIL_TOKEN_EXPIRY_TIME),
+            batch_size
+        ),
+        'reset_password': purge_expired(
+            ResetPasswordToken,
+            now - timedelta(hours=get_password_reset_token_expiry_time()),
+            batch_size
+        ),
+    }
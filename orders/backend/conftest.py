@@ -0,0 +1,19 @@
+import pytest
+
+from .redis_client import get_redis
+
+
+@pytest.fixture(autouse=True)
+def clear_throttles():
+    # счетчики лимитов запросов хранятся в Redis между запусками тестов
+    client = get_redis()
+    for key in client.scan_iter('throttle:*'):
+        client.delete(key)
+
+
+@pytest.fixture(autouse=True)
+def clear_outbox_claims():
+    # id сообщений outbox повторяются в новой тестовой базе
+    client = get_redis()
+    for key in client.scan_iter('outbox:*'):
+        client.delete(key)
@@ -0,0 +1,204 @@
+"""
+Уведомления поставщиков о новых заказах и изменении статуса заказов.
+
+События публикуются в Redis (канал orders:shop:<id магазина>) после
+фиксации транзакции, изменившей заказ. Поток событий отдается
+поставщику по Server-Sent Events отдельным ASGI-приложением
+(см. orders/asgi.py): соединения ждут событий в цикле событий asyncio
+и не занимают WSGI-воркеры. Каждый процесс держит одну подписку
+на каналы всех магазинов и раздает события своим соединениям.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from redis import asyncio as aioredis
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'orders:shop:{shop_id}'
+CHANNEL_PATTERN = 'orders:shop:*'
+EVENTS_PATH = '/api/v1/partner/orders/events/'
+# событий в очереди соединения; при переполнении события отбрасываются,
+# пропущенное клиент получает из ленты изменений partner/orders/changes/
+QUEUE_SIZE = 100
+
+
+def publish_order_changes(changes, event):
+    """
+    Опубликовать изменения заказа (записи OrderChange) после фиксации
+    текущей транзакции.
+    :param event: new_order или state_changed
+    """
+    messages = [
+        (CHANNEL.format(shop_id=change.shop_id),
+         json.dumps({'event': event, 'order': change.order_id,
+                     'state': change.state}))
+        for change in changes
+    ]
+
+    def publish():
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for channel, message in messages:
+                pipe.publish(channel, message)
+            pipe.execute()
+        except Exception:
+            # уведомление не обязательно: изменение есть в ленте изменений
+            logger.exception('Не удалось опубликовать изменение заказа')
+
+    transaction.on_commit(publish)
+
+
+class OrderEventHub:
+    """
+    Подписка процесса на события всех магазинов и раздача событий
+    очередям открытых соединений
+    """
+
+    def __init__(self):
+        self.queues = defaultdict(set)
+        self.subscribed = False
+        self._reader = None
+
+    def subscribe(self, shop_id):
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.queues[shop_id].add(queue)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.ensure_future(self._read())
+        return queue
+
+    def unsubscribe(self, shop_id, queue):
+        self.queues[shop_id].discard(queue)
+        if not self.queues[shop_id]:
+            del self.queues[shop_id]
+
+    def dispatch(self, channel, data):
+        shop_id = int(channel.rsplit(':', 1)[1])
+        for queue in self.queues.get(shop_id, ()):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                logger.warning('Очередь событий магазина %s переполнена',
+                               shop_id)
+
+    async def _read(self):
+        while True:
+            client = aioredis.Redis.from_url(settings.REDIS_URL)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(CHANNEL_PATTERN)
+                self.subscribed = True
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.dispatch(message['channel'].decode(),
+                                      message['data'].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Подписка на события заказов прервана')
+                await asyncio.sleep(1)
+            finally:
+                self.subscribed = False
+                await pubsub.close()
+                await client.close()
+
+
+hub = OrderEventHub()
+
+
+@sync_to_async
+def _get_shop_id(key):
+    from rest_framework.authtoken.models import Token
+
+    # приложение работает вне обработчика запросов Django, поэтому
+    # устаревшие и разорванные соединения закрываются здесь
+    # (как по сигналам request_started и request_finished)
+    close_old_connections()
+    try:
+        return Token.objects.filter(
+            key=key, user__is_active=True, user__type='shop'
+        ).values_list('user__shop__id', flat=True).first()
+    finally:
+        close_old_connections()
+
+
+def _token(scope):
+    """
+    Токен из заголовка Authorization (Token <key>) или параметра token:
+    EventSource в браузере не передает заголовки
+    """
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            keyword, _, key = value.decode().partition(' ')
+            if keyword == 'Token':
+                return key.strip()
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('token', [None])[0]
+
+
+async def _json_response(send, status, data):
+    body = json.dumps(data, ensure_ascii=False).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def order_events_app(scope, receive, send):
+    """
+    ASGI-приложение потока событий заказов магазина поставщика
+    (text/event-stream)
+    """
+    if scope['method'] != 'GET':
+        await _json_response(send, 405, {'Status': False,
+                                         'Errors': 'Метод не поддерживается'})
+        return
+
+    key = _token(scope)
+    shop_id = await _get_shop_id(key) if key else None
+    if shop_id is None:
+        await _json_response(send, 403, {'Status': False,
+                                         'Errors': 'Только для магазинов'})
+        return
+
+    queue = hub.subscribe(shop_id)
+    disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': b': connected\n\n',
+                    'more_body': True})
+        while True:
+            event = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {event, disconnect}, return_when=asyncio.FIRST_COMPLETED,
+                timeout=settings.ORDER_EVENTS_KEEPALIVE
+            )
+            if disconnect in done:
+                event.cancel()
+                break
+            if event in done:
+                body = f'data: {event.result()}\n\n'.encode()
+            else:
+                # комментарий не дает прокси закрыть неактивное соединение
+                event.cancel()
+                body = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body,
+                        'more_body': True})
+    finally:
+        disconnect.cancel()
+        hub.unsubscribe(shop_id, queue)
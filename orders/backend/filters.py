@@ -0,0 +1,50 @@
+import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import STATE_CHOICES
+
+ORDER_STATES = {state for state, _ in STATE_CHOICES if state != 'basket'}
+
+
+def _parse_dt(value, end_of_day=False):
+    """
+    Дата или дата и время в формате ISO 8601.
+    Для даты без времени берется начало (или конец) дня.
+    """
+    try:
+        dt = parse_datetime(value)
+        if dt is None:
+            date = parse_date(value)
+            if date is None:
+                return None
+            time = datetime.time.max if end_of_day else datetime.time.min
+            dt = datetime.datetime.combine(date, time)
+    except ValueError:
+        return None
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+def filter_orders(queryset, query_params, state_lookup='state'):
+    """
+    Отфильтровать заказы по параметрам state, dt_from и dt_to.
+    При неправильно указанных параметрах вызывает ValueError.
+    """
+    state = query_params.get('state')
+    if state:
+        if state not in ORDER_STATES:
+            raise ValueError(f'Неизвестный статус заказа: {state}')
+        queryset = queryset.filter(**{state_lookup: state})
+
+    for param, lookup in (('dt_from', 'dt__gte'), ('dt_to', 'dt__lte')):
+        value = query_params.get(param)
+        if value:
+            dt = _parse_dt(value, end_of_day=param == 'dt_to')
+            if dt is None:
+                raise ValueError(f'Неправильно указана дата: {param}')
+            queryset = queryset.filter(**{lookup: dt})
+
+    return queryset
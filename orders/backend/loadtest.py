@@ -0,0 +1,100 @@
+"""
+Сбор и вывод результатов нагрузочных тестов
+(команды load_test и replay_traffic)
+"""
+import statistics
+import threading
+from collections import defaultdict
+
+
+def percentiles(latencies):
+    """
+    p50, p95 и p99 времени ответа (None, если замеров меньше двух)
+    """
+    if len(latencies) < 2:
+        return None
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {'p50': quantiles[49], 'p95': quantiles[94], 'p99': quantiles[98]}
+
+
+class Stats:
+    """
+    Время ответа и ошибки по эндпоинтам (потокобезопасно)
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.throttled = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, status_code):
+        with self._lock:
+            if status_code == 429:
+                self.throttled[name] += 1
+            elif status_code is None or status_code >= 400:
+                self.errors[name] += 1
+            else:
+                self.latencies[name].append(seconds)
+
+    def rows(self, elapsed):
+        names = sorted(set(self.latencies) | set(self.errors)
+                       | set(self.throttled))
+        for name in names:
+            latencies = sorted(self.latencies[name])
+            total = (len(latencies) + self.errors[name]
+                     + self.throttled[name])
+            row = {'name': name, 'requests': total,
+                   'rps': total / elapsed,
+                   'errors': self.errors[name] / total * 100,
+                   'throttled': self.throttled[name]}
+            if len(latencies) > 1:
+                row.update(percentiles(latencies), max=latencies[-1])
+            yield row
+
+
+def write_report(stdout, stats, elapsed):
+    """
+    Таблица запросов в секунду, доли ошибок и времени ответа по эндпоинтам
+    """
+    stdout.write(f'Время теста: {elapsed:.1f} с')
+    stdout.write(f'{"Эндпоинт":<28}{"запросов":>9}{"в сек":>8}'
+                 f'{"ошибок,%":>9}{"429":>6}'
+                 f'{"p50,мс":>8}{"p95,мс":>8}{"p99,мс":>8}{"max,мс":>8}')
+    total = errors = 0
+    for row in stats.rows(elapsed):
+        total += row['requests']
+        errors += row['requests'] * row['errors'] / 100
+        latencies = ''.join(
+            f'{row[name] * 1000:>8.0f}' if name in row else f'{"-":>8}'
+            for name in ('p50', 'p95', 'p99', 'max')
+        )
+        stdout.write(f'{row["name"]:<28}{row["requests"]:>9}'
+                     f'{row["rps"]:>8.1f}{row["errors"]:>9.1f}'
+                     f'{row["throttled"]:>6}{latencies}')
+    if total:
+        stdout.write(f'Всего: {total} запросов, '
+                     f'{total / elapsed:.1f} в секунду, '
+                     f'ошибок {errors / total * 100:.1f}%')
+
+
+def write_comparison(stdout, baseline, latencies):
+    """
+    Сравнение времени ответа по эндпоинтам с предыдущим запуском:
+    baseline и latencies - словари {эндпоинт: [время ответа, с]}
+    """
+    stdout.write(f'{"Эндпоинт":<28}{"p50 было":>10}{"стало":>8}'
+                 f'{"p95 было":>10}{"стало":>8}{"p95, %":>8}')
+    for name in sorted(set(baseline) | set(latencies)):
+        before = percentiles(baseline.get(name, []))
+        after = percentiles(latencies.get(name, []))
+        values = ''
+        for quantile in ('p50', 'p95'):
+            values += ''.join(
+                f'{result[quantile] * 1000:>{width}.0f}' if result
+                else f'{"-":>{width}}'
+                for result, width in ((before, 10), (after, 8))
+            )
+        change = (f'{(after["p95"] / before["p95"] - 1) * 100:>+8.0f}'
+                  if before and after and before['p95'] else f'{"-":>8}')
+        stdout.write(f'{name:<28}{values}{change}')
@@ -0,0 +1,261 @@
+"""
+Очередь писем с пакетной отправкой.
+
+Письма записываются в таблицу исходящих сообщений (backend.outbox)
+и после фиксации транзакции переносятся в список Redis mail:queue. Задача
+send_queued_emails_task забирает их пакетами (MAIL_BATCH_SIZE) и отправляет
+через одно соединение с почтовым сервером. Запуск задачи планируется
+при постановке письма в очередь, не чаще одного запуска одновременно
+(ключ mail:drain), и периодически через celery beat на случай сбоя.
+Письмо, которое не удалось отправить, возвращается в очередь,
+пока не исчерпано MAIL_MAX_ATTEMPTS попыток. Письмо, повторно
+опубликованное из outbox, не отправляется (outbox.claim).
+
+Письма не удаляются из Redis до отправки: задача переносит их (LMOVE)
+в свой список mail:queue:processing:<id> и удаляет каждое письмо после
+отправки. Время последней отправки задачи хранится в mail:queue:processing;
+письма задачи, не отправлявшей писем дольше MAIL_PROCESSING_TIMEOUT
+(например, остановленной по тайм-ауту), возвращаются в очередь
+при следующем запуске отправки.
+
+Уведомления администратора, кроме срочных (ADMIN_URGENT_NOTIFICATIONS),
+накапливаются в списке mail:admin_digest и отправляются одним письмом
+раз в ADMIN_DIGEST_INTERVAL секунд задачей send_admin_digest_task.
+"""
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+from . import outbox
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = 'mail:queue'
+DRAIN_KEY = 'mail:drain'
+# время, после которого запуск отправки можно запланировать повторно,
+# если задача отправки завершилась аварийно
+DRAIN_TIMEOUT = 60 * 5
+
+
+def _payload(title, message, addressee_list, sender=None):
+    return {'title': title, 'message': message, 'to': list(addressee_list),
+            'from': sender or settings.EMAIL_HOST_USER, 'attempts': 0}
+
+
+def enqueue_email(title, message, addressee_list, sender=None):
+    """
+    Поставить письмо в очередь на отправку после фиксации
+    текущей транзакции (через backend.outbox)
+    """
+    outbox.add('email', _payload(title, message, addressee_list, sender))
+
+
+def push_emails(payloads):
+    """
+    Добавить письма в очередь отправки
+    """
+    get_redis().rpush(QUEUE_KEY, *[json.dumps(payload)
+                                   for payload in payloads])
+    schedule_drain()
+
+
+def schedule_drain(countdown=None):
+    """
+    Запланировать отправку очереди, если она еще не запланирована
+    """
+    from .tasks import send_queued_emails_task
+
+    if get_redis().set(DRAIN_KEY, 1, nx=True, ex=DRAIN_TIMEOUT):
+        send_queued_emails_task.apply_async(countdown=countdown)
+
+
+def _email(data):
+    return EmailMultiAlternatives(data['title'], data['message'],
+                                  data['from'], data['to'])
+
+
+def _processing_key(queue_key):
+    return f'{queue_key}:processing'
+
+
+def requeue_stale(queue_key=QUEUE_KEY):
+    """
+    Вернуть в очередь письма задач отправки, завершенных аварийно
+    (письмо могло быть отправлено до остановки задачи и будет отправлено
+    повторно).
+    :return: количество возвращенных писем
+    """
+    client = get_redis()
+    processing_key = _processing_key(queue_key)
+    requeued = 0
+    deadline = time.time() - settings.MAIL_PROCESSING_TIMEOUT
+    for key in client.zrangebyscore(processing_key, '-inf', deadline):
+        while True:
+            raw = client.lmove(key, queue_key, 'LEFT', 'RIGHT')
+            if raw is None:
+                break
+            outbox.release(json.loads(raw))
+            requeued += 1
+        client.zrem(processing_key, key)
+    if requeued:
+        logger.warning('Возвращено в очередь писем: %s', requeued)
+    return requeued
+
+
+def send_queued(batch_size=None, queue_key=QUEUE_KEY):
+    """
+    Отправить письма из очереди пакетами через одно соединение.
+    :param queue_key: ключ очереди в Redis; повторная отправка
+    планируется только для основной очереди QUEUE_KEY
+    :return: количество отправленных, неотправленных и возвращенных
+    в очередь писем и время отправки, с
+    """
+    client = get_redis()
+    main_queue = queue_key == QUEUE_KEY
+    batch_size = batch_size or settings.MAIL_BATCH_SIZE
+    processing_key = _processing_key(queue_key)
+    processing = f'{processing_key}:{uuid.uuid4().hex}'
+    sent, failed, retry, batch = 0, 0, [], []
+    start = time.perf_counter()
+    requeue_stale(queue_key)
+
+    connection = get_connection()
+    try:
+        connection.open()
+        while True:
+            client.zadd(processing_key, {processing: time.time()})
+            pipe = client.pipeline(transaction=False)
+            for _ in range(batch_size):
+                pipe.lmove(queue_key, processing, 'LEFT', 'RIGHT')
+            batch = [raw for raw in pipe.execute() if raw is not None]
+            if not batch:
+                break
+            while batch:
+                data = json.loads(batch[0])
+                if not outbox.claim(data):
+                    client.lrem(processing, 1, batch.pop(0))
+                    continue
+                try:
+                    # ошибка одного письма не мешает отправке остальных
+                    connection.send_messages([_email(data)])
+                except Exception:
+                    outbox.release(data)
+                    data['attempts'] += 1
+                    if data['attempts'] < settings.MAIL_MAX_ATTEMPTS:
+                        # исходное письмо остается в списке задачи
+                        # до возврата в очередь
+                        retry.append(json.dumps(data))
+                        batch.pop(0)
+                    else:
+                        failed += 1
+                        logger.exception('Письмо "%s" для %s не отправлено',
+                                         data['title'], data['to'])
+                        client.lrem(processing, 1, batch.pop(0))
+                    # соединение могло быть разорвано сервером
+                    connection.close()
+                    connection.open()
+                else:
+                    sent += 1
+                    pipe = client.pipeline(transaction=False)
+                    pipe.lrem(processing, 1, batch.pop(0))
+                    pipe.zadd(processing_key, {processing: time.time()})
+                    pipe.execute()
+    finally:
+        connection.close()
+        # неотправленные письма возвращаются в очередь
+        pipe = client.pipeline()
+        if batch or retry:
+            pipe.rpush(queue_key, *batch, *retry)
+        pipe.delete(processing)
+        pipe.zrem(processing_key, processing)
+        pipe.execute()
+        if main_queue:
+            client.delete(DRAIN_KEY)
+
+    elapsed = time.perf_counter() - start
+    if sent or failed:
+        logger.info('Отправлено писем: %s, не отправлено: %s, '
+                    'повторная отправка: %s, %.1f писем/с',
+                    sent, failed, len(retry), sent / elapsed)
+    if main_queue and retry:
+        schedule_drain(countdown=settings.MAIL_RETRY_DELAY)
+    elif main_queue and client.llen(QUEUE_KEY):
+        # письма, поставленные в очередь во время завершения отправки
+        schedule_drain()
+    return {'sent': sent, 'failed': failed, 'retry': len(retry),
+            'seconds': round(elapsed, 3)}
+
+
+# уведомления администратора; срочные отправляются сразу,
+# остальные собираются в периодическую сводку
+ADMIN_NOTIFICATIONS = {
+    'new_partner': 'Новые поставщики',
+    'price_list': 'Обновления прайс-листов',
+    'new_order': 'Новые заказы',
+}
+DIGEST_KEY = 'mail:admin_digest'
+# строк одного типа в сводке, остальные только подсчитываются
+DIGEST_LINES = 100
+
+
+def notify_admin(kind, title, message):
+    """
+    Уведомить администратора (письмо на ADMIN_EMAIL).
+    :param kind: тип уведомления из ADMIN_NOTIFICATIONS
+    """
+    if kind in settings.ADMIN_URGENT_NOTIFICATIONS:
+        enqueue_email(title, message, [settings.ADMIN_EMAIL])
+    else:
+        outbox.add('admin_digest', {'kind': kind, 'message': message})
+
+
+def push_digest(payloads):
+    """
+    Добавить уведомления в сводку
+    """
+    get_redis().rpush(DIGEST_KEY, *[json.dumps(payload)
+                                    for payload in payloads])
+
+
+def send_admin_digest():
+    """
+    Поставить в очередь сводку накопленных уведомлений администратора.
+    :return: количество уведомлений в сводке
+    """
+    pipe = get_redis().pipeline()
+    pipe.lrange(DIGEST_KEY, 0, -1)
+    pipe.delete(DIGEST_KEY)
+    notifications, _ = pipe.execute()
+    if not notifications:
+        return 0
+
+    messages = {kind: [] for kind in ADMIN_NOTIFICATIONS}
+    count = 0
+    for raw in notifications:
+        data = json.loads(raw)
+        if outbox.claim(data):
+            messages.setdefault(data['kind'], []).append(data['message'])
+            count += 1
+    if not count:
+        return 0
+
+    sections = []
+    for kind, kind_messages in messages.items():
+        if not kind_messages:
+            continue
+        lines = [f'{ADMIN_NOTIFICATIONS.get(kind, kind)}: '
+                 f'{len(kind_messages)}']
+        lines.extend(f'- {message}'
+                     for message in kind_messages[:DIGEST_LINES])
+        if len(kind_messages) > DIGEST_LINES:
+            lines.append(f'... и еще {len(kind_messages) - DIGEST_LINES}')
+        sections.append('\n'.join(lines))
+
+    push_emails([_payload(f'Сводка уведомлений: {count}',
+                          '\n\n'.join(sections), [settings.ADMIN_EMAIL])])
+    return count
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Subquery
+
+from backend.checkout import snapshot_order
+from backend.models import Order, OrderChange, OrderItem, OrderShop
+
+
+class Command(BaseCommand):
+    help = ('Зафиксировать цены, суммы и стоимость доставки заказов, '
+            'оформленных до их сохранения при оформлении. '
+            'Используются текущие цены товаров.')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.exclude(
+            state='basket'
+        ).filter(
+            total_sum__isnull=True
+        ).only('id', 'dt')
+
+        count = 0
+        for order in orders.iterator():
+            with transaction.atomic():
+                invalid_deliveries = snapshot_order(order)
+                order.save(update_fields=['total_sum', 'total_delivery'])
+            for error in invalid_deliveries:
+                self.stderr.write(f'Заказ {order.id}: {error}')
+            count += 1
+
+        # дата заказа и количество позиций в записях OrderShop,
+        # созданных до появления этих полей
+        order_shops = OrderShop.objects.filter(dt__isnull=True).update(
+            dt=Subquery(Order.objects.filter(
+                id=OuterRef('order_id')
+            ).values('dt')[:1]),
+            items_count=Subquery(OrderItem.objects.filter(
+                order_id=OuterRef('order_id'),
+                product_info__shop_id=OuterRef('shop_id')
+            ).order_by().values('order_id').annotate(
+                count=Count('id')
+            ).values('count')[:1])
+        )
+
+        # заказы, оформленные до появления журнала изменений,
+        # попадают в ленту изменений в порядке оформления
+        changes = OrderChange.objects.bulk_create(
+            OrderChange(order_id=order_id, shop_id=shop_id, state=state)
+            for order_id, shop_id, state in OrderShop.objects.exclude(
+                Exists(OrderChange.objects.filter(order_id=OuterRef('order_id'),
+                                                  shop_id=OuterRef('shop_id')))
+            ).order_by(
+                'dt', 'order_id'
+            ).values_list('order_id', 'shop_id', 'order__state').iterator()
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано заказов: {count}, '
+            f'заказов по магазинам: {order_shops}, '
+            f'записей в журнале изменений: {len(changes)}'
+        ))
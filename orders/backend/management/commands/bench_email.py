@@ -0,0 +1,113 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+from django.core.mail import EmailMultiAlternatives
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from backend.mail import QUEUE_KEY, send_queued
+from backend.redis_client import get_redis
+
+
+class SMTPSink:
+    """
+    Локальный SMTP-сервер, принимающий и отбрасывающий письма.
+    latency - задержка ответа на каждую команду (имитация сети).
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.received = 0
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, '127.0.0.1', 0)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def reply(self, writer, line):
+        await asyncio.sleep(self.latency)
+        writer.write(line)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        await self.reply(writer, b'220 sink\r\n')
+        while True:
+            line = await reader.readline()
+            command = line[:4].upper()
+            if not line or command == b'QUIT':
+                await self.reply(writer, b'221 bye\r\n')
+                break
+            if command == b'DATA':
+                await self.reply(writer, b'354 end with .\r\n')
+                while await reader.readline() not in (b'.\r\n', b''):
+                    pass
+                self.received += 1
+            await self.reply(writer, b'250 OK\r\n')
+        writer.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+
+
+class Command(BaseCommand):
+    help = ('Сравнить отправку писем по одному (новое соединение на письмо) '
+            'и пакетами из очереди через одно соединение. '
+            'Без --host письма отправляются локальному SMTP-серверу, '
+            'который их отбрасывает.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500,
+                            help='Количество писем')
+        parser.add_argument('--host', help='Адрес SMTP-сервера')
+        parser.add_argument('--port', type=int, default=25)
+        parser.add_argument('--latency', type=float, default=0.002,
+                            help='Задержка ответа локального сервера, с')
+
+    def handle(self, *args, **options):
+        sink = None
+        if options['host']:
+            host, port = options['host'], options['port']
+        else:
+            sink = SMTPSink(options['latency'])
+            host, port = '127.0.0.1', sink.port
+
+        count = options['count']
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST=host, EMAIL_PORT=port, EMAIL_USE_TLS=False,
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD=''
+        ):
+            # по одному письму, как отправляла прежняя задача
+            start = time.perf_counter()
+            for i in range(count):
+                EmailMultiAlternatives(f'Письмо {i}', 'Текст',
+                                       'bench@example.com',
+                                       ['to@example.com']).send()
+            self.report('По одному', count, time.perf_counter() - start)
+
+            # пакетами из отдельной очереди: письма основной очереди
+            # не отправляются и не смешиваются с тестовыми
+            queue_key = f'{QUEUE_KEY}:bench:{uuid.uuid4().hex}'
+            client = get_redis()
+            try:
+                client.rpush(queue_key, *[json.dumps({
+                    'title': f'Письмо {i}', 'message': 'Текст',
+                    'from': 'bench@example.com', 'to': ['to@example.com'],
+                    'attempts': 0,
+                }) for i in range(count)])
+                result = send_queued(queue_key=queue_key)
+            finally:
+                client.delete(queue_key)
+            self.report('Из очереди', result['sent'], result['seconds'])
+
+        if sink:
+            sink.stop()
+            self.stdout.write(f'Получено сервером: {sink.received}')
+
+    def report(self, name, count, seconds):
+        self.stdout.write(f'{name}: {count} писем за {seconds:.2f} с, '
+                          f'{count / seconds:.1f} писем/с')
@@ -0,0 +1,79 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест запросов на чтение с медленными клиентами: '
+            'клиенты читают ответ частями с паузами. '
+            'Для сравнения запустите тест для WSGI (порт 8000) '
+            'и ASGI (порт 8001) серверов.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url',
+                            default='http://127.0.0.1:8001/api/v1/products/')
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Общее количество запросов')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Количество одновременных клиентов')
+        parser.add_argument('--chunk', type=int, default=1024,
+                            help='Размер части ответа, байт')
+        parser.add_argument('--read-delay', type=float, default=0.05,
+                            help='Пауза между чтением частей ответа, с')
+        parser.add_argument('--token', help='Токен пользователя')
+
+    def handle(self, *args, **options):
+        latencies, errors, elapsed = asyncio.run(self.run(options))
+        done = len(latencies)
+        self.stdout.write(f'Запросов: {done + errors}, ошибок: {errors}, '
+                          f'время: {elapsed:.2f} с, '
+                          f'запросов в секунду: {done / elapsed:.1f}')
+        if done > 1:
+            quantiles = statistics.quantiles(latencies, n=100)
+            self.stdout.write(f'Время ответа, мс: '
+                              f'p50 {quantiles[49] * 1000:.0f}, '
+                              f'p95 {quantiles[94] * 1000:.0f}, '
+                              f'max {max(latencies) * 1000:.0f}')
+
+    async def run(self, options):
+        url = urlsplit(options['url'])
+        path = url.path + (f'?{url.query}' if url.query else '')
+        headers = [f'GET {path} HTTP/1.1', f'Host: {url.netloc}',
+                   'Connection: close']
+        if options['token']:
+            headers.append(f"Authorization: Token {options['token']}")
+        request = ('\r\n'.join(headers) + '\r\n\r\n').encode()
+
+        remaining = options['requests']
+        latencies, errors = [], 0
+
+        async def client():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    reader, writer = await asyncio.open_connection(
+                        url.hostname, url.port or 80
+                    )
+                    writer.write(request)
+                    await writer.drain()
+                    status_line = await reader.readline()
+                    while await reader.read(options['chunk']):
+                        await asyncio.sleep(options['read_delay'])
+                    writer.close()
+                except OSError:
+                    errors += 1
+                    continue
+                if b' 200 ' in status_line:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client()
+                               for _ in range(options['concurrency'])])
+        return latencies, errors, time.perf_counter() - start
@@ -0,0 +1,295 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from backend.checkout import shop_delivery
+from backend.models import (User, Shop, Category, Product, ProductInfo,
+                            Parameter, ProductParameter, Address, Order,
+                            OrderItem, OrderShop, OrderChange, Delivery,
+                            STATE_CHOICES)
+
+PASSWORD = 'load-test-password'
+
+PARAMETERS = {
+    'Цвет': ('черный', 'белый', 'серый', 'синий', 'красный', 'зеленый'),
+    'Размер': ('XS', 'S', 'M', 'L', 'XL'),
+    'Материал': ('пластик', 'металл', 'стекло', 'дерево', 'ткань'),
+    'Гарантия, мес.': ('6', '12', '24', '36'),
+    'Вес, г': None,
+    'Страна': ('Россия', 'Китай', 'Корея', 'Германия', 'Вьетнам'),
+}
+
+# уровни стоимости доставки магазина: (минимальная сумма, стоимость)
+DELIVERY_TIERS = ((0, 500), (5000, 300), (20000, 0))
+
+CITIES = ('Москва', 'Санкт-Петербург', 'Казань', 'Новосибирск',
+          'Екатеринбург', 'Самара')
+
+ORDER_STATES = [state for state, _ in STATE_CHOICES if state != 'basket']
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = ('Заполнить базу синтетическими данными для нагрузочного '
+            'тестирования (см. команду load_test): магазины с уровнями '
+            'стоимости доставки, категории, товары с параметрами, '
+            'покупатели с адресами и токенами, история заказов. '
+            f'Пароль всех пользователей - {PASSWORD}.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shops', type=int, default=20,
+                            help='Количество магазинов')
+        parser.add_argument('--categories', type=int, default=50,
+                            help='Количество категорий')
+        parser.add_argument('--products', type=int, default=50000,
+                            help='Количество позиций в каждом магазине')
+        parser.add_argument('--parameters', type=int, default=3,
+                            help='Количество параметров у позиции')
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Количество покупателей')
+        parser.add_argument('--orders', type=int, default=100000,
+                            help='Количество оформленных заказов')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Период истории заказов, дней')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Строк в одном запросе INSERT')
+        parser.add_argument('--prefix', default='load',
+                            help='Префикс адресов почты пользователей')
+        parser.add_argument('--seed', type=int,
+                            help='Начальное значение генератора случайных '
+                                 'чисел')
+
+    def handle(self, *args, **options):
+        if options['parameters'] > len(PARAMETERS):
+            raise CommandError(f'Параметров не больше {len(PARAMETERS)}')
+        if User.objects.filter(
+            email__startswith=f"{options['prefix']}-"
+        ).exists():
+            raise CommandError(f"Данные с префиксом {options['prefix']} "
+                               f"уже созданы")
+
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.password = make_password(PASSWORD)
+
+        shops = self.step('Магазины', self.create_shops, options)
+        categories = self.step('Категории', self.create_categories,
+                               options, shops)
+        self.step('Товары', self.create_products, options, shops,
+                  categories)
+        buyers = self.step('Покупатели', self.create_buyers, options)
+        self.step('Заказы', self.create_orders, options, shops, buyers)
+
+    def step(self, title, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        self.stdout.write(f'{title}: {time.perf_counter() - start:.1f} с')
+        return result
+
+    def create_users(self, emails, user_type):
+        users = User.objects.bulk_create(
+            (User(email=email, password=self.password, type=user_type,
+                  is_active=True, first_name='Тест', last_name=str(number))
+             for number, email in enumerate(emails)),
+            batch_size=self.batch_size
+        )
+        Token.objects.bulk_create(
+            (Token(key=Token.generate_key(), user=user) for user in users),
+            batch_size=self.batch_size
+        )
+        return users
+
+    @transaction.atomic
+    def create_shops(self, options):
+        prefix = options['prefix']
+        partners = self.create_users(
+            (f'{prefix}-partner-{number}@example.com'
+             for number in range(options['shops'])), 'shop'
+        )
+        shops = Shop.objects.bulk_create(
+            Shop(name=f'Магазин {number}', user=partner, state=True,
+                 is_uptodate=True)
+            for number, partner in enumerate(partners)
+        )
+        Delivery.objects.bulk_create(
+            Delivery(shop=shop, min_sum=min_sum, cost=cost)
+            for shop in shops for min_sum, cost in DELIVERY_TIERS
+        )
+        return shops
+
+    @transaction.atomic
+    def create_categories(self, options, shops):
+        categories = Category.objects.bulk_create(
+            Category(name=f'Категория {number}')
+            for number in range(options['categories'])
+        )
+        Category.shops.through.objects.bulk_create(
+            Category.shops.through(category=category, shop=shop)
+            for category in categories for shop in shops
+        )
+        return categories
+
+    def create_products(self, options, shops, categories):
+        """
+        Каждый магазин продает одни и те же products товаров
+        по своим ценам и со своими остатками
+        """
+        parameters = [Parameter.objects.get_or_create(name=name)[0]
+                      for name in PARAMETERS][:options['parameters']]
+
+        products = []
+        for batch in batches(range(options['products']), self.batch_size):
+            with transaction.atomic():
+                products += Product.objects.bulk_create(
+                    Product(name=f'Товар {number}',
+                            category=self.random.choice(categories))
+                    for number in batch
+                )
+        self.product_prices = {}
+        for product in products:
+            self.product_prices[product.id] = self.random.randint(100, 50000)
+
+        offers = ((shop, product) for shop in shops for product in products)
+        written = 0
+        for batch in batches(offers, self.batch_size):
+            with transaction.atomic():
+                product_infos = ProductInfo.objects.bulk_create(
+                    self.product_info(shop, product) for shop, product in batch
+                )
+                ProductParameter.objects.bulk_create(
+                    ProductParameter(product_info=product_info,
+                                     parameter=parameter,
+                                     value=self.parameter_value(parameter))
+                    for product_info in product_infos
+                    for parameter in parameters
+                )
+            written += len(batch)
+            self.stdout.write(f'  позиций: {written}')
+
+    def product_info(self, shop, product):
+        price_rrc = self.product_prices[product.id]
+        return ProductInfo(
+            product=product, shop=shop, external_id=product.id,
+            model=f'M-{product.id}',
+            quantity=self.random.randint(1000, 100000),
+            price=int(price_rrc * self.random.uniform(0.8, 1.0)),
+            price_rrc=price_rrc
+        )
+
+    def parameter_value(self, parameter):
+        values = PARAMETERS[parameter.name]
+        if values is None:
+            return str(self.random.randint(50, 5000))
+        return self.random.choice(values)
+
+    @transaction.atomic
+    def create_buyers(self, options):
+        prefix = options['prefix']
+        buyers = self.create_users(
+            (f'{prefix}-buyer-{number}@example.com'
+             for number in range(options['users'])), 'buyer'
+        )
+        addresses = Address.objects.bulk_create(
+            (Address(user=buyer, city=self.random.choice(CITIES),
+                     street=f'Улица {self.random.randint(1, 300)}',
+                     house=str(self.random.randint(1, 100)),
+                     apartment=str(self.random.randint(1, 500)))
+             for buyer in buyers),
+            batch_size=self.batch_size
+        )
+        return list(zip(buyers, addresses))
+
+    def create_orders(self, options, shops, buyers):
+        """
+        Оформленные заказы из 1-3 магазинов по 1-4 позиции в каждом
+        с зафиксированными ценами, суммами и стоимостью доставки
+        """
+        # доставка считается так же, как при оформлении заказа
+        prefetch_related_objects(shops, 'delivery')
+        # позиции загружаются только для выборки, а не все
+        sample_size = min(options['products'], 1000)
+        offers = {
+            shop.id: list(ProductInfo.objects.filter(
+                shop=shop
+            ).order_by('?').values_list('id', 'price')[:sample_size])
+            for shop in shops
+        }
+        now = timezone.now()
+        period = options['days'] * 24 * 3600
+
+        written = 0
+        for batch in batches(range(options['orders']), self.batch_size):
+            dates, orders, lines = [], [], []
+            for _ in batch:
+                buyer, address = self.random.choice(buyers)
+                dates.append(now - timedelta(
+                    seconds=self.random.randint(0, period)
+                ))
+                orders.append(Order(user=buyer, address=address,
+                                    state=self.random.choice(ORDER_STATES)))
+                shop_lines = {}
+                for shop in self.random.sample(
+                    shops, min(len(shops), self.random.randint(1, 3))
+                ):
+                    items = dict(self.random.sample(
+                        offers[shop.id],
+                        min(len(offers[shop.id]), self.random.randint(1, 4))
+                    ))
+                    shop_lines[shop] = items
+                lines.append(shop_lines)
+
+            with transaction.atomic():
+                Order.objects.bulk_create(orders)
+                items, order_shops, changes = [], [], []
+                for order, dt, shop_lines in zip(orders, dates, lines):
+                    # дата заказа задается после вставки (auto_now_add)
+                    order.dt = dt
+                    order.total_sum, order.total_delivery = 0, 0
+                    for shop, shop_items in shop_lines.items():
+                        quantities = {product_info_id:
+                                      self.random.randint(1, 3)
+                                      for product_info_id in shop_items}
+                        shop_sum = sum(shop_items[product_info_id] * quantity
+                                       for product_info_id, quantity
+                                       in quantities.items())
+                        delivery = shop_delivery(shop, shop_sum)
+                        order.total_sum += shop_sum
+                        order.total_delivery += delivery
+                        items += [OrderItem(order=order,
+                                            product_info_id=product_info_id,
+                                            quantity=quantity,
+                                            price=shop_items[product_info_id])
+                                  for product_info_id, quantity
+                                  in quantities.items()]
+                        order_shops.append(OrderShop(
+                            order=order, shop=shop, dt=dt,
+                            shop_sum=shop_sum, items_count=len(quantities),
+                            delivery=delivery
+                        ))
+                        changes.append(OrderChange(order=order, shop=shop,
+                                                   state=order.state))
+                Order.objects.bulk_update(
+                    orders, ['dt', 'total_sum', 'total_delivery']
+                )
+                OrderItem.objects.bulk_create(items)
+                OrderShop.objects.bulk_create(order_shops)
+                OrderChange.objects.bulk_create(changes)
+            written += len(batch)
+            self.stdout.write(f'  заказов: {written}')
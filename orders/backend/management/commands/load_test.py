@@ -0,0 +1,192 @@
+import abc
+import random
+import threading
+import time
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from backend.loadtest import Stats, write_report
+from backend.models import Address
+
+
+class VirtualUser(threading.Thread, abc.ABC):
+    """
+    Клиент API, повторяющий сценарий до окончания теста
+    """
+
+    def __init__(self, token, stats, deadline, options):
+        super().__init__(daemon=True)
+        self.stats = stats
+        self.deadline = deadline
+        self.options = options
+        self.random = random.Random()
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Token {token}'
+
+    def request(self, name, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.options['url'] + path,
+                timeout=self.options['timeout'], **kwargs
+            )
+        except requests.RequestException:
+            self.stats.add(name, time.perf_counter() - start, None)
+            return None
+        self.stats.add(name, time.perf_counter() - start,
+                       response.status_code)
+        return response if response.ok else None
+
+    def pause(self):
+        time.sleep(self.random.uniform(0, 2 * self.options['think_time']))
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            self.scenario()
+
+    @abc.abstractmethod
+    def scenario(self):
+        """
+        Один проход сценария пользователя
+        """
+
+
+class Buyer(VirtualUser):
+    """
+    Покупатель: просматривает каталог, ищет товары по категории,
+    добавляет их в корзину и оформляет часть заказов
+    """
+
+    def __init__(self, *args, address_id, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.address_id = address_id
+
+    def scenario(self):
+        categories = self.request('categories', 'GET', 'categories/')
+        shops = self.request('shops', 'GET', 'shops/')
+        if categories is None or shops is None:
+            self.pause()
+            return
+        categories, shops = categories.json(), shops.json()
+        if not categories or not shops:
+            self.pause()
+            return
+        self.pause()
+
+        # каталог магазина
+        shop = self.random.choice(shops)
+        self.request('products?shop_id', 'GET', 'products/',
+                     params={'shop_id': shop['id'],
+                             'category_id': self.random.choice(
+                                 categories)['id']})
+        self.pause()
+
+        # поиск по категории во всех магазинах
+        products = self.request(
+            'products?category_id', 'GET', 'products/',
+            params={'category_id': self.random.choice(categories)['id']}
+        )
+        products = products.json() if products is not None else []
+        if not products:
+            return
+        self.pause()
+
+        items = [{'product_info': product_info['id'],
+                  'quantity': self.random.randint(1, 3)}
+                 for product_info in self.random.sample(
+                     products, min(len(products), self.random.randint(1, 3))
+                 )]
+        if self.request('basket POST', 'POST', 'basket/',
+                        json={'items': items}) is None:
+            return
+        self.request('basket', 'GET', 'basket/')
+        self.pause()
+
+        if self.random.random() < self.options['checkout_rate']:
+            self.request('order POST', 'POST', 'order/',
+                         json={'address_id': self.address_id})
+            self.request('order', 'GET', 'order/')
+            self.pause()
+
+
+class Partner(VirtualUser):
+    """
+    Поставщик: опрашивает список заказов и ленту изменений
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor = None
+
+    def scenario(self):
+        self.request('partner/orders', 'GET', 'partner/orders/')
+        params = {'cursor': self.cursor} if self.cursor else {}
+        changes = self.request('partner/orders/changes', 'GET',
+                               'partner/orders/changes/', params=params)
+        if changes is not None:
+            self.cursor = changes.json()['cursor']
+        time.sleep(max(0, min(self.options['poll_interval'],
+                              self.deadline - time.monotonic())))
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест API по сценарию: покупатели просматривают '
+            'каталог, ищут товары, добавляют их в корзину и оформляют '
+            'заказы, поставщики опрашивают заказы. Используются '
+            'пользователи, созданные командой generate_data. '
+            'Для оценки предельной нагрузки запустите сервер '
+            'с THROTTLE_DISABLED=True.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/api/v1/')
+        parser.add_argument('--buyers', type=int, default=20,
+                            help='Количество одновременных покупателей')
+        parser.add_argument('--partners', type=int, default=2,
+                            help='Количество одновременных поставщиков')
+        parser.add_argument('--duration', type=float, default=60,
+                            help='Продолжительность теста, с')
+        parser.add_argument('--think-time', type=float, default=0.5,
+                            help='Средняя пауза покупателя между шагами, с')
+        parser.add_argument('--poll-interval', type=float, default=5,
+                            help='Интервал опроса заказов поставщиком, с')
+        parser.add_argument('--checkout-rate', type=float, default=0.2,
+                            help='Доля сценариев, завершающихся заказом')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Время ожидания ответа, с')
+        parser.add_argument('--prefix', default='load',
+                            help='Префикс адресов почты пользователей')
+
+    def handle(self, *args, **options):
+        if not options['url'].endswith('/'):
+            options['url'] += '/'
+        prefix = options['prefix']
+        buyers = list(Address.objects.filter(
+            user__email__startswith=f'{prefix}-buyer-',
+            user__auth_token__isnull=False
+        ).values_list('user__auth_token__key', 'id')[:options['buyers']])
+        partners = list(Token.objects.filter(
+            user__email__startswith=f'{prefix}-partner-'
+        ).values_list('key', flat=True)[:options['partners']])
+        if len(buyers) < options['buyers'] or \
+                len(partners) < options['partners']:
+            raise CommandError('Недостаточно пользователей, '
+                               'запустите generate_data')
+
+        stats = Stats()
+        deadline = time.monotonic() + options['duration']
+        users = [Buyer(token, stats, deadline, options,
+                       address_id=address_id)
+                 for token, address_id in buyers]
+        users += [Partner(token, stats, deadline, options)
+                  for token in partners]
+
+        start = time.perf_counter()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.perf_counter() - start
+
+        write_report(self.stdout, stats, elapsed)
@@ -0,0 +1,36 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from backend.metrics import histograms, merge, quantile
+from backend.redis_client import get_redis
+
+
+class Command(BaseCommand):
+    help = ('Длина очередей Celery и время ожидания задач в очереди '
+            'до начала выполнения (для подбора количества воркеров).')
+
+    def handle(self, *args, **options):
+        queues = {settings.CELERY_TASK_DEFAULT_QUEUE}
+        queues.update(route['queue']
+                      for route in settings.CELERY_TASK_ROUTES.values())
+        # гистограммы записываются по очереди и задаче
+        by_queue = defaultdict(list)
+        for labels, histogram in histograms('celery_queue_latency_seconds'):
+            by_queue[labels.get('queue')].append(histogram)
+        latencies = {queue: merge(queue_histograms)
+                     for queue, queue_histograms in by_queue.items()}
+
+        client = get_redis()
+        for queue in sorted(queues | set(latencies) - {None}):
+            line = f'{queue}: в очереди {client.llen(queue)}'
+            histogram = latencies.get(queue)
+            if histogram and histogram['count']:
+                p95 = quantile(histogram, 0.95)
+                line += (f', задач выполнено {histogram["count"]}, '
+                         f'ожидание в среднем '
+                         f'{histogram["sum"] / histogram["count"]:.3f} с, '
+                         f'p50 <= {quantile(histogram, 0.5)} с, '
+                         f'p95 <= {p95 if p95 is not None else "> 300"} с')
+            self.stdout.write(line)
@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from backend.outbox import relay
+
+
+class Command(BaseCommand):
+    help = ('Публиковать исходящие сообщения (задачи Celery и письма), '
+            'записанные обработчиками запросов в таблицу OutboxMessage.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Опубликовать накопленные сообщения '
+                                 'и завершить работу')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            count = relay()
+            if count:
+                self.stdout.write(f'Опубликовано сообщений: {count}')
+            elif options['once']:
+                break
+            else:
+                time.sleep(settings.OUTBOX_POLL_INTERVAL)
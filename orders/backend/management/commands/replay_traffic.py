@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from backend.loadtest import Stats, write_comparison, write_report
+from backend.traffic import read_files
+
+
+class Command(BaseCommand):
+    help = ('Воспроизвести запросы, записанные TrafficCaptureMiddleware, '
+            'с исходными интервалами (или ускоренно) и вывести время ответа '
+            'по эндпоинтам. Запросы пользователей выполняются от имени '
+            'пользователей того же типа, созданных командой generate_data. '
+            'Результат можно сохранить (--save) и сравнить с результатом '
+            'другой сборки (--baseline).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+',
+                            help='Файлы NDJSON или каталоги с ними')
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--speed', type=float, default=1,
+                            help='Ускорение относительно записи '
+                                 '(0 - без пауз между запросами)')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Наибольшее количество одновременных '
+                                 'запросов')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Время ожидания ответа, с')
+        parser.add_argument('--prefix', default='load',
+                            help='Префикс адресов почты пользователей')
+        parser.add_argument('--save',
+                            help='Сохранить время ответа в файл JSON')
+        parser.add_argument('--baseline',
+                            help='Файл JSON с результатом, сохраненным '
+                                 'с --save, для сравнения')
+
+    def handle(self, *args, **options):
+        entries = read_files(options['paths'])
+        if not entries:
+            raise CommandError('Нет записанных запросов')
+        self.url = options['url'].rstrip('/')
+        self.timeout = options['timeout']
+        self.stats = Stats()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.lag = 0.0
+        self.mismatched = 0
+
+        # каждому записанному пользователю назначается пользователь
+        # того же типа тестового стенда
+        tokens = {user_type: cycle(list(Token.objects.filter(
+            user__email__startswith=f"{options['prefix']}-",
+            user__type=user_type
+        ).values_list('key', flat=True)) or [None])
+            for user_type in ('buyer', 'shop')}
+        users = {}
+
+        start = time.monotonic()
+        first = entries[0]['time']
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            for entry in entries:
+                scheduled = start
+                if options['speed']:
+                    scheduled += (entry['time'] - first) / options['speed']
+                    time.sleep(max(0, scheduled - time.monotonic()))
+                token = None
+                if entry['user'] and entry['user_type'] in tokens:
+                    if entry['user'] not in users:
+                        users[entry['user']] = next(
+                            tokens[entry['user_type']]
+                        )
+                    token = users[entry['user']]
+                executor.submit(self.send, entry, token, scheduled)
+        elapsed = time.monotonic() - start
+
+        write_report(self.stdout, self.stats, elapsed)
+        self.stdout.write(f'Ответов с другим классом статуса, чем при '
+                          f'записи: {self.mismatched}, наибольшее '
+                          f'отставание от расписания: {self.lag:.2f} с')
+
+        latencies = dict(self.stats.latencies)
+        if options['save']:
+            with open(options['save'], 'w') as file:
+                json.dump(latencies, file)
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                write_comparison(self.stdout, json.load(file), latencies)
+
+    def send(self, entry, token, scheduled):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        headers = {'Authorization': f'Token {token}'} if token else {}
+
+        start = time.monotonic()
+        try:
+            response = session.request(
+                entry['method'], self.url + entry['path'],
+                params=entry['params'], json=entry['body'], headers=headers,
+                timeout=self.timeout
+            )
+            status_code = response.status_code
+        except requests.RequestException:
+            status_code = None
+        self.stats.add(entry['view'], time.monotonic() - start, status_code)
+
+        with self.lock:
+            self.lag = max(self.lag, start - scheduled)
+            if status_code is None or \
+                    status_code // 100 != entry['status'] // 100:
+                self.mismatched += 1
@@ -0,0 +1,230 @@
+"""
+Метрики в Redis, общие для всех процессов (веб-серверы, воркеры Celery).
+
+Гистограмма хранится в хэше metrics:<имя>:<метки> с полями count, sum
+и накопленными счетчиками le:<граница> для границ BUCKETS, как гистограммы
+Prometheus. Ключи всех гистограмм перечислены в множестве metrics:keys.
+
+Счетчик хранится в строковом ключе metrics:<имя>:<метки>, ключи всех
+счетчиков перечислены в множестве metrics:counters.
+
+Все метрики выводятся в текстовом формате Prometheus (render_prometheus,
+эндпоинт /metrics).
+"""
+import logging
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEYS_KEY = 'metrics:keys'
+COUNTERS_KEY = 'metrics:counters'
+# границы гистограмм длительностей (секунды)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, 300.0)
+# границы гистограмм количеств и размеров
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+HISTOGRAM_BUCKETS = {
+    'http_db_queries': COUNT_BUCKETS,
+    'http_response_size_bytes': SIZE_BUCKETS,
+    'import_goods_per_second': RATE_BUCKETS,
+}
+
+
+def _buckets(name):
+    return HISTOGRAM_BUCKETS.get(name, BUCKETS)
+
+
+def _key(name, labels):
+    # ':' разделяет метки в ключе, поэтому в значениях меток заменяется
+    return ':'.join(['metrics', name] + [
+        f'{label}={str(value).replace(":", "_")}'
+        for label, value in sorted(labels.items())
+    ])
+
+
+def observe(name, value, **labels):
+    """
+    Добавить значение в гистограмму. Ошибка записи метрики
+    не прерывает основную работу.
+    """
+    observe_many([(name, value, labels)])
+
+
+def observe_many(observations):
+    """
+    Добавить значения в гистограммы за один запрос к Redis.
+    observations - список кортежей (имя, значение, метки).
+    """
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for name, value, labels in observations:
+            key = _key(name, labels)
+            pipe.hincrby(key, 'count', 1)
+            pipe.hincrbyfloat(key, 'sum', value)
+            for bound in _buckets(name):
+                if value <= bound:
+                    pipe.hincrby(key, f'le:{bound}', 1)
+            pipe.sadd(KEYS_KEY, key)
+        pipe.execute()
+    except Exception:
+        logger.exception('Не удалось записать метрики %s',
+                         ', '.join(name for name, _, _ in observations))
+
+
+def increment(name, amount=1, **labels):
+    """
+    Увеличить счетчик. Ошибка записи метрики не прерывает основную работу.
+    """
+    key = _key(name, labels)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.incrby(key, amount)
+        pipe.sadd(COUNTERS_KEY, key)
+        pipe.execute()
+    except Exception:
+        logger.exception('Не удалось записать метрику %s', name)
+
+
+def _labels(prefix, key):
+    return dict(part.split('=', 1)
+                for part in key[len(prefix) + 1:].split(':') if part)
+
+
+def _matches(prefix, key):
+    return key == prefix or key.startswith(prefix + ':')
+
+
+def counters(name):
+    """
+    Значения счетчика: список пар (метки, значение)
+    """
+    client = get_redis()
+    prefix = f'metrics:{name}'
+    keys = sorted(key.decode() for key in client.smembers(COUNTERS_KEY))
+    keys = [key for key in keys if _matches(prefix, key)]
+    if not keys:
+        return []
+    return [(_labels(prefix, key), int(value))
+            for key, value in zip(keys, client.mget(keys))
+            if value is not None]
+
+
+def histograms(name):
+    """
+    Гистограммы метрики: список пар (метки, данные), данные - словарь
+    с ключами count, sum и buckets (список пар граница - количество)
+    """
+    client = get_redis()
+    prefix = f'metrics:{name}'
+    result = []
+    for key in sorted(client.smembers(KEYS_KEY)):
+        key = key.decode()
+        if not _matches(prefix, key):
+            continue
+        fields = {field.decode(): value.decode()
+                  for field, value in client.hgetall(key).items()}
+        if not fields:
+            continue
+        result.append((_labels(prefix, key), {
+            'count': int(fields['count']),
+            'sum': float(fields['sum']),
+            'buckets': [(bound, int(fields.get(f'le:{bound}', 0)))
+                        for bound in _buckets(name)],
+        }))
+    return result
+
+
+def merge(histograms):
+    """
+    Сумма гистограмм одной метрики (например, по всем значениям метки)
+    """
+    histograms = list(histograms)
+    return {
+        'count': sum(histogram['count'] for histogram in histograms),
+        'sum': sum(histogram['sum'] for histogram in histograms),
+        'buckets': [
+            (bound, sum(histogram['buckets'][i][1]
+                        for histogram in histograms))
+            for i, (bound, _) in enumerate(histograms[0]['buckets'])
+        ] if histograms else [],
+    }
+
+
+def quantile(histogram, q):
+    """
+    Оценка квантиля по гистограмме: верхняя граница интервала
+    (None, если значение больше последней границы)
+    """
+    rank = q * histogram['count']
+    for bound, count in histogram['buckets']:
+        if count >= rank:
+            return bound
+    return None
+
+
+def _split_key(key):
+    name, _, labels = key[len('metrics:'):].partition(':')
+    return name, dict(part.split('=', 1)
+                      for part in labels.split(':') if part)
+
+
+def _format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    values = ','.join(
+        '{}="{}"'.format(label, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in labels.items()
+    )
+    return '{' + values + '}'
+
+
+def render_prometheus():
+    """
+    Все метрики в текстовом формате Prometheus
+    """
+    client = get_redis()
+    histogram_keys = sorted(key.decode() for key in client.smembers(KEYS_KEY))
+    counter_keys = sorted(key.decode()
+                          for key in client.smembers(COUNTERS_KEY))
+    pipe = client.pipeline(transaction=False)
+    for key in histogram_keys:
+        pipe.hgetall(key)
+    if counter_keys:
+        pipe.mget(counter_keys)
+    results = pipe.execute()
+    counter_values = results.pop() if counter_keys else []
+
+    lines = []
+    typed = set()
+    for key, fields in zip(histogram_keys, results):
+        if not fields:
+            continue
+        fields = {field.decode(): value.decode()
+                  for field, value in fields.items()}
+        name, labels = _split_key(key)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} histogram')
+        for bound in _buckets(name):
+            lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} '
+                         f'{fields.get(f"le:{bound}", 0)}')
+        lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} '
+                     f'{fields["count"]}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {fields["sum"]}')
+        lines.append(f'{name}_count{_format_labels(labels)} '
+                     f'{fields["count"]}')
+
+    for key, value in zip(counter_keys, counter_values):
+        if value is None:
+            continue
+        name, labels = _split_key(key)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name}_total counter')
+        lines.append(f'{name}_total{_format_labels(labels)} {int(value)}')
+    return '\n'.join(lines) + '\n'
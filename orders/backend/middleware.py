@@ -0,0 +1,282 @@
+"""
+Замеры времени обработки запросов.
+
+PerformanceMiddleware для каждого представления записывает в гистограммы
+(backend.metrics, эндпоинт /metrics) общее время запроса, количество
+и время SQL-запросов, время построения данных ответа сериализаторами DRF
+(to_representation, TimedSerializerMixin), время отрисовки ответа в JSON
+(TimedJSONRenderer) и размер ответа. Все значения запроса записываются одним запросом к Redis.
+При DEBUG замеры добавляются в заголовок Server-Timing.
+Имя представления передается в запись медленных запросов
+(backend.slow_queries).
+
+TrafficCaptureMiddleware записывает часть запросов к API для последующего
+воспроизведения (backend.traffic, команда replay_traffic).
+
+Оба класса поддерживают синхронный и асинхронный режимы: под ASGI запросы
+не проходят через sync_to_async и не выполняются по очереди в одном потоке.
+Запись метрик и запросов под ASGI выполняется в пуле потоков, чтобы
+не блокировать цикл событий.
+
+SQL-запросы считаются по соединению потока, обрабатывающего запрос:
+под ASGI представления выполняются в других потоках, поэтому количество
+и время SQL-запросов записываются только под WSGI.
+"""
+import abc
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from rest_framework.renderers import JSONRenderer
+
+from . import traffic
+from .metrics import observe_many
+from .slow_queries import origin
+
+
+class QueryTimer:
+    """
+    Обертка выполнения SQL-запросов (connection.execute_wrapper),
+    считающая их количество и время
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+class SerializeTimer:
+    """
+    Время to_representation сериализаторов за время запроса
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.depth = 0
+
+
+# задается PerformanceMiddleware на время обработки запроса
+serialize_timer = ContextVar('serialize_timer', default=None)
+
+
+class TimedSerializerMixin:
+    """
+    Сериализатор DRF, добавляющий время to_representation к замерам
+    запроса (вложенные сериализаторы не учитываются повторно)
+    """
+
+    def to_representation(self, instance):
+        timer = serialize_timer.get()
+        if timer is None or timer.depth:
+            return super().to_representation(instance)
+        timer.depth += 1
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            timer.depth -= 1
+            timer.seconds += time.perf_counter() - start
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer, сохраняющий время отрисовки ответа в JSON в запросе
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        start = time.perf_counter()
+        try:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        finally:
+            request = (renderer_context or {}).get('request')
+            if request is not None:
+                request = getattr(request, '_request', request)
+                request.render_seconds = (
+                    getattr(request, 'render_seconds', 0.0)
+                    + time.perf_counter() - start
+                )
+
+
+def view_name(request):
+    """
+    Имя представления для меток метрик
+    """
+    match = request.resolver_match
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+class AsyncCapableMiddleware(abc.ABC):
+    """
+    Основа middleware с синхронным (handle) и асинхронным (ahandle)
+    обработчиками. Режим выбирается по get_response при создании.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = asyncio.iscoroutinefunction(get_response)
+        if self.async_mode:
+            # обработчик Django вызывает экземпляр как корутину
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.ahandle(request)
+        return self.handle(request)
+
+    @abc.abstractmethod
+    def handle(self, request):
+        """
+        Обработать запрос в синхронном режиме
+        """
+
+    @abc.abstractmethod
+    async def ahandle(self, request):
+        """
+        Обработать запрос в асинхронном режиме
+        """
+
+
+class PerformanceMiddleware(AsyncCapableMiddleware):
+
+    def handle(self, request):
+        token = origin.set(request.path)
+        try:
+            if not settings.PERF_METRICS_ENABLED:
+                return self.get_response(request)
+
+            timer = QueryTimer()
+            serialize = SerializeTimer()
+            serialize_token = serialize_timer.set(serialize)
+            start = time.perf_counter()
+            try:
+                with connection.execute_wrapper(timer):
+                    response = self.get_response(request)
+            finally:
+                serialize_timer.reset(serialize_token)
+            self.record(request, response, time.perf_counter() - start,
+                        serialize.seconds, timer)
+            return response
+        finally:
+            origin.reset(token)
+
+    async def ahandle(self, request):
+        token = origin.set(request.path)
+        try:
+            if not settings.PERF_METRICS_ENABLED:
+                return await self.get_response(request)
+
+            serialize = SerializeTimer()
+            serialize_token = serialize_timer.set(serialize)
+            start = time.perf_counter()
+            try:
+                response = await self.get_response(request)
+            finally:
+                serialize_timer.reset(serialize_token)
+            await sync_to_async(self.record, thread_sensitive=False)(
+                request, response, time.perf_counter() - start,
+                serialize.seconds
+            )
+            return response
+        finally:
+            origin.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        origin.set(view_name(request))
+
+    def record(self, request, response, total, serialize, timer=None):
+        """
+        Записать замеры запроса (serialize - время сериализаторов,
+        timer - счетчик SQL-запросов под WSGI)
+        """
+        render = getattr(request, 'render_seconds', 0.0)
+        size = 0 if response.streaming else len(response.content)
+        labels = {'view': view_name(request), 'method': request.method}
+        observations = [
+            ('http_request_duration_seconds', total, labels),
+            ('http_serialize_duration_seconds', serialize, labels),
+            ('http_render_duration_seconds', render, labels),
+            ('http_response_size_bytes', size, labels),
+        ]
+        if timer is not None:
+            observations += [
+                ('http_db_queries', timer.count, labels),
+                ('http_db_duration_seconds', timer.seconds, labels),
+            ]
+        observe_many(observations)
+
+        if settings.DEBUG:
+            timings = [f'total;dur={total * 1000:.1f}']
+            if timer is not None:
+                timings.append(f'db;dur={timer.seconds * 1000:.1f};'
+                               f'desc="{timer.count} queries"')
+            timings.append(f'serialize;dur={serialize * 1000:.1f}')
+            timings.append(f'render;dur={render * 1000:.1f}')
+            response['Server-Timing'] = ', '.join(timings)
+
+
+class TrafficCaptureMiddleware(AsyncCapableMiddleware):
+    """
+    Запись доли запросов к API в файлы NDJSON (TRAFFIC_CAPTURE_ENABLED)
+    """
+
+    def __init__(self, get_response):
+        if not settings.TRAFFIC_CAPTURE_ENABLED:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    @staticmethod
+    def sampled(request):
+        return request.path.startswith(
+            settings.TRAFFIC_CAPTURE_PATH_PREFIX
+        ) and random.random() < settings.TRAFFIC_CAPTURE_SAMPLE_RATE
+
+    def handle(self, request):
+        if not self.sampled(request):
+            return self.get_response(request)
+
+        # тело читается до представления, которое читает поток запроса
+        body = traffic.read_body(request)
+        started = time.time()
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, body, started,
+                    time.perf_counter() - start)
+        return response
+
+    async def ahandle(self, request):
+        if not self.sampled(request):
+            return await self.get_response(request)
+
+        body = traffic.read_body(request)
+        started = time.time()
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        await sync_to_async(self.record, thread_sensitive=False)(
+            request, response, body, started, time.perf_counter() - start
+        )
+        return response
+
+    @staticmethod
+    def record(request, response, body, started, duration):
+        # потоки событий не воспроизводятся
+        if not response.streaming:
+            traffic.record(request, body, view_name(request),
+                           response.status_code, started, duration)
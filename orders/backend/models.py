@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, connections
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 
@@ -20,6 +20,13 @@ USER_TYPE_CHOICES = (
     ('buyer', 'Покупатель'),
 )
 
+IMPORT_STATE_CHOICES = (
+    ('queued', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершен'),
+    ('failed', 'Ошибка'),
+)
+
 
 # Create your models here.
 
@@ -276,16 +283,88 @@ class Order(models.Model):
     address = models.ForeignKey(Address, verbose_name='Адрес',
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
+    stock_reserved = models.BooleanField(verbose_name='Товары зарезервированы',
+                                         default=False)
+    # суммы фиксируются при оформлении заказа
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма заказа',
+                                            blank=True, null=True)
+    total_delivery = models.PositiveIntegerField(
+        verbose_name='Стоимость доставки', blank=True, null=True
+    )
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = "Список заказов"
         ordering = ('-dt',)
+        indexes = [
+            # история заказов покупателя: все заказы и с фильтром по статусу
+            models.Index(fields=['user', 'dt'], name='order_user_dt_idx'),
+            models.Index(fields=['user', 'state', 'dt'],
+                         name='order_user_state_dt_idx'),
+            # список заказов в админке: по дате и с навигацией по датам
+            models.Index(fields=['dt', 'id'], name='order_dt_id_idx'),
+        ]
 
     def __str__(self):
         return f"Заказ {self.id} от {self.dt}"
 
 
+class OrderItemManager(models.Manager):
+    """
+    Менеджер заказанных позиций с массовым добавлением одним запросом
+    """
+
+    def bulk_upsert(self, order_id, quantities, replace=False):
+        """
+        Добавить позиции в заказ одним запросом INSERT ... ON CONFLICT
+        по ограничению unique_order_item.
+        :param order_id: id заказа
+        :param quantities: словарь {product_info_id: количество}
+        :param replace: заменить количество у существующих позиций
+        (по умолчанию количество прибавляется, но сумма не превышает
+        остатка товара)
+        :return: словарь {product_info_id: итоговое количество}
+        """
+        if not quantities:
+            return {}
+
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        meta = self.model._meta
+        table = quote_name(meta.db_table)
+        order_column = quote_name(meta.get_field('order').column)
+        product_info_column = quote_name(meta.get_field('product_info').column)
+        quantity_column = quote_name(meta.get_field('quantity').column)
+
+        if replace:
+            new_quantity = f'EXCLUDED.{quantity_column}'
+        else:
+            # сумма не больше остатка товара
+            stock_meta = ProductInfo._meta
+            stock_column = quote_name(stock_meta.get_field('quantity').column)
+            stock = (f'SELECT {stock_column} '
+                     f'FROM {quote_name(stock_meta.db_table)} '
+                     f'WHERE {quote_name(stock_meta.pk.column)} = '
+                     f'EXCLUDED.{product_info_column}')
+            new_quantity = (f'LEAST({table}.{quantity_column} + '
+                            f'EXCLUDED.{quantity_column}, ({stock}))')
+
+        values, params = [], []
+        for product_info_id, quantity in quantities.items():
+            values.append('(%s, %s, %s)')
+            params.extend([order_id, product_info_id, quantity])
+
+        sql = (f'INSERT INTO {table} '
+               f'({order_column}, {product_info_column}, {quantity_column}) '
+               f'VALUES {", ".join(values)} '
+               f'ON CONFLICT ({order_column}, {product_info_column}) '
+               f'DO UPDATE SET {quantity_column} = {new_quantity} '
+               f'RETURNING {product_info_column}, {quantity_column}')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return dict(cursor.fetchall())
+
+
 class OrderItem(models.Model):
     order = models.ForeignKey(Order,
                               verbose_name='Заказ',
@@ -298,6 +377,11 @@ class OrderItem(models.Model):
                                      blank=True,
                                      on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(verbose_name='Количество')
+    # цена фиксируется при оформлении заказа
+    price = models.PositiveIntegerField(verbose_name='Цена',
+                                        blank=True, null=True)
+
+    objects = OrderItemManager()
 
     class Meta:
         verbose_name = 'Заказанная позиция'
@@ -311,6 +395,99 @@ class OrderItem(models.Model):
         return f"{self.product_info}"
 
 
+class OrderShop(models.Model):
+    """
+    Заказ в магазине: сумма, количество позиций и стоимость доставки,
+    зафиксированные при оформлении заказа. Дата заказа дублируется,
+    чтобы заказы поставщика выбирались одним запросом по индексу.
+    """
+    order = models.ForeignKey(Order,
+                              verbose_name='Заказ',
+                              related_name='order_shops',
+                              on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop,
+                             verbose_name='Магазин',
+                             related_name='order_shops',
+                             on_delete=models.CASCADE)
+    dt = models.DateTimeField(verbose_name='Дата создания заказа',
+                              blank=True, null=True)
+    shop_sum = models.PositiveIntegerField(verbose_name='Сумма по магазину')
+    items_count = models.PositiveIntegerField(verbose_name='Количество позиций',
+                                              default=0)
+    delivery = models.PositiveIntegerField(verbose_name='Стоимость доставки',
+                                           blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Заказ по магазину'
+        verbose_name_plural = "Список заказов по магазинам"
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'shop'],
+                                    name='unique_order_shop'),
+        ]
+        indexes = [
+            # заказы поставщика от новых к старым
+            models.Index(fields=['shop', '-dt'],
+                         name='order_shop_shop_dt_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.order}: {self.shop}"
+
+
+class OrderChangeManager(models.Manager):
+    """
+    Менеджер журнала изменений заказов
+    """
+
+    def record(self, order):
+        """
+        Записать изменение заказа для всех магазинов заказа
+        (вызывается в транзакции, изменяющей заказ)
+        """
+        shop_ids = OrderShop.objects.filter(
+            order_id=order.id
+        ).values_list('shop_id', flat=True)
+        return self.bulk_create([
+            self.model(order_id=order.id, shop_id=shop_id, state=order.state)
+            for shop_id in shop_ids
+        ])
+
+
+class OrderChange(models.Model):
+    """
+    Журнал изменений заказов для ленты изменений поставщика.
+    Возрастающий id - номер изменения в последовательности.
+    """
+    id = models.BigAutoField(primary_key=True)
+    order = models.ForeignKey(Order,
+                              verbose_name='Заказ',
+                              related_name='changes',
+                              on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop,
+                             verbose_name='Магазин',
+                             related_name='order_changes',
+                             on_delete=models.CASCADE)
+    state = models.CharField(verbose_name='Статус',
+                             choices=STATE_CHOICES,
+                             max_length=15)
+    created_at = models.DateTimeField(verbose_name='Время изменения',
+                                      auto_now_add=True)
+
+    objects = OrderChangeManager()
+
+    class Meta:
+        verbose_name = 'Изменение заказа'
+        verbose_name_plural = "Журнал изменений заказов"
+        indexes = [
+            # изменения заказов магазина по порядку
+            models.Index(fields=['shop', 'id'],
+                         name='order_change_shop_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.order}: {self.state}"
+
+
 class Delivery(models.Model):
     shop = models.ForeignKey(Shop,
                              verbose_name='Магазин',
@@ -340,6 +517,11 @@ class ConfirmEmailToken(models.Model):
     class Meta:
         verbose_name = 'Токен подтверждения Email'
         verbose_name_plural = 'Токены подтверждения Email'
+        indexes = [
+            # удаление устаревших токенов (cleanup.purge_expired)
+            models.Index(fields=['created_at'],
+                         name='confirm_token_created_at_idx'),
+        ]
 
     @staticmethod
     def generate_key():
@@ -377,3 +559,80 @@ class ConfirmEmailToken(models.Model):
 
     def __str__(self):
         return "Password reset token for user {user}".format(user=self.user)
+
+
+class OutboxMessage(models.Model):
+    """
+    Исходящее сообщение (задача Celery, письмо), записанное в транзакции
+    изменения данных и публикуемое после ее фиксации (см. backend.outbox)
+    """
+    id = models.BigAutoField(primary_key=True)
+    topic = models.CharField(verbose_name='Тип', max_length=50)
+    payload = models.JSONField(verbose_name='Данные')
+    created_at = models.DateTimeField(verbose_name='Время создания',
+                                      auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Исходящее сообщение'
+        verbose_name_plural = "Исходящие сообщения"
+
+    def __str__(self):
+        return f"{self.topic} {self.id}"
+
+
+class ImportRun(models.Model):
+    """
+    Загрузка прайс-листа магазина: длительность этапов (получение файла,
+    разбор, запись в базу), количество строк и ошибки.
+    Ход записи обновляется задачей do_import_task.
+    """
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='import_runs',
+                             on_delete=models.CASCADE)
+    state = models.CharField(verbose_name='Статус',
+                             choices=IMPORT_STATE_CHOICES,
+                             max_length=15, default='queued')
+    created_at = models.DateTimeField(verbose_name='Создан',
+                                      auto_now_add=True)
+    started_at = models.DateTimeField(verbose_name='Начало записи',
+                                      blank=True, null=True)
+    finished_at = models.DateTimeField(verbose_name='Окончание',
+                                       blank=True, null=True)
+    fetch_seconds = models.FloatField(verbose_name='Получение файла, с',
+                                      blank=True, null=True)
+    parse_seconds = models.FloatField(verbose_name='Разбор, с',
+                                      blank=True, null=True)
+    write_seconds = models.FloatField(verbose_name='Запись, с',
+                                      blank=True, null=True)
+    goods_total = models.PositiveIntegerField(verbose_name='Товаров в файле',
+                                              default=0)
+    goods_written = models.PositiveIntegerField(verbose_name='Записано товаров',
+                                                default=0)
+    rows_deleted = models.PositiveIntegerField(
+        verbose_name='Удалено позиций', default=0
+    )
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+
+    class Meta:
+        verbose_name = 'Загрузка прайс-листа'
+        verbose_name_plural = "Загрузки прайс-листов"
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f"Загрузка {self.id} ({self.shop})"
+
+    @property
+    def rows_delta(self):
+        """
+        Изменение количества позиций магазина
+        """
+        return self.goods_written - self.rows_deleted
+
+    @property
+    def rows_per_second(self):
+        """
+        Скорость записи товаров
+        """
+        if not self.write_seconds:
+            return None
+        return round(self.goods_written / self.write_seconds, 1)
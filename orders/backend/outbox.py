@@ -0,0 +1,127 @@
+"""
+Исходящие сообщения (transactional outbox).
+
+Обработчики запросов не обращаются к брокеру и Redis: задачи Celery
+и письма записываются в таблицу OutboxMessage в той же транзакции,
+что и изменения данных. Сообщения отмененных транзакций не публикуются.
+Процесс manage.py relay_outbox выбирает сообщения пакетами
+(SELECT ... FOR UPDATE SKIP LOCKED, поэтому процессов может быть
+несколько), публикует их и удаляет в той же транзакции. Если процесс
+остановится между публикацией и фиксацией, пакет будет опубликован
+повторно, поэтому в каждое опубликованное сообщение добавляется его id
+(outbox_id), а получатели (задачи Celery с OutboxTask, отправка писем
+и сводки администратора) отмечают сообщение в Redis (outbox:<id>,
+OUTBOX_DEDUPE_TTL секунд) перед обработкой и пропускают повторы.
+"""
+from collections import defaultdict
+
+from celery import Task, current_app
+from django.conf import settings
+from django.db import transaction
+
+from .models import OutboxMessage
+from .redis_client import get_redis
+
+PROCESSED_KEY = 'outbox:{id}'
+
+
+def add(topic, payload):
+    """
+    Записать сообщение в текущей транзакции
+    """
+    return OutboxMessage.objects.create(topic=topic, payload=payload)
+
+
+def send_task(name, *args, **kwargs):
+    """
+    Поставить задачу Celery после фиксации текущей транзакции
+    (повторы пропускаются задачами с base=OutboxTask)
+    """
+    return add('task', {'task': name, 'args': list(args), 'kwargs': kwargs})
+
+
+def claim(payload):
+    """
+    Отметить сообщение как обрабатываемое получателем.
+    :return: False, если сообщение уже обработано (опубликовано повторно)
+    """
+    outbox_id = payload.get('outbox_id')
+    if outbox_id is None:
+        return True
+    return bool(get_redis().set(PROCESSED_KEY.format(id=outbox_id), 1,
+                                nx=True, ex=settings.OUTBOX_DEDUPE_TTL))
+
+
+def release(payload):
+    """
+    Снять отметку с сообщения, которое не удалось обработать,
+    чтобы его можно было обработать повторно
+    """
+    outbox_id = payload.get('outbox_id')
+    if outbox_id is not None:
+        get_redis().delete(PROCESSED_KEY.format(id=outbox_id))
+
+
+class OutboxTask(Task):
+    """
+    Задача Celery, которая выполняется один раз для сообщения outbox
+    (outbox_id передается в заголовке)
+    """
+
+    def __call__(self, *args, **kwargs):
+        # заголовки сообщения - атрибуты запроса (при apply - в headers)
+        headers = self.request.headers or {}
+        payload = {'outbox_id': getattr(self.request, 'outbox_id',
+                                        headers.get('outbox_id'))}
+        if not claim(payload):
+            return None
+        try:
+            return super().__call__(*args, **kwargs)
+        except BaseException:
+            # ошибка или повтор (self.retry): задачу можно выполнить снова
+            release(payload)
+            raise
+
+
+def _publish_tasks(payloads):
+    for payload in payloads:
+        current_app.send_task(payload['task'], args=payload['args'],
+                              kwargs=payload['kwargs'],
+                              headers={'outbox_id': payload['outbox_id']})
+
+
+def _handlers():
+    from . import mail
+
+    return {
+        'task': _publish_tasks,
+        'email': mail.push_emails,
+        'admin_digest': mail.push_digest,
+    }
+
+
+def relay(batch_size=None):
+    """
+    Опубликовать пакет сообщений.
+    :return: количество опубликованных сообщений
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    handlers = _handlers()
+    with transaction.atomic():
+        messages = list(OutboxMessage.objects.select_for_update(
+            skip_locked=True
+        ).order_by('id')[:batch_size])
+        if not messages:
+            return 0
+
+        payloads = defaultdict(list)
+        for message in messages:
+            payloads[message.topic].append({**message.payload,
+                                            'outbox_id': message.id})
+        for topic, topic_payloads in payloads.items():
+            handlers[topic](topic_payloads)
+
+        OutboxMessage.objects.filter(
+            id__in=[message.id for message in messages]
+        ).delete()
+    return len(messages)
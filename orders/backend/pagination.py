@@ -0,0 +1,97 @@
+import json
+
+from django.conf import settings
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+
+class OrderCursorPagination(CursorPagination):
+    """
+    Постраничный вывод заказов по ключу (дата создания) без OFFSET:
+    каждая страница - индексированный запрос с условием на dt
+    """
+    ordering = '-dt'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class OrderChangesCursor:
+    """
+    Непрозрачный курсор ленты изменений заказов: подписанный номер
+    последнего полученного изменения
+    """
+    salt = 'backend.order-changes'
+
+    @classmethod
+    def encode(cls, seq):
+        # без метки времени: курсор одного изменения всегда одинаков
+        return signing.Signer(salt=cls.salt).sign_object(seq)
+
+    @classmethod
+    def decode(cls, cursor):
+        """
+        Номер изменения из курсора (0 - без курсора).
+        Вызывает ValueError для неверного курсора.
+        """
+        if not cursor:
+            return 0
+        try:
+            seq = signing.Signer(salt=cls.salt).unsign_object(cursor)
+        except signing.BadSignature:
+            try:
+                # курсоры, выданные до отказа от метки времени
+                seq = signing.loads(cursor, salt=cls.salt)
+            except signing.BadSignature:
+                raise ValueError('Неверный курсор')
+        if not isinstance(seq, int):
+            raise ValueError('Неверный курсор')
+        return seq
+
+
+def estimated_count(queryset):
+    """
+    Оценка количества строк запроса по статистике Postgres без COUNT(*):
+    для запроса без условий - reltuples таблицы, иначе - оценка
+    планировщика (EXPLAIN). None, если оценка недоступна.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        if not queryset.query.where and not queryset.query.distinct:
+            cursor.execute('SELECT reltuples FROM pg_class '
+                           'WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            # -1 - таблица еще не анализировалась
+            if row is None or row[0] < 0:
+                return None
+            return int(row[0])
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator для списков администратора по большим таблицам:
+    количество объектов оценивается по статистике Postgres,
+    точный COUNT(*) выполняется, только если оценка меньше
+    ADMIN_EXACT_COUNT_LIMIT
+    """
+
+    @cached_property
+    def count(self):
+        estimate = None
+        if hasattr(self.object_list, 'query'):
+            estimate = estimated_count(self.object_list)
+        if estimate is None or estimate < settings.ADMIN_EXACT_COUNT_LIMIT:
+            return super().count
+        return estimate
@@ -0,0 +1,27 @@
+"""
+Бюджеты эндпоинтов для test_budgets.py.
+
+Для каждого эндпоинта данные создаются заново в каждом из масштабов
+(SCALES: количество товаров, позиций корзины и заказов; масштабы
+отличаются на порядок). Количество SQL-запросов
+не должно зависеть от масштаба и не должно превышать queries, а p95
+времени ответа при масштабе LATENCY_SCALE (REPEAT запросов) - p95_ms:
+каталог и корзина отдаются без пагинации, и время ответа при тысяче
+позиций растет вместе с объемом ответа.
+Изменение бюджета - отдельное решение при ревью.
+"""
+
+SCALES = (10, 100, 1000)
+LATENCY_SCALE = 100
+REPEAT = 20
+
+BUDGETS = {
+    'products': {'path': 'products/', 'user': None,
+                 'queries': 4, 'p95_ms': 250},
+    'basket': {'path': 'basket/', 'user': 'buyer',
+               'queries': 9, 'p95_ms': 250},
+    'order': {'path': 'order/', 'user': 'buyer',
+              'queries': 9, 'p95_ms': 250},
+    'partner_orders': {'path': 'partner/orders/', 'user': 'partner',
+                       'queries': 4, 'p95_ms': 250},
+}
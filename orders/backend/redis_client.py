@@ -0,0 +1,12 @@
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    """
+    Общее подключение к Redis (пул соединений на процесс)
+    """
+    return redis.Redis.from_url(settings.REDIS_URL)
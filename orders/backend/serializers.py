@@ -1,13 +1,23 @@
-from django.db.models import Sum, F
+from collections import defaultdict
+from functools import cached_property
+
 from drf_spectacular.utils import extend_schema_serializer
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
+from .checkout import shop_delivery
+from .middleware import TimedSerializerMixin
 from .models import User, Shop, Product, ProductParameter, \
-    ProductInfo, OrderItem, Order, Category, Address, Delivery
+    ProductInfo, OrderItem, Order, Category, Address, Delivery, OrderShop
+
+
+class ModelSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """
+    ModelSerializer с замером времени для PerformanceMiddleware
+    """
 
 
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(ModelSerializer):
     def __init__(self, *args, **kwargs):
         # Don't pass the 'user_id' arg up to the superclass
         user_id = kwargs.pop('user_id', None)
@@ -41,7 +51,7 @@ class AddressSerializer(serializers.ModelSerializer):
 
 
 @extend_schema_serializer(exclude_fields=['is_active'])
-class PartnerSerializer(serializers.ModelSerializer):
+class PartnerSerializer(ModelSerializer):
     is_active = serializers.BooleanField(default=False)
     type = serializers.CharField(default='shop', write_only=True)
     address = AddressSerializer(read_only=True, many=True)
@@ -55,7 +65,7 @@ class PartnerSerializer(serializers.ModelSerializer):
 
 
 @extend_schema_serializer(exclude_fields=['address'])
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ModelSerializer):
     address = AddressSerializer(read_only=True, many=True)
 
     class Meta:
@@ -65,7 +75,7 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id']
 
 
-class UserWithPasswordSerializer(serializers.ModelSerializer):
+class UserWithPasswordSerializer(ModelSerializer):
     password = serializers.CharField(required=True)
 
     class Meta:
@@ -77,7 +87,7 @@ class UserWithPasswordSerializer(serializers.ModelSerializer):
 @extend_schema_serializer(
     exclude_fields=['shop'],
 )
-class DeliverySerializer(serializers.ModelSerializer):
+class DeliverySerializer(ModelSerializer):
 
     class Meta:
         model = Delivery
@@ -87,13 +97,13 @@ class DeliverySerializer(serializers.ModelSerializer):
         }
 
 
-class ShopStateSerializer(serializers.ModelSerializer):
+class ShopStateSerializer(ModelSerializer):
     class Meta:
         model = Shop
         fields = ['id', 'name', 'state']
 
 
-class ShopSerializer(serializers.ModelSerializer):
+class ShopSerializer(ModelSerializer):
     delivery = DeliverySerializer(read_only=True, many=True)
 
     class Meta:
@@ -109,7 +119,7 @@ class ShopSerializer(serializers.ModelSerializer):
         }
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(ModelSerializer):
     category = serializers.StringRelatedField()
 
     class Meta:
@@ -117,7 +127,7 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ['name', 'category', ]
 
 
-class ProductParameterSerializer(serializers.ModelSerializer):
+class ProductParameterSerializer(ModelSerializer):
     parameter = serializers.StringRelatedField()
 
     class Meta:
@@ -125,7 +135,7 @@ class ProductParameterSerializer(serializers.ModelSerializer):
         fields = ['parameter', 'value', ]
 
 
-class ProductInfoSerializer(serializers.ModelSerializer):
+class ProductInfoSerializer(ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_parameters = ProductParameterSerializer(read_only=True, many=True)
     shop = ShopSerializer(read_only=True)
@@ -146,7 +156,7 @@ class OrderProductInfoSerializer(ProductInfoSerializer):
 
 
 @extend_schema_serializer(exclude_fields=['order'])
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(ModelSerializer):
     class Meta:
         model = OrderItem
         fields = ['id', 'quantity', 'product_info', 'order', ]
@@ -160,37 +170,70 @@ class ShopOrderItemSerializer(OrderItemSerializer):
     product_info = OrderProductInfoSerializer(read_only=True)
 
 
-class ShopOrderSerializer(serializers.ModelSerializer):
-    def __init__(self, *args, **kwargs):
-        # Don't pass the 'order_id' arg up to the superclass
-        order_id = kwargs.pop('order_id', None)
-
-        # Instantiate the superclass normally
-        super().__init__(*args, **kwargs)
-
-        self.order_id = order_id
-
-    shop_sum = serializers.IntegerField()
+class BasketSerializer(ModelSerializer):
+    total_sum = serializers.IntegerField(source='basket_sum')
+    address = AddressSerializer(read_only=True)
 
     class Meta:
-        model = Shop
-        fields = ['id', 'name', 'shop_sum', ]
+        model = Order
+        fields = ['id', 'state', 'dt', 'total_sum', 'address']
         read_only_fields = ['id']
 
+    @cached_property
+    def _items_serializer(self):
+        # один сериализатор позиций на все магазины корзины
+        return ShopOrderItemSerializer(many=True)
+
     def to_representation(self, instance):
         ret = super().to_representation(instance)
-        if self.order_id is not None:
-            ordered_items = OrderItem.objects.filter(
-                product_info__shop=instance.id, order=self.order_id
-            )
-            ret['ordered_items'] = [ShopOrderItemSerializer(item).data
-                                    for item in ordered_items]
+        # позиции с товарами и стоимости доставки магазинов загружены
+        # через prefetch_related (см. BasketView.get)
+        shops, shop_items = {}, defaultdict(list)
+        for item in instance.ordered_items.all():
+            shop = item.product_info.shop
+            shops[shop.id] = shop
+            shop_items[shop.id].append(item)
+
+        delivery_costs = []
+        invalid_deliveries = []
+        ret['shops'] = []
+        for shop in sorted(shops.values(), key=lambda shop: shop.name,
+                           reverse=True):
+            items = shop_items[shop.id]
+            shop_sum = sum(item.quantity * item.product_info.price
+                           for item in items)
+            delivery = shop_delivery(shop, shop_sum)
+            if isinstance(delivery, str):
+                invalid_deliveries.append(delivery)
+            else:
+                delivery_costs.append(delivery)
+            ret['shops'].append({
+                'id': shop.id, 'name': shop.name, 'shop_sum': shop_sum,
+                'ordered_items': self._items_serializer.to_representation(
+                    items
+                ),
+                'delivery': delivery,
+            })
+
+        if invalid_deliveries:
+            ret['total_delivery'] = invalid_deliveries
+        else:
+            ret['total_delivery'] = sum(delivery_costs)
 
         return ret
 
 
-class OrderSerializer(serializers.ModelSerializer):
-    total_sum = serializers.IntegerField()
+class OrderedItemSerializer(ShopOrderItemSerializer):
+    class Meta(ShopOrderItemSerializer.Meta):
+        fields = ['id', 'quantity', 'price', 'product_info', 'order', ]
+
+
+class OrderSerializer(ModelSerializer):
+    """
+    Оформленный заказ с суммами, зафиксированными при оформлении.
+    Позиции (ordered_items) и суммы по магазинам (order_shops)
+    должны быть загружены через prefetch_related.
+    """
     address = AddressSerializer(read_only=True)
 
     class Meta:
@@ -198,77 +241,71 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = ['id', 'state', 'dt', 'total_sum', 'address']
         read_only_fields = ['id']
 
+    @cached_property
+    def _items_serializer(self):
+        # один сериализатор позиций на все заказы списка:
+        # поля строятся один раз, а не для каждого заказа и магазина
+        return OrderedItemSerializer(many=True)
+
     def to_representation(self, instance):
         ret = super().to_representation(instance)
-        delivery_costs = []
-        invalid_deliveries = []
-        shops = Shop.objects.filter(
-            product_infos__ordered_items__order=instance.id
-        ).annotate(
-            shop_sum=Sum(F('product_infos__ordered_items__quantity')
-                         * F('product_infos__price'))
-        ).distinct()
-        ret['shops'] = []
-        for shop in shops:
-            shop_data = ShopOrderSerializer(shop, order_id=instance.id).data
-            shop_deliveries = Delivery.objects.filter(shop=shop)
-            if shop_deliveries:
-                shop_delivery = shop_deliveries.filter(
-                    min_sum__lte=shop_data['shop_sum']
-                ).order_by('-min_sum').first()
-                if shop_delivery is None:
-                    shop_data['delivery'] = (f"{shop_data['name']}: "
-                                             f"сумма заказа меньше минимальной.")
-                    invalid_deliveries.append(shop_data['delivery'])
-                else:
-                    shop_data['delivery'] = shop_delivery.cost
-                    delivery_costs.append(shop_data['delivery'])
-            else:
-                shop_data['delivery'] = (f"{shop_data['name']}: "
-                                         f"стоимость доставки недоступна.")
-                invalid_deliveries.append(shop_data['delivery'])
-            ret['shops'].append(shop_data)
-
-        if invalid_deliveries:
-            ret['total_delivery'] = invalid_deliveries
-        else:
-            ret['total_delivery'] = sum(delivery_costs)
+        shop_items = defaultdict(list)
+        for item in instance.ordered_items.all():
+            shop_items[item.product_info.shop_id].append(item)
+        ret['shops'] = [
+            {'id': order_shop.shop_id, 'name': order_shop.shop.name,
+             'shop_sum': order_shop.shop_sum,
+             'ordered_items': self._items_serializer.to_representation(
+                 shop_items[order_shop.shop_id]
+             ),
+             'delivery': order_shop.delivery}
+            for order_shop in instance.order_shops.all()
+        ]
+        ret['total_delivery'] = instance.total_delivery
 
         return ret
 
 
-class PartnerOrderSerializer(serializers.ModelSerializer):
+class PartnerOrderSerializer(ModelSerializer):
+    """
+    Заказ в магазине поставщика (по записи OrderShop).
+    Позиции всех заказов страницы загружаются одним запросом
+    и передаются словарем {id заказа: [позиции]}.
+    """
     def __init__(self, *args, **kwargs):
-        # Don't pass the 'partner_id' arg up to the superclass
-        partner_id = kwargs.pop('partner_id', None)
+        # Don't pass the 'ordered_items' arg up to the superclass
+        ordered_items = kwargs.pop('ordered_items', None)
 
         # Instantiate the superclass normally
         super().__init__(*args, **kwargs)
 
-        self.partner_id = partner_id
+        self.ordered_items = ordered_items
 
-    total_sum = serializers.IntegerField()
-    address = AddressSerializer(read_only=True)
+    id = serializers.IntegerField(source='order_id')
+    state = serializers.CharField(source='order.state')
+    # сумма заказа по магазину поставщика
+    total_sum = serializers.IntegerField(source='shop_sum')
+    address = AddressSerializer(source='order.address', read_only=True)
 
     class Meta:
-        model = Order
-        fields = ['id', 'state', 'dt', 'total_sum', 'address']
-        read_only_fields = ['id']
+        model = OrderShop
+        fields = ['id', 'state', 'dt', 'total_sum', 'items_count', 'address']
+
+    @cached_property
+    def _items_serializer(self):
+        return OrderedItemSerializer(many=True)
 
     def to_representation(self, instance):
         ret = super().to_representation(instance)
-        if self.partner_id is not None:
-            ordered_items = OrderItem.objects.filter(
-                product_info__shop__user_id=self.partner_id, order=instance.id
-            ).distinct()
-            ret['ordered_items'] = [
-                ShopOrderItemSerializer(item).data for item in ordered_items
-            ]
+        if self.ordered_items is not None:
+            ret['ordered_items'] = self._items_serializer.to_representation(
+                self.ordered_items.get(instance.order_id, [])
+            )
 
         return ret
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(ModelSerializer):
     class Meta:
         model = Category
         fields = ['id', 'name', ]
@@ -1,7 +1,19 @@
+import time
+
+from celery.signals import (before_task_publish, task_failure,
+                            task_postrun, task_prerun, task_retry)
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django_rest_passwordreset.signals import reset_password_token_created
+from rest_framework.authtoken.models import Token
 
-from .tasks import send_email_task
+from .authentication import invalidate_tokens
+from .mail import enqueue_email
+from .metrics import increment, observe
+from .models import User
+from .slow_queries import origin, slow_query_hook
 
 
 @receiver(reset_password_token_created)
@@ -17,7 +29,7 @@ def password_reset_token_created(sender, instance, reset_password_token, **kwarg
     """
     # send an e-mail to the user
 
-    send_email_task.delay(
+    enqueue_email(
         # title:
         f"Password Reset Token for {reset_password_token.user}",
         # message:
@@ -25,3 +37,96 @@ def password_reset_token_created(sender, instance, reset_password_token, **kwarg
         # to:
         [reset_password_token.user.email]
     )
+
+
+@before_task_publish.connect
+def add_publish_time(headers=None, **kwargs):
+    """
+    Время постановки задачи в очередь (для метрики ожидания в очереди)
+    """
+    headers.setdefault('published_at', time.time())
+
+
+@task_prerun.connect
+def record_queue_latency(task=None, **kwargs):
+    """
+    Время ожидания задачи в очереди до начала выполнения
+    """
+    task.request.started_at = time.perf_counter()
+    task.request.origin_token = origin.set(f'task {task.name}')
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is None:
+        return
+    delivery_info = task.request.delivery_info or {}
+    observe('celery_queue_latency_seconds', time.time() - published_at,
+            queue=delivery_info.get('routing_key') or 'default',
+            task=task.name)
+
+
+@task_postrun.connect
+def record_task_duration(task=None, state=None, **kwargs):
+    """
+    Время выполнения задачи (state - итоговый статус: SUCCESS, FAILURE,
+    RETRY)
+    """
+    origin_token = getattr(task.request, 'origin_token', None)
+    if origin_token is not None:
+        origin.reset(origin_token)
+    started_at = getattr(task.request, 'started_at', None)
+    if started_at is None:
+        return
+    observe('celery_task_duration_seconds', time.perf_counter() - started_at,
+            task=task.name, state=state or 'UNKNOWN')
+
+
+@task_retry.connect
+def count_task_retry(sender=None, **kwargs):
+    """
+    Повторные запуски задач
+    """
+    increment('celery_task_retries', task=sender.name)
+
+
+@task_failure.connect
+def count_task_failure(sender=None, exception=None, **kwargs):
+    """
+    Задачи, завершившиеся ошибкой
+    """
+    increment('celery_task_failures', task=sender.name,
+              exception=type(exception).__name__)
+
+
+@receiver([post_save, post_delete], sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    """
+    Выход, удаление или замена токена
+    """
+    # после удаления первичный ключ (key) у объекта сбрасывается
+    key = instance.key
+    transaction.on_commit(lambda: invalidate_tokens(key))
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    """
+    Изменение пользователя (пароль, is_active и др.)
+    """
+    if created:
+        return
+    keys = list(Token.objects.filter(
+        user_id=instance.id
+    ).values_list('key', flat=True))
+    transaction.on_commit(lambda: invalidate_tokens(*keys))
+
+
+@receiver(connection_created)
+def add_slow_query_hook(sender, connection, **kwargs):
+    """
+    Запись медленных запросов для всех соединений с базой
+    """
+    # обертки сохраняются у объекта соединения при переподключении;
+    # соединение может открыться внутри connection.execute_wrapper
+    # (PerformanceMiddleware), который при выходе удаляет последнюю
+    # обертку, поэтому запись добавляется первой
+    if slow_query_hook not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, slow_query_hook)
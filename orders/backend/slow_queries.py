@@ -0,0 +1,148 @@
+"""
+Запись медленных SQL-запросов с планами выполнения.
+
+Обертка slow_query_hook добавляется к каждому новому соединению с базой
+(сигнал connection_created, см. signals.py). Запрос дольше
+SLOW_QUERY_THRESHOLD_MS записывается (с вероятностью SLOW_QUERY_SAMPLE_RATE
+и не больше SLOW_QUERY_MAX_PER_MINUTE записей в минуту на все процессы)
+в кольцевой буфер в Redis из SLOW_QUERY_BUFFER_SIZE записей: текст запроса
+без параметров, представление или задача Celery, место вызова в коде
+и план EXPLAIN (ANALYZE, BUFFERS). Для плана запрос выполняется повторно,
+поэтому план строится только для SELECT и в точке сохранения (ошибка
+не прерывает транзакцию). Буфер доступен в админке (admin/slow-queries/).
+
+Значения параметров в буфер не попадают: в условиях плана (Filter,
+Index Cond и др.) строки и числа заменяются на ?, от ошибки построения
+плана сохраняется только тип.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+import traceback
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import transaction
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+BUFFER_KEY = 'slow_queries'
+RATE_KEY = 'slow_queries:rate:{minute}'
+
+# представление или задача, выполняющие запросы
+# (задается PerformanceMiddleware и обработчиком task_prerun)
+origin = ContextVar('slow_query_origin', default=None)
+
+_local = threading.local()
+
+# строки условий плана и литералы в них
+PLAN_CONDITION = re.compile(
+    r'^(\s*(?:Index |Recheck |Hash |Merge |Join |One-Time )?'
+    r'(?:Cond|Filter): )(.*)$'
+)
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def _caller():
+    """
+    Ближайшие к запросу кадры стека из кода проекта
+    """
+    frames = [frame for frame in traceback.extract_stack()
+              if frame.filename.startswith(settings.BASE_DIR)
+              and 'site-packages' not in frame.filename
+              and not frame.filename.endswith('slow_queries.py')]
+    return [f'{frame.filename[len(settings.BASE_DIR) + 1:]}:{frame.lineno} '
+            f'in {frame.name}' for frame in frames[-3:]]
+
+
+def _allowed():
+    if random.random() >= settings.SLOW_QUERY_SAMPLE_RATE:
+        return False
+    key = RATE_KEY.format(minute=int(time.time() // 60))
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.incr(key)
+    pipe.expire(key, 60)
+    count, _ = pipe.execute()
+    return count <= settings.SLOW_QUERY_MAX_PER_MINUTE
+
+
+def _mask_plan(plan):
+    """
+    План без значений параметров запроса в условиях
+    """
+    lines = []
+    for line in plan.splitlines():
+        match = PLAN_CONDITION.match(line)
+        if match:
+            line = match.group(1) + LITERAL.sub('?', match.group(2))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _explain(connection, sql, params):
+    if not sql.lstrip()[:6].upper() == 'SELECT':
+        return None
+    try:
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {sql}', params)
+                return _mask_plan('\n'.join(row[0]
+                                           for row in cursor.fetchall()))
+    except Exception as e:
+        # текст ошибки может содержать значения параметров
+        return f'Не удалось получить план: {type(e).__name__}'
+
+
+def record(connection, sql, params, duration):
+    """
+    Записать медленный запрос в буфер
+    """
+    _local.recording = True
+    try:
+        if not _allowed():
+            return
+        entry = {
+            'time': time.time(),
+            'duration_ms': round(duration * 1000, 1),
+            'sql': sql,
+            'origin': origin.get(),
+            'caller': _caller(),
+            'plan': _explain(connection, sql, params),
+        }
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.lpush(BUFFER_KEY, json.dumps(entry, ensure_ascii=False))
+        pipe.ltrim(BUFFER_KEY, 0, settings.SLOW_QUERY_BUFFER_SIZE - 1)
+        pipe.execute()
+    except Exception:
+        logger.exception('Не удалось записать медленный запрос')
+    finally:
+        _local.recording = False
+
+
+def slow_query_hook(execute, sql, params, many, context):
+    """
+    Обертка выполнения запросов (connection.execute_wrapper)
+    """
+    threshold = settings.SLOW_QUERY_THRESHOLD_MS
+    if not threshold or many or getattr(_local, 'recording', False):
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    result = execute(sql, params, many, context)
+    duration = time.perf_counter() - start
+    if duration * 1000 >= threshold:
+        record(context['connection'], sql, params, duration)
+    return result
+
+
+def recent(limit=None):
+    """
+    Последние медленные запросы (сначала новые)
+    """
+    limit = limit or settings.SLOW_QUERY_BUFFER_SIZE
+    return [json.loads(entry)
+            for entry in get_redis().lrange(BUFFER_KEY, 0, limit - 1)]
@@ -1,21 +1,72 @@
+import time
+
 from celery import shared_task
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.utils import timezone
 
+from .basket import get_basket_store
+from .cleanup import purge_expired_tokens
+from .mail import push_emails, send_admin_digest, send_queued
+from .metrics import increment, observe
 from .models import Category, ProductInfo, Product, Parameter, \
-    ProductParameter, Shop
+    ProductParameter, Shop, ImportRun, OrderItem
+from .outbox import OutboxTask
 
 
 @shared_task()
 def send_email_task(title, message, addressee_list,
                     sender=settings.EMAIL_HOST_USER):
-    # send an e-mail to the user
-    msg = EmailMultiAlternatives(title, message, sender, addressee_list)
-    msg.send()
+    # письма отправляются пакетами из очереди (задачи, поставленные
+    # до появления очереди, переносят письмо в нее)
+    push_emails([{'title': title, 'message': message, 'to': addressee_list,
+                  'from': sender, 'attempts': 0}])
+
+
+@shared_task()
+def send_queued_emails_task():
+    # отправляем письма из очереди через одно соединение
+    result = send_queued()
+    for outcome in ('sent', 'failed', 'retry'):
+        if result[outcome]:
+            increment('emails', result[outcome], outcome=outcome)
+    return result
 
 
 @shared_task()
-def do_import_task(shop_id, data):
+def send_admin_digest_task():
+    # отправляем администратору сводку накопленных уведомлений
+    return send_admin_digest()
+
+
+@shared_task(base=OutboxTask)
+def do_import_task(shop_id, data, run_id=None):
+    # ход загрузки записывается в ImportRun (см. ShopAdmin.make_uptodate_view)
+    runs = (ImportRun.objects.filter(id=run_id) if run_id
+            else ImportRun.objects.none())
+    runs.update(state='running', started_at=timezone.now(),
+                goods_total=len(data['goods']))
+    start = time.perf_counter()
+    try:
+        written, deleted = _import_price_list(shop_id, data, runs)
+    except Exception as e:
+        runs.update(state='failed', error=repr(e),
+                    write_seconds=time.perf_counter() - start,
+                    finished_at=timezone.now())
+        raise
+    seconds = time.perf_counter() - start
+    runs.update(state='done', goods_written=written, rows_deleted=deleted,
+                write_seconds=seconds, finished_at=timezone.now())
+    if seconds:
+        observe('import_goods_per_second', written / seconds, shop=shop_id)
+
+
+def _import_price_list(shop_id, data, runs):
+    """
+    Записать прайс-лист магазина: позиции обновляются по внешнему ИД,
+    позиции, которых нет в прайс-листе, удаляются, а уже заказанные
+    остаются в истории заказов с нулевым остатком.
+    :return: количество записанных товаров и удаленных позиций
+    """
     # TODO select_related and prefetch_related?
     shop = Shop.objects.get(id=shop_id)
 
@@ -26,21 +77,30 @@ def do_import_task(shop_id, data):
         )
         category_object.shops.add(shop.id)
         category_object.save()
-    ProductInfo.objects.filter(shop_id=shop.id).delete()
-    for item in data['goods']:
+    existing = {product_info.external_id: product_info for product_info
+                in ProductInfo.objects.filter(shop_id=shop.id)}
+    for written, item in enumerate(data['goods'], 1):
         product, _ = Product.objects.get_or_create(
             name=item['name'], category_id=item['category']
         )
 
-        product_info = ProductInfo.objects.create(
-            product_id=product.id,
-            external_id=item['id'],
-            model=item['model'],
-            price=item['price'],
-            price_rrc=item['price_rrc'],
-            quantity=item['quantity'],
-            shop_id=shop.id
-        )
+        fields = {
+            'product_id': product.id,
+            'model': item['model'],
+            'price': item['price'],
+            'price_rrc': item['price_rrc'],
+            'quantity': item['quantity'],
+        }
+        product_info = existing.pop(item['id'], None)
+        if product_info is None:
+            product_info = ProductInfo.objects.create(
+                external_id=item['id'], shop_id=shop.id, **fields
+            )
+        else:
+            for name, value in fields.items():
+                setattr(product_info, name, value)
+            product_info.save()
+            product_info.product_parameters.all().delete()
         for name, value in item['parameters'].items():
             parameter_object, _ = Parameter.objects.get_or_create(
                 name=name
@@ -50,9 +110,36 @@ def do_import_task(shop_id, data):
                 parameter_id=parameter_object.id,
                 value=value
             )
+        if written % settings.IMPORT_PROGRESS_EVERY == 0:
+            runs.update(goods_written=written)
+
+    # удаление позиции удалило бы ее из оформленных заказов
+    removed = ProductInfo.objects.filter(
+        id__in=[product_info.id for product_info in existing.values()]
+    )
+    ordered = OrderItem.objects.filter(
+        product_info__in=removed
+    ).exclude(order__state='basket').values('product_info_id')
+    removed.filter(id__in=ordered).update(quantity=0)
+    _, deleted = removed.exclude(id__in=ordered).delete()
+    deleted = deleted.get(ProductInfo._meta.label, 0)
+    runs.update(rows_deleted=deleted)
 
     shop.name = data['shop']
     shop.is_uptodate = True
     shop.save()
+    return len(data['goods']), deleted
 
 
+@shared_task()
+def flush_baskets_task():
+    # переносим измененные корзины из Redis в базу
+    basket_store = get_basket_store()
+    if basket_store is not None:
+        return basket_store.flush_dirty()
+
+
+@shared_task()
+def purge_expired_tokens_task():
+    # удаляем устаревшие токены подтверждения почты и сброса пароля
+    return purge_expired_tokens()
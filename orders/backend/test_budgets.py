@@ -0,0 +1,112 @@
+import time
+
+import pytest
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from .models import (User, Shop, Category, Product, ProductInfo, Parameter,
+                     ProductParameter, Order, OrderItem, OrderShop, Address,
+                     Delivery)
+from .perf_budgets import BUDGETS, LATENCY_SCALE, REPEAT, SCALES
+from .tests import full_path
+
+
+def seed(scale):
+    """
+    Поставщик с scale товарами, покупатель с корзиной из scale позиций
+    и scale оформленными заказами (оформление повторяет place_order
+    без резервирования, чтобы наибольший масштаб создавался быстро)
+    """
+    partner = User.objects.create_user('partner@example.com',
+                                       'lkajdhfkljdshf', type='shop')
+    shop = Shop.objects.create(name='Магазин', user=partner)
+    Delivery.objects.create(shop=shop, min_sum=0, cost=300)
+    category = Category.objects.create(name='Категория')
+    parameters = [Parameter.objects.get_or_create(name=name)[0]
+                  for name in ('Цвет', 'Вес')]
+    products = Product.objects.bulk_create(
+        Product(name=f'Товар {i}', category=category) for i in range(scale)
+    )
+    product_infos = ProductInfo.objects.bulk_create(
+        ProductInfo(product=product, shop=shop, external_id=i,
+                    quantity=scale * 10, price=100 + i, price_rrc=120 + i)
+        for i, product in enumerate(products)
+    )
+    ProductParameter.objects.bulk_create(
+        ProductParameter(product_info=product_info, parameter=parameter,
+                         value=i)
+        for i, product_info in enumerate(product_infos)
+        for parameter in parameters
+    )
+
+    buyer = User.objects.create_user('buyer@example.com', 'lkajdhfkljdshf')
+    address = Address.objects.create(user=buyer, city='Город',
+                                     street='Улица')
+    orders = Order.objects.bulk_create(
+        Order(user=buyer, state='new', address=address,
+              total_sum=product_info.price, total_delivery=300)
+        for product_info in product_infos
+    )
+    OrderItem.objects.bulk_create(
+        OrderItem(order=order, product_info=product_info, quantity=1,
+                  price=product_info.price)
+        for order, product_info in zip(orders, product_infos)
+    )
+    OrderShop.objects.bulk_create(
+        OrderShop(order=order, shop=shop, dt=order.dt,
+                  shop_sum=product_info.price, items_count=1, delivery=300)
+        for order, product_info in zip(orders, product_infos)
+    )
+    basket = Order.objects.create(user=buyer, state='basket')
+    OrderItem.objects.bulk_create(
+        OrderItem(order=basket, product_info=product_info, quantity=2)
+        for product_info in product_infos
+    )
+    return {'buyer': buyer, 'partner': partner, None: None}
+
+
+def get(api_client, path):
+    response = api_client.get(full_path(path))
+    assert response.status_code == status.HTTP_200_OK
+    return response
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('name', BUDGETS)
+def test_endpoint_budget(name, settings):
+    settings.BASKET_STORAGE = 'db'
+    # EXPLAIN журнала медленных запросов не входит в бюджет
+    settings.SLOW_QUERY_SAMPLE_RATE = 0
+    budget = BUDGETS[name]
+    api_client = APIClient()
+
+    counts = {}
+    for scale in SCALES:
+        # каждый масштаб создается с нуля и откатывается после замера
+        with transaction.atomic():
+            users = seed(scale)
+            api_client.force_authenticate(users[budget['user']])
+            # первый запрос прогревает кэши процесса
+            get(api_client, budget['path'])
+            with CaptureQueriesContext(connection) as queries:
+                get(api_client, budget['path'])
+            counts[scale] = len(queries)
+
+            if scale == LATENCY_SCALE:
+                durations = []
+                for _ in range(REPEAT):
+                    start = time.perf_counter()
+                    get(api_client, budget['path'])
+                    durations.append((time.perf_counter() - start) * 1000)
+            transaction.set_rollback(True)
+
+    assert len(set(counts.values())) == 1, \
+        f'{name}: количество запросов зависит от объема данных: {counts}'
+    assert counts[SCALES[-1]] <= budget['queries'], \
+        f'{name}: {counts[SCALES[-1]]} запросов, бюджет {budget["queries"]}'
+
+    p95 = sorted(durations)[int(len(durations) * 0.95) - 1]
+    assert p95 <= budget['p95_ms'], \
+        f'{name}: p95 {p95:.1f} мс, бюджет {budget["p95_ms"]} мс'
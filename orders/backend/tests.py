@@ -1,11 +1,48 @@
+import asyncio
+import json
 import os
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from smtplib import SMTPException
+from types import SimpleNamespace
 
 import pytest
+import redis
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib import admin
+from django.core import mail as django_mail
+from django.core.management import call_command
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import connection, transaction
+from django.test import AsyncClient
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.test import APIClient
-from rest_framework import status
+from rest_framework import serializers as rest_serializers, status
 from django.conf import settings
+from orders.django_celery import app as celery_app
 
-from .models import User
+from . import admin as backend_admin
+from . import (authentication, cleanup, events, mail, metrics, outbox,
+               signals, slow_queries, tasks, traffic)
+from .admin import OrderAdmin
+from .authentication import CachedTokenAuthentication, local_cache
+from .basket import get_basket_store
+from .checkout import (InsufficientStock, place_order, reserve_stock,
+                       release_stock)
+from .management.commands.generate_data import DELIVERY_TIERS
+from .models import (User, Shop, Category, Product, ProductInfo,
+                     OrderItem, Order, Address, Delivery, OutboxMessage,
+                     ConfirmEmailToken, ImportRun, ProductParameter)
+from .pagination import EstimatedCountPaginator, estimated_count
+from .redis_client import get_redis
+from .views import CategoryView
 
 PATH_PREFIX = 'http://127.0.0.1:8000/api/v1/'
 
@@ -123,3 +160,1350 @@ class TestPartner:
             )
 
         assert response.status_code == expected_status, description
+
+
+@pytest.mark.django_db
+class TestBasket:
+    @pytest.fixture
+    def api_client(self):
+        return APIClient()
+
+    @pytest.fixture
+    def buyer(self):
+        return User.objects.create_user('buyer_email@example.com',
+                                        'lkajdhfkljdshf')
+
+    @pytest.fixture
+    def product_infos(self):
+        shop = Shop.objects.create(name='Магазин')
+        category = Category.objects.create(name='Категория')
+        product = Product.objects.create(name='Товар', category=category)
+        return [ProductInfo.objects.create(product=product, shop=shop,
+                                           external_id=external_id,
+                                           quantity=10, price=100,
+                                           price_rrc=120)
+                for external_id in range(3)]
+
+    def test_add_items(self, api_client, buyer, product_infos):
+        api_client.force_authenticate(buyer)
+        items = [{'product_info': product_info.id, 'quantity': 2}
+                 for product_info in product_infos]
+
+        response = api_client.post(full_path('basket/'), {'items': items},
+                                   format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['Создано объектов'] == len(product_infos)
+        assert OrderItem.objects.filter(
+            order__user=buyer, order__state='basket'
+        ).count() == len(product_infos)
+
+    @pytest.mark.parametrize('replace, expected_quantity',
+                             [[False, 5], [True, 3], ['false', 5], ['0', 5],
+                              ['true', 3]])
+    def test_add_existing_item(self, api_client, buyer, product_infos,
+                               replace, expected_quantity):
+        api_client.force_authenticate(buyer)
+        product_info = product_infos[0]
+        api_client.post(full_path('basket/'), {
+            'items': [{'product_info': product_info.id, 'quantity': 2}]
+        }, format='json')
+
+        response = api_client.post(full_path('basket/'), {
+            'items': [{'product_info': product_info.id, 'quantity': 3}],
+            'replace': replace
+        }, format='json')
+
+        assert response.status_code == status.HTTP_200_OK, \
+            'Повторное добавление позиции'
+        assert response.json()['Обновлено объектов'] == 1
+        assert OrderItem.objects.get(
+            order__user=buyer, product_info=product_info
+        ).quantity == expected_quantity
+
+    def test_add_items_with_errors(self, api_client, buyer, product_infos):
+        api_client.force_authenticate(buyer)
+        items = [{'product_info': product_infos[0].id, 'quantity': 1},
+                 {'product_info': 0, 'quantity': 1},
+                 {'product_info': product_infos[1].id, 'quantity': 'один'}]
+
+        response = api_client.post(full_path('basket/'), {'items': items},
+                                   format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [item['Status'] for item in response.json()['items']] == \
+               [True, False, False], 'Результат по каждой позиции'
+
+    @pytest.mark.parametrize('basket_storage', ['db', 'redis'])
+    def test_add_items_limited_by_stock(self, api_client, buyer,
+                                        product_infos, settings,
+                                        basket_storage):
+        settings.BASKET_STORAGE = basket_storage
+        api_client.force_authenticate(buyer)
+        product_info = product_infos[0]
+        url = full_path('basket/')
+
+        response = api_client.post(url, {'items': [
+            {'product_info': product_info.id, 'quantity': 2 ** 40}
+        ]}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()['items'][0]['Errors'] == \
+            'Недостаточно товара на складе'
+
+        response = api_client.post(url, {'items': [
+            {'product_info': product_info.id, 'quantity': 1}
+        ], 'replace': 'maybe'}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        # при добавлении количество не превышает остаток
+        for quantity in (8, 8):
+            response = api_client.post(url, {'items': [
+                {'product_info': product_info.id, 'quantity': quantity}
+            ]}, format='json')
+            assert response.status_code == status.HTTP_200_OK
+        assert response.json()['items'][0]['quantity'] == \
+            product_info.quantity
+        if basket_storage == 'redis':
+            get_basket_store().clear(buyer.id)
+
+    def test_update_items(self, api_client, buyer, product_infos,
+                          django_assert_max_num_queries):
+        api_client.force_authenticate(buyer)
+        api_client.post(full_path('basket/'), {
+            'items': [{'product_info': product_info.id, 'quantity': 1}
+                      for product_info in product_infos]
+        }, format='json')
+        first, second, third = OrderItem.objects.filter(
+            order__user=buyer
+        ).order_by('id')
+        items = [{'id': first.id, 'quantity': 4},
+                 {'id': second.id, 'quantity': 7},
+                 {'id': third.id, 'quantity': 0},
+                 {'id': 0, 'quantity': 1}]
+
+        # аутентификация, корзина, выборка, обновление, удаление и транзакция
+        with django_assert_max_num_queries(8):
+            response = api_client.put(full_path('basket/'), {'items': items},
+                                      format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['updated'] == [first.id, second.id]
+        assert response.json()['deleted'] == [third.id]
+        assert response.json()['not_found'] == [0]
+        assert response.json()['invalid'] == []
+        assert OrderItem.objects.get(id=second.id).quantity == 7
+
+    def test_update_items_invalid(self, api_client, buyer, product_infos):
+        api_client.force_authenticate(buyer)
+        api_client.post(full_path('basket/'), {
+            'items': [{'product_info': product_infos[0].id, 'quantity': 1}]
+        }, format='json')
+        item = OrderItem.objects.get(order__user=buyer)
+        items = [{'id': str(item.id), 'quantity': 2},
+                 {'id': item.id, 'quantity': -1},
+                 {'id': item.id, 'quantity': 1.5},
+                 {'id': item.id, 'quantity': 2 ** 40},
+                 item.id]
+
+        response = api_client.put(full_path('basket/'), {'items': items},
+                                  format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()['not_found'] == []
+        assert response.json()['invalid'] == [str(item.id), item.id,
+                                              item.id, item.id, None]
+
+        items.append({'id': item.id, 'quantity': 3})
+        response = api_client.put(full_path('basket/'), {'items': items},
+                                  format='json')
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['updated'] == [item.id]
+        assert len(response.json()['invalid']) == 5
+        assert OrderItem.objects.get(id=item.id).quantity == 3
+
+    def test_redis_basket_store(self, api_client, buyer, product_infos,
+                                settings):
+        settings.BASKET_STORAGE = 'redis'
+        api_client.force_authenticate(buyer)
+        first, second, _ = product_infos
+        api_client.post(full_path('basket/'), {
+            'items': [{'product_info': first.id, 'quantity': 2},
+                      {'product_info': second.id, 'quantity': 3}]
+        }, format='json')
+
+        response = api_client.put(full_path('basket/'), {
+            'items': [{'id': first.id, 'quantity': 4},
+                      {'id': second.id, 'quantity': 0}]
+        }, format='json')
+        assert response.json()['updated'] == [first.id]
+        assert response.json()['deleted'] == [second.id]
+
+        response = api_client.get(full_path('basket/'))
+        assert response.json()[0]['total_sum'] == 4 * first.price, \
+            'Сумма корзины хранится в Redis'
+        assert not OrderItem.objects.filter(order__user=buyer).exists(), \
+            'До переноса корзина хранится только в Redis'
+
+        basket_store = get_basket_store()
+        assert basket_store.flush_dirty() >= 1
+        basket_item = OrderItem.objects.get(order__user=buyer,
+                                            order__state='basket')
+        assert (basket_item.product_info_id, basket_item.quantity) == \
+               (first.id, 4)
+        basket_store.clear(buyer.id)
+
+
+@pytest.mark.django_db
+class TestCheckout:
+    STOCK = 5
+
+    @pytest.fixture
+    def api_client(self):
+        return APIClient()
+
+    @pytest.fixture
+    def product_info(self):
+        shop = Shop.objects.create(name='Магазин')
+        Delivery.objects.create(shop=shop, min_sum=0, cost=300)
+        category = Category.objects.create(name='Категория')
+        product = Product.objects.create(name='Товар', category=category)
+        return ProductInfo.objects.create(product=product, shop=shop,
+                                          external_id=1, quantity=self.STOCK,
+                                          price=100, price_rrc=120)
+
+    @staticmethod
+    def make_basket(email, product_info, quantity):
+        buyer = User.objects.create_user(email, 'lkajdhfkljdshf')
+        address = Address.objects.create(user=buyer, city='Город',
+                                         street='Улица')
+        basket = Order.objects.create(user=buyer, state='basket')
+        OrderItem.objects.create(order=basket, product_info=product_info,
+                                 quantity=quantity)
+        return buyer, address, basket
+
+    @pytest.mark.parametrize('quantity, expected_status, expected_stock', [
+        [2, status.HTTP_200_OK, STOCK - 2],
+        [STOCK + 1, status.HTTP_400_BAD_REQUEST, STOCK],
+    ])
+    def test_checkout_reserves_stock(self, api_client, product_info,
+                                     quantity, expected_status,
+                                     expected_stock):
+        buyer, address, _ = self.make_basket('buyer_email@example.com',
+                                             product_info, quantity)
+        api_client.force_authenticate(buyer)
+
+        response = api_client.post(full_path('order/'),
+                                   {'address_id': address.id}, format='json')
+
+        assert response.status_code == expected_status
+        product_info.refresh_from_db()
+        assert product_info.quantity == expected_stock
+
+    def test_release_stock(self, product_info):
+        _, _, basket = self.make_basket('buyer_email@example.com',
+                                        product_info, 2)
+        reserve_stock(basket.id)
+
+        release_stock(basket.id)
+
+        product_info.refresh_from_db()
+        assert product_info.quantity == self.STOCK
+
+    def test_admin_cancel_releases_stock_once(self, product_info):
+        _, address, basket = self.make_basket('buyer_email@example.com',
+                                              product_info, 2)
+        place_order(basket, address.id)
+        order_admin = OrderAdmin(Order, admin.site)
+        form = SimpleNamespace(changed_data=['state'])
+
+        # две отмены по экземплярам, загруженным до первой из них
+        first, second = (Order.objects.get(id=basket.id) for _ in range(2))
+        for order in (first, second):
+            order.state = 'canceled'
+            order_admin.save_model(None, order, form, True)
+
+        product_info.refresh_from_db()
+        assert product_info.quantity == self.STOCK
+        assert Order.objects.get(id=basket.id).stock_reserved is False
+
+    @pytest.mark.django_db(transaction=True)
+    def test_no_oversell_under_concurrency(self, product_info):
+        baskets = [self.make_basket(f'buyer_{i}@example.com',
+                                    product_info, 1)[2]
+                   for i in range(self.STOCK * 4)]
+        results = []
+
+        def checkout(order_id):
+            try:
+                reserve_stock(order_id)
+            except InsufficientStock:
+                results.append(False)
+            else:
+                results.append(True)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=len(baskets)) as executor:
+            executor.map(checkout, [basket.id for basket in baskets])
+
+        product_info.refresh_from_db()
+        assert results.count(True) == self.STOCK, \
+            'Зарезервировано не больше, чем есть на складе'
+        assert product_info.quantity == 0
+
+    @pytest.mark.django_db(transaction=True)
+    def test_overlapping_baskets_under_concurrency(self, product_info):
+        product_infos = [product_info] + [
+            ProductInfo.objects.create(
+                product=product_info.product, shop=product_info.shop,
+                external_id=external_id, quantity=self.STOCK, price=100,
+                price_rrc=120
+            ) for external_id in (2, 3)
+        ]
+        # корзины с парами общих товаров, позиции добавлены
+        # в разном порядке
+        baskets = {}
+        for i in range(self.STOCK * 4):
+            first, second = product_infos[i % 3], product_infos[(i + 1) % 3]
+            basket = self.make_basket(f'buyer_{i}@example.com', first, 1)[2]
+            OrderItem.objects.create(order=basket, product_info=second,
+                                     quantity=1)
+            baskets[basket.id] = {first.id, second.id}
+        results = {}
+
+        def checkout(order_id):
+            try:
+                reserve_stock(order_id)
+            except InsufficientStock:
+                results[order_id] = False
+            else:
+                results[order_id] = True
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=len(baskets)) as executor:
+            # исключения, кроме нехватки товара (например, взаимная
+            # блокировка), передаются в тест
+            list(executor.map(checkout, baskets))
+
+        assert len(results) == len(baskets)
+        for product_info in product_infos:
+            product_info.refresh_from_db()
+            reserved = sum(1 for order_id, ok in results.items()
+                           if ok and product_info.id in baskets[order_id])
+            assert reserved == self.STOCK - product_info.quantity
+            assert product_info.quantity >= 0
+
+    def test_order_totals_are_fixed_at_checkout(self, api_client,
+                                                product_info):
+        buyer, address, _ = self.make_basket('buyer_email@example.com',
+                                             product_info, 2)
+        api_client.force_authenticate(buyer)
+        api_client.post(full_path('order/'), {'address_id': address.id},
+                        format='json')
+        product_info.price = 1000
+        product_info.save()
+
+        response = api_client.get(full_path('order/'))
+
+        order_data = response.json()['results'][0]
+        assert order_data['total_sum'] == 200, 'Сумма по ценам на момент заказа'
+        assert order_data['total_delivery'] == 300
+        assert order_data['shops'][0]['ordered_items'][0]['price'] == 100
+
+    def test_price_list_import_keeps_order_history(self, api_client,
+                                                   product_info):
+        buyer, address, _ = self.make_basket('buyer_email@example.com',
+                                             product_info, 2)
+        api_client.force_authenticate(buyer)
+        api_client.post(full_path('order/'), {'address_id': address.id},
+                        format='json')
+        # позиция только в корзине другого покупателя
+        in_basket = ProductInfo.objects.create(
+            product=product_info.product, shop=product_info.shop,
+            external_id=2, quantity=1, price=50, price_rrc=60
+        )
+        self.make_basket('other_buyer@example.com', in_basket, 1)
+        category = product_info.product.category
+        data = {'shop': 'Магазин',
+                'categories': [{'id': category.id, 'name': category.name}],
+                'goods': [{'id': 1, 'category': category.id, 'model': '',
+                           'name': 'Товар', 'price': 1000, 'price_rrc': 1200,
+                           'quantity': 10, 'parameters': {'Цвет': 'синий'}}]}
+        runs = ImportRun.objects.none()
+
+        # позиция обновляется, а не создается заново
+        assert tasks._import_price_list(product_info.shop_id, data,
+                                        runs) == (1, 1)
+        product_info.refresh_from_db()
+        assert product_info.price == 1000
+        assert product_info.product_parameters.get().value == 'синий'
+        assert not ProductInfo.objects.filter(id=in_basket.id).exists()
+
+        # заказанная позиция, которой нет в прайс-листе, остается в заказе
+        data['goods'] = []
+        assert tasks._import_price_list(product_info.shop_id, data,
+                                        runs) == (0, 0)
+        product_info.refresh_from_db()
+        assert product_info.quantity == 0
+
+        order_data = api_client.get(full_path('order/')).json()['results'][0]
+        assert order_data['total_sum'] == 200
+        ordered_items = order_data['shops'][0]['ordered_items']
+        assert [(item['quantity'], item['price'])
+                for item in ordered_items] == [(2, 100)]
+
+    def test_order_history_pagination(self, api_client, product_info):
+        buyer, address, _ = self.make_basket('buyer_email@example.com',
+                                             product_info, 1)
+        Order.objects.bulk_create([Order(user=buyer, state=state)
+                                   for state in ['new'] * 3 + ['sent'] * 2])
+        api_client.force_authenticate(buyer)
+
+        response = api_client.get(full_path('order/'), {'page_size': 2})
+        first_page = response.json()
+        response = api_client.get(first_page['next'])
+        second_page = response.json()
+
+        assert len(first_page['results']) == len(second_page['results']) == 2
+        assert not {order['id'] for order in first_page['results']} & \
+               {order['id'] for order in second_page['results']}
+
+    @pytest.mark.parametrize('params, expected_status, expected_count', [
+        [{'state': 'sent'}, status.HTTP_200_OK, 2],
+        [{'dt_from': '2000-01-01', 'dt_to': '2000-12-31'},
+         status.HTTP_200_OK, 0],
+        [{'state': 'basket'}, status.HTTP_400_BAD_REQUEST, None],
+        [{'dt_from': 'вчера'}, status.HTTP_400_BAD_REQUEST, None],
+    ])
+    def test_order_history_filters(self, api_client, product_info,
+                                   params, expected_status, expected_count):
+        buyer, address, _ = self.make_basket('buyer_email@example.com',
+                                             product_info, 1)
+        Order.objects.bulk_create([Order(user=buyer, state=state)
+                                   for state in ['new'] * 3 + ['sent'] * 2])
+        api_client.force_authenticate(buyer)
+
+        response = api_client.get(full_path('order/'), params)
+
+        assert response.status_code == expected_status
+        if expected_count is not None:
+            assert len(response.json()['results']) == expected_count
+
+    def test_partner_orders(self, api_client, product_info,
+                            django_assert_max_num_queries):
+        partner = User.objects.create_user(valid_partner_data['email'],
+                                           valid_partner_data['password'],
+                                           type='shop')
+        Shop.objects.filter(id=product_info.shop_id).update(user=partner)
+        for i in range(3):
+            buyer, address, basket = self.make_basket(
+                f'buyer_{i}@example.com', product_info, 1
+            )
+            place_order(basket, address.id)
+        api_client.force_authenticate(partner)
+
+        # заказы по магазину, их позиции и параметры товаров
+        with django_assert_max_num_queries(3):
+            response = api_client.get(full_path('partner/orders/'))
+
+        assert response.status_code == status.HTTP_200_OK
+        results = response.json()['results']
+        assert len(results) == 3
+        assert all(order['items_count'] == len(order['ordered_items']) == 1
+                   for order in results)
+
+    def test_partner_order_changes(self, api_client, product_info, settings):
+        settings.ORDER_CHANGES_SETTLE_SECONDS = 0
+        partner = User.objects.create_user(valid_partner_data['email'],
+                                           valid_partner_data['password'],
+                                           type='shop')
+        Shop.objects.filter(id=product_info.shop_id).update(user=partner)
+        orders = []
+        for i in range(2):
+            buyer, address, basket = self.make_basket(
+                f'buyer_{i}@example.com', product_info, 1
+            )
+            place_order(basket, address.id)
+            orders.append(basket)
+        api_client.force_authenticate(partner)
+        url = full_path('partner/orders/changes/')
+
+        # без курсора - все изменения с начала ленты
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        feed = response.json()
+        assert [order['id'] for order in feed['results']] == [
+            order.id for order in orders]
+        assert feed['has_more'] is False
+
+        # новых изменений нет, курсор не меняется
+        response = api_client.get(url, {'cursor': feed['cursor']})
+        assert response.json()['results'] == []
+        assert response.json()['cursor'] == feed['cursor']
+
+        # изменение статуса в админке продвигает ленту
+        order = orders[0]
+        order.state = 'confirmed'
+        OrderAdmin(Order, admin.site).save_model(
+            None, order, SimpleNamespace(changed_data=['state']), True
+        )
+        response = api_client.get(url, {'cursor': feed['cursor']})
+        results = response.json()['results']
+        assert [(result['id'], result['state']) for result in results] == [
+            (order.id, 'confirmed')]
+
+        response = api_client.get(url, {'cursor': 'invalid'})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db(transaction=True)
+class TestOrderEvents:
+
+    def test_new_order_event(self, monkeypatch):
+        monkeypatch.setattr(events, 'hub', events.OrderEventHub())
+        partner = User.objects.create_user(valid_partner_data['email'],
+                                           valid_partner_data['password'],
+                                           type='shop', is_active=True)
+        token = Token.objects.create(user=partner)
+        shop = Shop.objects.create(name='Магазин', user=partner)
+        Delivery.objects.create(shop=shop, min_sum=0, cost=300)
+        category = Category.objects.create(name='Категория')
+        product = Product.objects.create(name='Товар', category=category)
+        product_info = ProductInfo.objects.create(
+            product=product, shop=shop, external_id=1, quantity=5,
+            price=100, price_rrc=120
+        )
+        buyer, address, basket = TestCheckout.make_basket(
+            'buyer_email@example.com', product_info, 1
+        )
+
+        async def stream():
+            sent, disconnected = [], asyncio.Event()
+            messages = [{'type': 'http.request', 'body': b''}]
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {'type': 'http', 'method': 'GET',
+                     'path': events.EVENTS_PATH, 'query_string': b'',
+                     'headers': [(b'authorization',
+                                  f'Token {token.key}'.encode())]}
+            app = asyncio.ensure_future(
+                events.order_events_app(scope, receive, send)
+            )
+            # ждем подписки процесса на каналы магазинов
+            while not events.hub.subscribed:
+                await asyncio.sleep(0.01)
+            await sync_to_async(place_order)(basket, address.id)
+            for _ in range(500):
+                if any(b'data:' in message.get('body', b'')
+                       for message in sent):
+                    break
+                await asyncio.sleep(0.01)
+            disconnected.set()
+            await app
+            return sent
+
+        sent = asyncio.run(stream())
+        assert sent[0]['status'] == 200
+        data = [json.loads(message['body'][len(b'data: '):])
+                for message in sent
+                if message.get('body', b'').startswith(b'data:')]
+        assert data == [{'event': 'new_order', 'order': basket.id,
+                         'state': 'new'}]
+
+
+    def test_shop_lookup_closes_old_connections(self):
+        # соединение закрывается по CONN_MAX_AGE (в тестах - 0),
+        # как в конце обычного запроса
+        assert async_to_sync(events._get_shop_id)('missing') is None
+        assert connection.connection is None
+
+@pytest.fixture
+def slow_categories(monkeypatch):
+    """
+    Список категорий выполняется delay секунд; threads - потоки,
+    в которых он выполнялся
+    """
+    delay, threads = 0.3, set()
+    list_categories = CategoryView.list
+
+    def slow_list(self, request, *args, **kwargs):
+        threads.add(threading.current_thread().name)
+        time.sleep(delay)
+        return list_categories(self, request, *args, **kwargs)
+
+    monkeypatch.setattr(CategoryView, 'list', slow_list)
+    return SimpleNamespace(delay=delay, threads=threads)
+
+
+def get_concurrently(path, count):
+    """
+    Одновременные GET-запросы через ASGI: ответы и общее время
+    """
+    async def get_all():
+        client = AsyncClient()
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[
+            client.get(full_path(path)) for _ in range(count)
+        ])
+        return responses, time.perf_counter() - start
+
+    return asyncio.run(get_all())
+
+
+def test_read_views_wrapped_only_for_asgi():
+    # под WSGI представления вызываются напрямую, без async_to_sync
+    for name in ('categories', 'products', 'basket', 'order'):
+        wsgi_view = resolve(reverse(name, urlconf='orders.urls'),
+                            urlconf='orders.urls').func
+        asgi_view = resolve(reverse(name, urlconf='orders.asgi_urls'),
+                            urlconf='orders.asgi_urls').func
+        assert not asyncio.iscoroutinefunction(wsgi_view)
+        assert asyncio.iscoroutinefunction(asgi_view)
+
+
+@pytest.mark.urls('orders.asgi_urls')
+@pytest.mark.django_db(transaction=True)
+def test_async_read_views(slow_categories):
+    Category.objects.create(name='Категория')
+    count = 4
+
+    responses, elapsed = get_concurrently('categories/', count)
+
+    assert all(response.status_code == status.HTTP_200_OK
+               for response in responses)
+    assert [category['name'] for category in responses[0].json()] == [
+        'Категория']
+    # запросы на чтение выполняются одновременно в потоках пула
+    assert len(slow_categories.threads) == count
+    assert elapsed < slow_categories.delay * count / 2
+
+
+@pytest.mark.urls('orders.asgi_urls')
+@pytest.mark.django_db(transaction=True)
+def test_middleware_keeps_async_reads_concurrent(slow_categories, settings,
+                                                 tmp_path):
+    settings.TRAFFIC_CAPTURE_ENABLED = True
+    settings.TRAFFIC_CAPTURE_SAMPLE_RATE = 1
+    settings.TRAFFIC_CAPTURE_DIR = str(tmp_path)
+    count = 4
+
+    responses, elapsed = get_concurrently('categories/', count)
+
+    assert all(response.status_code == status.HTTP_200_OK
+               for response in responses)
+    # middleware не переводит запросы в один поток: запросы выполняются
+    # одновременно в разных потоках пула
+    assert len(slow_categories.threads) == count
+    assert elapsed < slow_categories.delay * count / 2
+    assert len(traffic.read_files([str(tmp_path)])) == count
+
+
+@pytest.mark.django_db
+def test_queued_emails(monkeypatch):
+    client = get_redis()
+    client.delete(mail.QUEUE_KEY)
+    # письма только ставятся в очередь, отправка запускается в тесте
+    monkeypatch.setattr(mail, 'schedule_drain', lambda countdown=None: None)
+    for i in range(3):
+        mail.enqueue_email(f'Письмо {i}', 'Текст', ['to@example.com'])
+    assert outbox.relay() == 3
+    assert client.llen(mail.QUEUE_KEY) == 3
+
+    # первая попытка отправить второе письмо завершается ошибкой
+    failures = {'Письмо 1'}
+    send_messages = EmailBackend.send_messages
+
+    def flaky_send_messages(self, messages):
+        if messages[0].subject in failures:
+            failures.remove(messages[0].subject)
+            raise SMTPException
+        return send_messages(self, messages)
+
+    monkeypatch.setattr(EmailBackend, 'send_messages', flaky_send_messages)
+    result = mail.send_queued()
+    assert (result['sent'], result['failed'], result['retry']) == (2, 0, 1)
+    assert client.llen(mail.QUEUE_KEY) == 1
+
+    # письмо отправляется повторно при следующем запуске
+    assert mail.send_queued()['sent'] == 1
+    assert [message.subject for message in django_mail.outbox] == [
+        'Письмо 0', 'Письмо 2', 'Письмо 1']
+    assert client.llen(mail.QUEUE_KEY) == 0
+
+
+def test_queued_emails_of_stopped_task_are_requeued(monkeypatch, settings):
+    client = get_redis()
+    processing_key = f'{mail.QUEUE_KEY}:processing'
+    for key in [mail.QUEUE_KEY, processing_key,
+                *client.scan_iter(f'{processing_key}:*')]:
+        client.delete(key)
+    monkeypatch.setattr(mail, 'schedule_drain', lambda countdown=None: None)
+    mail.push_emails([mail._payload(f'Письмо {i}', 'Текст',
+                                    ['to@example.com']) for i in range(3)])
+
+    # во время отправки письмо хранится в списке задачи, а не только
+    # в памяти процесса
+    processing_lengths = []
+    send_messages = EmailBackend.send_messages
+
+    def recording_send_messages(self, messages):
+        processing_lengths.append(sum(
+            client.llen(key) for key in client.scan_iter(f'{processing_key}:*')
+        ))
+        return send_messages(self, messages)
+
+    monkeypatch.setattr(EmailBackend, 'send_messages',
+                        recording_send_messages)
+
+    # задача остановлена, не отправив два письма
+    stopped = f'{processing_key}:stopped'
+    for _ in range(2):
+        client.lmove(mail.QUEUE_KEY, stopped, 'LEFT', 'RIGHT')
+    client.zadd(processing_key, {stopped: time.time()})
+
+    # письма задачи, которая может еще выполняться, не возвращаются
+    assert mail.send_queued(batch_size=1)['sent'] == 1
+    assert processing_lengths == [3]
+    assert client.llen(stopped) == 2
+
+    settings.MAIL_PROCESSING_TIMEOUT = 0
+    assert mail.send_queued()['sent'] == 2
+    assert [message.subject for message in django_mail.outbox] == [
+        'Письмо 2', 'Письмо 0', 'Письмо 1']
+    assert not client.exists(stopped, processing_key)
+    assert client.llen(mail.QUEUE_KEY) == 0
+
+
+def test_bench_email_uses_own_queue():
+    client = get_redis()
+    client.delete(mail.QUEUE_KEY)
+    client.rpush(mail.QUEUE_KEY, json.dumps(mail._payload(
+        'Заказ', 'Текст', ['customer@example.com']
+    )))
+    out = StringIO()
+
+    call_command('bench_email', count=5, latency=0, stdout=out)
+
+    # письмо основной очереди не отправлено тестом и осталось в очереди
+    assert 'Из очереди: 5 писем' in out.getvalue()
+    assert 'Получено сервером: 10' in out.getvalue()
+    assert client.llen(mail.QUEUE_KEY) == 1
+    assert not list(client.scan_iter(f'{mail.QUEUE_KEY}:bench:*'))
+    client.delete(mail.QUEUE_KEY)
+
+
+@pytest.mark.django_db
+def test_admin_digest(monkeypatch, settings):
+    settings.ADMIN_URGENT_NOTIFICATIONS = ['new_partner']
+    client = get_redis()
+    client.delete(mail.QUEUE_KEY, mail.DIGEST_KEY)
+    monkeypatch.setattr(mail, 'schedule_drain', lambda countdown=None: None)
+
+    mail.notify_admin('new_partner', 'Новый поставщик', 'Поставщик')
+    for i in range(3):
+        mail.notify_admin('new_order', 'Новый заказ', f'Заказ {i}')
+    mail.notify_admin('price_list', 'Обновление прайса', 'Магазин')
+    outbox.relay()
+    # срочное уведомление отправляется сразу, остальные ждут сводки
+    assert client.llen(mail.QUEUE_KEY) == 1
+    assert client.llen(mail.DIGEST_KEY) == 4
+
+    assert mail.send_admin_digest() == 4
+    assert mail.send_admin_digest() == 0
+    assert client.llen(mail.QUEUE_KEY) == 2
+    mail.send_queued()
+    digest = django_mail.outbox[-1]
+    assert digest.to == [settings.ADMIN_EMAIL]
+    assert digest.subject == 'Сводка уведомлений: 4'
+    assert 'Новые заказы: 3' in digest.body
+    assert '- Заказ 2' in digest.body
+
+
+@pytest.mark.django_db
+def test_outbox_publishes_committed_messages(monkeypatch):
+    client = get_redis()
+    client.delete(mail.QUEUE_KEY)
+    monkeypatch.setattr(mail, 'schedule_drain', lambda countdown=None: None)
+
+    # письмо из отмененной транзакции не отправляется
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            mail.enqueue_email('Отмененное', 'Текст', ['to@example.com'])
+            raise RuntimeError
+    mail.enqueue_email('Письмо', 'Текст', ['to@example.com'])
+    assert OutboxMessage.objects.count() == 1
+
+    assert outbox.relay() == 1
+    assert outbox.relay() == 0
+    assert [json.loads(raw)['title']
+            for raw in client.lrange(mail.QUEUE_KEY, 0, -1)] == ['Письмо']
+
+
+@pytest.mark.django_db
+def test_outbox_messages_processed_once(monkeypatch):
+    client = get_redis()
+    client.delete(mail.QUEUE_KEY)
+    monkeypatch.setattr(mail, 'schedule_drain', lambda countdown=None: None)
+    published = []
+    monkeypatch.setattr(outbox, 'current_app', SimpleNamespace(
+        send_task=lambda name, **options: published.append(options)
+    ))
+    calls = []
+
+    @celery_app.task(base=outbox.OutboxTask, shared=False)
+    def outbox_task():
+        calls.append(1)
+
+    mail.enqueue_email('Письмо', 'Текст', ['to@example.com'])
+    outbox.send_task(outbox_task.name)
+    # фиксация не удалась после публикации, пакет публикуется повторно
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            assert outbox.relay() == 2
+            raise RuntimeError
+    assert outbox.relay() == 2
+    assert client.llen(mail.QUEUE_KEY) == 2
+    assert len(published) == 2
+
+    assert mail.send_queued()['sent'] == 1
+    assert [message.subject for message in django_mail.outbox] == ['Письмо']
+    for options in published:
+        outbox_task.apply(headers=options['headers'])
+    assert calls == [1]
+
+
+def test_task_routes_and_queue_latency():
+    router = celery_app.amqp.router
+    assert router.route({}, 'backend.tasks.do_import_task')[
+        'queue'].name == 'imports'
+    assert router.route({}, 'backend.tasks.send_queued_emails_task')[
+        'queue'].name == 'emails'
+    assert router.route({}, 'backend.tasks.flush_baskets_task')[
+        'queue'].name == 'default'
+
+    task_name = 'backend.tasks.send_queued_emails_task'
+    get_redis().delete('metrics:celery_queue_latency_seconds:queue=emails:'
+                       f'task={task_name}')
+    headers = {}
+    signals.add_publish_time(headers=headers)
+    headers['published_at'] -= 2
+    task = SimpleNamespace(name=task_name, request=SimpleNamespace(
+        published_at=headers['published_at'],
+        delivery_info={'routing_key': 'emails'}
+    ))
+    signals.record_queue_latency(task=task)
+
+    latencies = {labels.get('task'): histogram for labels, histogram
+                 in metrics.histograms('celery_queue_latency_seconds')
+                 if labels['queue'] == 'emails'}
+    assert latencies[task_name]['count'] == 1
+    assert metrics.quantile(latencies[task_name], 0.5) == 2.5
+
+
+@pytest.mark.django_db
+def test_task_metrics():
+    def durations(task, state):
+        return sum(histogram['count'] for labels, histogram
+                   in metrics.histograms('celery_task_duration_seconds')
+                   if labels == {'task': task, 'state': state})
+
+    def failures(task):
+        return sum(value for labels, value
+                   in metrics.counters('celery_task_failures')
+                   if labels['task'] == task)
+
+    purge_task = tasks.purge_expired_tokens_task.name
+    before = durations(purge_task, 'SUCCESS')
+    tasks.purge_expired_tokens_task.apply()
+    assert durations(purge_task, 'SUCCESS') == before + 1
+
+    import_task = tasks.do_import_task.name
+    before = failures(import_task)
+    signals.count_task_failure(sender=tasks.do_import_task,
+                               exception=Shop.DoesNotExist())
+    assert failures(import_task) == before + 1
+
+
+@pytest.mark.django_db
+class TestCachedTokenAuthentication:
+
+    @pytest.fixture
+    def token(self):
+        user = User.objects.create_user('buyer_email@example.com',
+                                        'lkajdhfkljdshf', is_active=True)
+        return Token.objects.create(user=user)
+
+    def test_cached_user(self, token, django_assert_num_queries,
+                         django_capture_on_commit_callbacks):
+        authentication = CachedTokenAuthentication()
+        user, _ = authentication.authenticate_credentials(token.key)
+        assert user.id == token.user_id
+
+        # повторная аутентификация без запросов к базе:
+        # из локального кэша и из Redis
+        with django_assert_num_queries(0):
+            authentication.authenticate_credentials(token.key)
+            local_cache.delete(token.key)
+            user, _ = authentication.authenticate_credentials(token.key)
+        # в Redis только поля CACHED_FIELDS, остальные - из базы
+        assert json.loads(get_redis().get(f'auth:token:{token.key}')) == {
+            'id': token.user_id, 'is_active': True, 'type': 'buyer',
+            'email': 'buyer_email@example.com'
+        }
+        with django_assert_num_queries(0):
+            assert user.email == 'buyer_email@example.com'
+        with django_assert_num_queries(1):
+            assert user.last_name == ''
+
+        # изменение пользователя удаляет его из кэша
+        with django_capture_on_commit_callbacks(execute=True):
+            user.is_active = False
+            user.save()
+        with pytest.raises(AuthenticationFailed):
+            authentication.authenticate_credentials(token.key)
+
+    def test_partner_request_with_cached_token(self):
+        partner = User.objects.create_user('partner@example.com',
+                                           'lkajdhfkljdshf', type='shop',
+                                           is_active=True)
+        token = Token.objects.create(user=partner)
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        url = full_path('partner/orders/')
+        assert api_client.get(url).status_code == status.HTTP_200_OK
+
+        # проверка IsShop и представление не загружают пользователя
+        with CaptureQueriesContext(connection) as queries:
+            assert api_client.get(url).status_code == status.HTTP_200_OK
+        tables = (User._meta.db_table, Token._meta.db_table)
+        assert not [query['sql'] for query in queries
+                    if any(table in query['sql'] for table in tables)]
+
+    def test_redis_unavailable(self, token, monkeypatch):
+        def get_redis():
+            raise redis.ConnectionError('Redis недоступен')
+
+        monkeypatch.setattr(authentication, 'get_redis', get_redis)
+        local_cache.delete(token.key)
+        user, _ = CachedTokenAuthentication().authenticate_credentials(
+            token.key
+        )
+        assert user.id == token.user_id
+
+    def test_logout(self, token, django_capture_on_commit_callbacks):
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        url = full_path('user/logout/')
+        with django_capture_on_commit_callbacks(execute=True):
+            response = api_client.post(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert not Token.objects.filter(key=token.key).exists()
+
+        response = api_client.post(url)
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.django_db
+def test_login_throttle():
+    api_client = APIClient()
+    url = full_path('user/login/')
+    data = {'email': 'buyer_email@example.com', 'password': 'wrong'}
+    for _ in range(10):
+        response = api_client.post(url, data)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    response = api_client.post(url, data)
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert 0 < int(response['Retry-After']) <= 60
+
+    # на клиента и scope в Redis хранится одно значение с временем жизни
+    client = get_redis()
+    key = 'throttle:login:127.0.0.1'
+    assert client.type(key) == b'string'
+    assert 0 < client.pttl(key) <= 60 * 1000
+
+
+@pytest.mark.django_db
+def test_purge_expired_tokens():
+    users = [User.objects.create_user(f'user{i}@example.com', 'password')
+             for i in range(6)]
+    tokens = [ConfirmEmailToken.objects.create(user=user) for user in users]
+    expired = timezone.now() - timedelta(
+        hours=settings.CONFIRM_EMAIL_TOKEN_EXPIRY_TIME + 1
+    )
+    ConfirmEmailToken.objects.filter(
+        id__in=[token.id for token in tokens[:5]]
+    ).update(created_at=expired)
+
+    # устаревший токен уже не подтверждает почту
+    response = APIClient().post(full_path('user/register/confirm/'),
+                                {'email': users[0].email,
+                                 'token': tokens[0].key})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    before = dict((labels['model'], value) for labels, value
+                  in metrics.counters('tokens_purged'))
+    result = cleanup.purge_expired_tokens(batch_size=2)
+    assert result == {'confirm_email': 5, 'reset_password': 0}
+    assert list(ConfirmEmailToken.objects.values_list('id', flat=True)) == \
+        [tokens[5].id]
+    after = dict((labels['model'], value) for labels, value
+                 in metrics.counters('tokens_purged'))
+    assert after['confirmemailtoken'] - \
+        before.get('confirmemailtoken', 0) == 5
+
+
+@pytest.mark.django_db
+class TestAdminChangelists:
+
+    @pytest.fixture
+    def admin_client(self, client):
+        admin_user = User.objects.create_superuser('admin@example.com',
+                                                   'lkajdhfkljdshf')
+        client.force_login(admin_user)
+        return client
+
+    def test_product_info_list(self, admin_client, django_assert_num_queries):
+        shop = Shop.objects.create(name='Магазин')
+        category = Category.objects.create(name='Категория')
+        for i in range(5):
+            product = Product.objects.create(name=f'Товар {i}',
+                                             category=category)
+            ProductInfo.objects.create(product=product, shop=shop,
+                                       external_id=i, quantity=1,
+                                       price=100, price_rrc=100)
+
+        # количество запросов не зависит от количества строк:
+        # сессия, пользователь, фильтр магазинов, оценка количества,
+        # точный подсчет (оценка мала) и сама страница
+        with django_assert_num_queries(6):
+            response = admin_client.get('/admin/backend/productinfo/')
+        assert response.status_code == status.HTTP_200_OK
+        assert response.context['cl'].result_count == 5
+
+    def test_order_list_user_filter(self, admin_client):
+        buyers = [User.objects.create_user(f'buyer{i}@example.com',
+                                           'lkajdhfkljdshf')
+                  for i in range(2)]
+        for buyer in buyers + buyers[:1]:
+            Order.objects.create(user=buyer, state='new')
+
+        response = admin_client.get('/admin/backend/order/',
+                                    {'user__id__exact': buyers[1].id})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.context['cl'].result_count == 1
+        content = response.content.decode()
+        # пользователь выбирается автодополнением, список всех
+        # пользователей в фильтр не загружается
+        assert 'data-field-name="user"' in content
+        assert buyers[0].email not in content
+        assert 'admin/js/autocomplete.js' in content
+
+        response = admin_client.get('/admin/autocomplete/', {
+            'term': 'buyer1', 'app_label': 'backend',
+            'model_name': 'order', 'field_name': 'user'
+        })
+        assert [result['id'] for result in response.json()['results']] == \
+            [str(buyers[1].id)]
+
+    def test_estimated_count(self, settings):
+        category = Category.objects.create(name='Категория')
+        Product.objects.bulk_create([
+            Product(name=f'Товар {i}', category=category) for i in range(50)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE backend_product')
+        estimate = estimated_count(Product.objects.all())
+        assert estimate is not None
+        assert estimated_count(
+            Product.objects.filter(name__startswith='Товар')
+        ) is not None
+
+        settings.ADMIN_EXACT_COUNT_LIMIT = 0
+        assert EstimatedCountPaginator(Product.objects.all(), 10).count == \
+            estimate
+        settings.ADMIN_EXACT_COUNT_LIMIT = 10000
+        assert EstimatedCountPaginator(Product.objects.all(), 10).count == 50
+
+    def test_import_runs(self, admin_client, monkeypatch, settings):
+        with open(valid_update_data['file'], 'rb') as f:
+            content = f.read()
+        shop = Shop.objects.create(name='Магазин', url='http://example.com/')
+        monkeypatch.setattr(backend_admin.rqs, 'get',
+                            lambda url: SimpleNamespace(ok=True,
+                                                        content=content))
+
+        response = admin_client.get('/admin/backend/shop/update/',
+                                    {'ids': shop.id})
+        assert response.status_code == status.HTTP_200_OK
+        run = ImportRun.objects.get(shop=shop)
+        assert run.state == 'queued'
+        assert run.goods_total == 4
+        assert run.fetch_seconds is not None
+        assert run.parse_seconds is not None
+        message = OutboxMessage.objects.get(topic='task')
+        assert message.payload['kwargs'] == {'run_id': run.id}
+
+        def imports_count():
+            return sum(histogram['count'] for labels, histogram
+                       in metrics.histograms('import_goods_per_second')
+                       if labels == {'shop': str(shop.id)})
+
+        # задача записывает ход загрузки и итоговые показатели
+        imported_before = imports_count()
+        settings.IMPORT_PROGRESS_EVERY = 2
+        tasks.do_import_task(*message.payload['args'],
+                             **message.payload['kwargs'])
+        run.refresh_from_db()
+        assert run.state == 'done'
+        assert run.goods_written == 4
+        assert run.rows_deleted == 0
+        assert run.rows_delta == 4
+        assert run.write_seconds > 0
+        assert run.rows_per_second > 0
+
+        assert imports_count() == imported_before + 1
+
+        response = admin_client.get('/admin/backend/importrun/progress/',
+                                    {'ids': run.id})
+        assert response.json()['runs'][0]['goods_written'] == 4
+        assert response.json()['runs'][0]['state'] == 'done'
+
+
+@pytest.mark.django_db
+def test_request_metrics(settings, monkeypatch):
+    settings.DEBUG = True
+    Category.objects.create(name='Категория')
+    # время сериализатора (to_representation), а не только отрисовки JSON
+    to_representation = rest_serializers.Serializer.to_representation
+
+    def slow_to_representation(self, instance):
+        time.sleep(0.05)
+        return to_representation(self, instance)
+
+    monkeypatch.setattr(rest_serializers.Serializer, 'to_representation',
+                        slow_to_representation)
+
+    def requests_count():
+        return sum(histogram['count'] for labels, histogram
+                   in metrics.histograms('http_request_duration_seconds')
+                   if labels == {'method': 'GET', 'view': 'categories'})
+
+    before = requests_count()
+    response = APIClient().get(full_path('categories/'))
+    assert response.status_code == status.HTTP_200_OK
+    timing = response['Server-Timing']
+    assert timing.startswith('total;dur=')
+    assert 'queries"' in timing and 'render;dur=' in timing
+    serialize = float(timing.split('serialize;dur=')[1].split(',')[0])
+    assert serialize >= 50
+    assert requests_count() == before + 1
+
+    response = APIClient().get('/metrics')
+    assert response.status_code == status.HTTP_200_OK
+    content = response.content.decode()
+    assert '# TYPE http_request_duration_seconds histogram' in content
+    assert ('http_db_queries_bucket{method="GET",view="categories",le="1000"}'
+            in content)
+    assert 'http_response_size_bytes_count{method="GET",view="categories"}' \
+        in content
+
+    settings.METRICS_TOKEN = 'secret'
+    assert APIClient().get('/metrics').status_code == \
+        status.HTTP_403_FORBIDDEN
+    response = APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db(transaction=True)
+def test_slow_query_hook_on_new_connection():
+    wrappers = []
+
+    def requests():
+        # в новом потоке соединение открывается внутри замера
+        # SQL-запросов PerformanceMiddleware
+        try:
+            for _ in range(2):
+                connection.close()
+                response = APIClient().get(full_path('categories/'))
+                assert response.status_code == status.HTTP_200_OK
+                wrappers.append(list(connection.execute_wrappers))
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=requests)
+    thread.start()
+    thread.join()
+    assert wrappers == [[slow_queries.slow_query_hook]] * 2
+
+
+@pytest.mark.django_db
+def test_slow_queries_without_parameters(settings):
+    client_redis = get_redis()
+    client_redis.delete(slow_queries.BUFFER_KEY)
+    for key in client_redis.scan_iter('slow_queries:rate:*'):
+        client_redis.delete(key)
+    settings.SLOW_QUERY_THRESHOLD_MS = 5
+    User.objects.create_user('secret@example.com', 'lkajdhfkljdshf')
+
+    sql = ('SELECT pg_sleep(0.01), '
+           '(SELECT count(*) FROM backend_user WHERE email = %s AND id > %s)')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, ['secret@example.com', 12345])
+
+    queries = slow_queries.recent()
+    assert len(queries) == 1
+    assert queries[0]['sql'] == sql
+    assert 'Filter: ' in queries[0]['plan']
+    assert 'secret' not in json.dumps(queries[0])
+    assert '12345' not in json.dumps(queries[0])
+
+
+@pytest.mark.django_db
+def test_slow_queries(client, settings):
+    client_redis = get_redis()
+    client_redis.delete(slow_queries.BUFFER_KEY)
+    for key in client_redis.scan_iter('slow_queries:rate:*'):
+        client_redis.delete(key)
+    settings.SLOW_QUERY_THRESHOLD_MS = 5
+    settings.SLOW_QUERY_MAX_PER_MINUTE = 2
+    assert slow_queries.slow_query_hook in connection.execute_wrappers
+
+    token = slow_queries.origin.set('test-view')
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            for _ in range(3):
+                cursor.execute('SELECT pg_sleep(0.01)')
+    finally:
+        slow_queries.origin.reset(token)
+
+    # быстрый запрос не записан, медленные - не больше лимита в минуту
+    queries = slow_queries.recent()
+    assert len(queries) == 2
+    assert queries[0]['sql'] == 'SELECT pg_sleep(0.01)'
+    assert queries[0]['origin'] == 'test-view'
+    assert queries[0]['duration_ms'] >= 5
+    assert 'Execution Time' in queries[0]['plan']
+    assert any('test_slow_queries' in frame for frame in queries[0]['caller'])
+
+    admin_user = User.objects.create_superuser('admin@example.com',
+                                               'lkajdhfkljdshf')
+    client.force_login(admin_user)
+    response = client.get('/admin/slow-queries/')
+    assert response.status_code == status.HTTP_200_OK
+    assert 'SELECT pg_sleep(0.01)' in response.content.decode()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_generate_data_and_load_test(live_server, settings):
+    settings.BASKET_STORAGE = 'db'
+    out = StringIO()
+    call_command('generate_data', shops=2, categories=3, products=20,
+                 users=4, orders=30, batch_size=7, seed=1, stdout=out)
+
+    assert ProductInfo.objects.count() == 40
+    assert ProductParameter.objects.count() == 120
+    assert Delivery.objects.count() == 6
+    assert Token.objects.count() == 6
+    orders = Order.objects.exclude(state='basket')
+    assert orders.count() == 30
+    # суммы заказов совпадают с суммами по магазинам и позициям,
+    # доставка - с уровнем стоимости доставки магазина
+    for order in orders.prefetch_related('order_shops', 'ordered_items'):
+        assert order.total_sum == sum(order_shop.shop_sum for order_shop
+                                      in order.order_shops.all())
+        assert order.total_delivery == sum(order_shop.delivery for order_shop
+                                           in order.order_shops.all())
+        for order_shop in order.order_shops.all():
+            assert order_shop.delivery == [
+                cost for min_sum, cost in DELIVERY_TIERS
+                if min_sum <= order_shop.shop_sum
+            ][-1]
+        assert order.total_sum == sum(item.price * item.quantity
+                                      for item in order.ordered_items.all())
+    assert orders.filter(dt__lt=timezone.now() - timedelta(days=1)).exists()
+
+    out = StringIO()
+    call_command('load_test', url=f'{live_server.url}/api/v1',
+                 buyers=2, partners=1, duration=2, think_time=0,
+                 poll_interval=0.5, checkout_rate=1, stdout=out)
+    report = out.getvalue()
+    for name in ('categories', 'products?category_id', 'basket POST',
+                 'order POST', 'partner/orders/changes'):
+        assert name in report
+    assert 'ошибок 0.0%' in report
+    assert Order.objects.exclude(state='basket').count() > 30
+
+
+@pytest.mark.django_db(transaction=True)
+def test_traffic_capture_and_replay(live_server, settings, tmp_path):
+    settings.BASKET_STORAGE = 'db'
+    settings.TRAFFIC_CAPTURE_ENABLED = True
+    settings.TRAFFIC_CAPTURE_SAMPLE_RATE = 1
+    settings.TRAFFIC_CAPTURE_DIR = str(tmp_path / 'traffic')
+    settings.TRAFFIC_CAPTURE_MAX_BYTES = 1000
+    call_command('generate_data', shops=1, categories=2, products=5,
+                 users=2, orders=0, seed=1, stdout=StringIO())
+    buyer = User.objects.filter(type='buyer').first()
+    product_info = ProductInfo.objects.first()
+
+    api_client = APIClient()
+    api_client.force_authenticate(buyer)
+    api_client.get(full_path('products/'), {'category_id': 1,
+                                            'token': 'secret-token'})
+    api_client.post(full_path('basket/'), {'items': [
+        {'product_info': product_info.id, 'quantity': 2}
+    ]})
+    api_client.post(full_path('user/addresses/'), {
+        'city': 'Москва', 'street': 'Тверская', 'phone': '+79001234567'
+    })
+    APIClient().post(full_path('user/login/'),
+                     {'email': buyer.email, 'password': 'load-test-password'})
+    APIClient().get('/admin/')
+
+    entries = traffic.read_files([settings.TRAFFIC_CAPTURE_DIR])
+    assert [entry['view'] for entry in entries] == [
+        'products', 'basket', 'user-address-list', 'user-login'
+    ]
+    products, basket, address, login = entries
+    assert products['params'] == {'category_id': ['1'],
+                                  'token': ['************']}
+    assert basket['body']['items'][0]['quantity'] == 2
+    assert basket['user'] == traffic.pseudonym(buyer)
+    assert basket['user_type'] == 'buyer'
+    assert basket['status'] == status.HTTP_200_OK
+    assert address['body']['city'] == '******'
+    assert login['body'] == {'email': '*' * len(buyer.email),
+                             'password': '*' * 18}
+    assert login['user'] is None
+    text = ''.join(path.read_text()
+                   for path in (tmp_path / 'traffic').iterdir())
+    assert buyer.email not in text and 'Тверская' not in text
+
+    # файлы сменяются при превышении размера
+    for _ in range(5):
+        api_client.get(full_path('products/'), {'category_id': 1})
+    assert len(list((tmp_path / 'traffic').iterdir())) > 1
+    assert len(traffic.read_files([settings.TRAFFIC_CAPTURE_DIR])) == 9
+
+    settings.TRAFFIC_CAPTURE_ENABLED = False
+    out = StringIO()
+    call_command('replay_traffic', settings.TRAFFIC_CAPTURE_DIR,
+                 url=live_server.url, speed=0, concurrency=2,
+                 save=str(tmp_path / 'before.json'), stdout=out)
+    assert 'Всего: 9 запросов' in out.getvalue()
+    out = StringIO()
+    call_command('replay_traffic', settings.TRAFFIC_CAPTURE_DIR,
+                 url=live_server.url, speed=0,
+                 baseline=str(tmp_path / 'before.json'), stdout=out)
+    assert 'p95 было' in out.getvalue()
+    assert 'basket' in out.getvalue()
@@ -0,0 +1,102 @@
+"""
+Ограничение частоты запросов, общее для всех процессов веб-сервера.
+
+Стандартные throttle-классы DRF хранят список времен запросов в кэше
+процесса: у каждого воркера свой счетчик, а память на клиента растет
+с лимитом. Здесь используется GCRA (generic cell rate algorithm):
+для клиента в Redis хранится одно число - теоретическое время прихода
+следующего запроса (мс), проверка и обновление выполняются атомарно
+Lua-скриптом за один запрос к Redis. Ключ удаляется сам, когда клиент
+перестает упираться в лимит.
+
+При недоступности Redis запросы не ограничиваются.
+"""
+import logging
+import math
+
+from rest_framework import throttling
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] - ключ клиента, ARGV[1] - интервал между запросами (мс),
+# ARGV[2] - количество запросов, допустимых подряд.
+# Возвращает 0, если запрос разрешен, иначе время ожидания (мс).
+GCRA_SCRIPT = """
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local tat = tonumber(redis.call('GET', KEYS[1]))
+if not tat or tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local allow_at = new_tat - interval * burst
+if allow_at > now then
+    return allow_at - now
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', new_tat - now)
+return 0
+"""
+
+_script = None
+
+
+def _gcra(key, interval, burst):
+    global _script
+    if _script is None:
+        _script = get_redis().register_script(GCRA_SCRIPT)
+    return _script(keys=[key], args=[interval, burst])
+
+
+class RedisRateThrottle(throttling.SimpleRateThrottle):
+    """
+    SimpleRateThrottle со счетчиком в Redis (GCRA)
+    """
+    cache_format = 'throttle:%(scope)s:%(ident)s'
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        if self.rate is None:
+            return True
+
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+
+        # целое число мс, с округлением в сторону более строгого лимита
+        interval = math.ceil(self.duration * 1000 / self.num_requests)
+        try:
+            wait = _gcra(key, interval, self.num_requests)
+        except Exception:
+            logger.exception('Не удалось проверить лимит запросов %s', key)
+            return True
+        if wait:
+            self.retry_after = wait / 1000
+            return False
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+class RedisAnonRateThrottle(throttling.AnonRateThrottle, RedisRateThrottle):
+    """
+    Лимит для анонимных пользователей (по IP-адресу), scope 'anon'
+    """
+
+
+class RedisUserRateThrottle(throttling.UserRateThrottle, RedisRateThrottle):
+    """
+    Лимит для пользователей (по id, анонимных - по IP-адресу), scope 'user'
+    """
+
+
+class RedisScopedRateThrottle(throttling.ScopedRateThrottle,
+                              RedisRateThrottle):
+    """
+    Лимит для отдельных эндпоинтов: scope задается атрибутом
+    throttle_scope представления или действия (@action(throttle_scope=...))
+    """
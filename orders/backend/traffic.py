@@ -0,0 +1,144 @@
+"""
+Запись запросов к API для воспроизведения (команда replay_traffic).
+
+TrafficCaptureMiddleware (backend.middleware) при TRAFFIC_CAPTURE_ENABLED
+записывает долю TRAFFIC_CAPTURE_SAMPLE_RATE запросов к API в файлы NDJSON
+(одна запись JSON в строке) в каталоге TRAFFIC_CAPTURE_DIR: время, метод,
+путь, параметры запроса, тело JSON, представление, статус и время ответа.
+Каждый процесс пишет в свой файл traffic-<pid>.ndjson; файл больше
+TRAFFIC_CAPTURE_MAX_BYTES переименовывается (.1, .2, ...), хранится
+TRAFFIC_CAPTURE_BACKUP_COUNT старых файлов.
+
+Запись не содержит персональных данных и секретов: заголовки (и токены
+авторизации) не записываются, значения полей из SENSITIVE_FIELDS в теле
+и параметрах заменяются звездочками той же длины, пользователь
+записывается псевдонимом (HMAC от id) с типом пользователя.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# поля с персональными данными и секретами
+SENSITIVE_FIELDS = {
+    'password', 'token', 'key', 'email', 'phone', 'first_name', 'last_name',
+    'patronymic', 'company', 'position', 'city', 'street', 'house',
+    'structure', 'building', 'apartment', 'url',
+}
+MASK = '***'
+
+_writer = None
+_lock = threading.Lock()
+
+
+def anonymize(value, field=None):
+    """
+    Копия данных запроса с замаскированными значениями полей
+    из SENSITIVE_FIELDS (строки заменяются звездочками той же длины,
+    чтобы размер тела запроса не менялся)
+    """
+    if isinstance(value, dict):
+        return {key: anonymize(item, key) for key, item in value.items()}
+    if isinstance(value, list):
+        return [anonymize(item, field) for item in value]
+    if field in SENSITIVE_FIELDS and value is not None:
+        return '*' * len(value) if isinstance(value, str) else MASK
+    return value
+
+
+def pseudonym(user):
+    """
+    Постоянный псевдоним пользователя, по которому нельзя узнать его id
+    """
+    return hmac.new(settings.SECRET_KEY.encode(), str(user.id).encode(),
+                    hashlib.sha256).hexdigest()[:16]
+
+
+def read_body(request):
+    """
+    Тело запроса JSON в виде данных или None
+    (читается до обработки запроса представлением)
+    """
+    if request.content_type != 'application/json':
+        return None
+    if int(request.headers.get('Content-Length') or 0) > \
+            settings.TRAFFIC_CAPTURE_MAX_BODY:
+        return None
+    try:
+        return json.loads(request.body or 'null')
+    except ValueError:
+        return None
+
+
+def _get_writer():
+    global _writer
+    path = os.path.join(settings.TRAFFIC_CAPTURE_DIR,
+                        f'traffic-{os.getpid()}.ndjson')
+    with _lock:
+        # файл процесса меняется после fork или изменения настроек
+        if _writer is None or _writer.baseFilename != os.path.abspath(path):
+            if _writer is not None:
+                _writer.close()
+            os.makedirs(settings.TRAFFIC_CAPTURE_DIR, exist_ok=True)
+            _writer = RotatingFileHandler(
+                path, maxBytes=settings.TRAFFIC_CAPTURE_MAX_BYTES,
+                backupCount=settings.TRAFFIC_CAPTURE_BACKUP_COUNT,
+                encoding='utf-8'
+            )
+            _writer.setFormatter(logging.Formatter('%(message)s'))
+        return _writer
+
+
+def record(request, body, view, status_code, started, duration):
+    """
+    Записать запрос в файл процесса
+    """
+    user = getattr(request, 'user', None)
+    authenticated = user is not None and user.is_authenticated
+    entry = {
+        'time': started,
+        'method': request.method,
+        'path': request.path,
+        'params': anonymize({key: request.GET.getlist(key)
+                             for key in request.GET}),
+        'body': anonymize(body),
+        'user': pseudonym(user) if authenticated else None,
+        'user_type': user.type if authenticated else None,
+        'view': view,
+        'status': status_code,
+        'duration_ms': round(duration * 1000, 1),
+    }
+    try:
+        _get_writer().handle(logging.makeLogRecord(
+            {'msg': json.dumps(entry, ensure_ascii=False)}
+        ))
+    except Exception:
+        logger.exception('Не удалось записать запрос')
+
+
+def read_files(paths):
+    """
+    Записанные запросы из файлов и каталогов (в каталоге - все файлы
+    traffic-*.ndjson*, включая старые) в порядке времени
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, name)
+                      for name in sorted(os.listdir(path))
+                      if name.startswith('traffic-')
+                      and '.ndjson' in name]
+        else:
+            files.append(path)
+    entries = []
+    for file in files:
+        with open(file, encoding='utf-8') as lines:
+            entries += [json.loads(line) for line in lines if line.strip()]
+    return sorted(entries, key=lambda entry: entry['time'])
@@ -3,6 +3,7 @@ from django_rest_passwordreset.views import reset_password_request_token, \
     reset_password_confirm
 from rest_framework.routers import DefaultRouter
 
+from .async_views import async_read_view
 from .views import PartnerViewSet, UserViewSet, AddressViewSet
 from .views import CategoryView, ShopView, ProductInfoView, BasketView, \
     OrderView
@@ -12,13 +13,26 @@ router.register(r'partner', PartnerViewSet, basename='partner')
 router.register(r'user', UserViewSet)
 router.register(r'user/addresses', AddressViewSet, basename='user-address')
 
-urlpatterns = [
-    path('user/password_reset/', reset_password_request_token, name='password-reset'),
-    path('user/password_reset/confirm/', reset_password_confirm, name='password-reset-confirm'),
 
-    path('categories/', CategoryView.as_view(), name='categories'),
-    path('shops/', ShopView.as_view(), name='shops'),
-    path('products/', ProductInfoView.as_view(), name='products'),
-    path('basket/', BasketView.as_view(), name='basket'),
-    path('order/', OrderView.as_view(), name='order'),
-] + router.urls
+def get_urlpatterns(read_view=None):
+    """
+    URL-адреса API. read_view - обертка представлений каталога, корзины
+    и заказов (async_read_view для ASGI-приложения)
+    """
+    read_view = read_view or (lambda view: view)
+    return [
+        path('user/password_reset/', reset_password_request_token, name='password-reset'),
+        path('user/password_reset/confirm/', reset_password_confirm, name='password-reset-confirm'),
+
+        path('categories/', read_view(CategoryView.as_view()), name='categories'),
+        path('shops/', read_view(ShopView.as_view()), name='shops'),
+        path('products/', read_view(ProductInfoView.as_view()), name='products'),
+        path('basket/', read_view(BasketView.as_view()), name='basket'),
+        path('order/', read_view(OrderView.as_view()), name='order'),
+    ] + router.urls
+
+
+urlpatterns = get_urlpatterns()
+
+# адреса ASGI-приложения (orders.asgi_urls)
+async_urlpatterns = get_urlpatterns(async_read_view)
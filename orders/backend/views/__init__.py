@@ -1,3 +1,4 @@
+from .metrics import *
 from .partner import *
 from .shop import *
 from .user import *
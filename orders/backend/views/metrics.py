@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from ..metrics import render_prometheus
+
+
+def metrics_view(request):
+    """
+    Метрики в текстовом формате Prometheus. Если задан METRICS_TOKEN,
+    запрос должен передавать заголовок Authorization: Bearer <токен>.
+    """
+    if settings.METRICS_TOKEN and not constant_time_compare(
+        request.headers.get('Authorization', ''),
+        f'Bearer {settings.METRICS_TOKEN}'
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(),
+                        content_type='text/plain; version=0.0.4')
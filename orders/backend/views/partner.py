@@ -1,26 +1,55 @@
 import datetime
+from collections import defaultdict
 from distutils.util import strtobool
 
 from django.conf import settings
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.db.models import Sum, F
+from django.db import transaction
 from django.http import JsonResponse
+from django.utils import timezone
 from drf_spectacular.utils import extend_schema, inline_serializer
-from orders.schema import (PARTNER_ORDERS_RESPONSE,
+from orders.schema import (PARTNER_ORDERS_RESPONSE, ORDER_HISTORY_PARAMETERS,
+                           PARTNER_ORDER_CHANGES_RESPONSE,
+                           ORDER_CHANGES_PARAMETERS,
                            StatusTrueSerializer, StatusFalseSerializer)
 from rest_framework import viewsets, status, fields, parsers
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
-from ..models import User, ConfirmEmailToken, Shop, Order, Delivery
+from ..filters import filter_orders
+from ..mail import enqueue_email, notify_admin
+from ..models import (User, ConfirmEmailToken, Shop, Delivery, OrderItem,
+                      OrderShop, OrderChange)
+from ..pagination import OrderCursorPagination, OrderChangesCursor
 from ..permissions import IsShop
 from ..serializers import (PartnerSerializer, ShopSerializer,
                            PartnerOrderSerializer, DeliverySerializer,
                            UserWithPasswordSerializer)
-from ..tasks import send_email_task
+
+
+ORDER_CHANGES_PAGE_SIZE = 100
+ORDER_CHANGES_MAX_PAGE_SIZE = 500
+
+
+def _ordered_items(order_shops):
+    """
+    Позиции заказов магазина одним запросом: {id заказа: [позиции]}
+    """
+    ordered_items = defaultdict(list)
+    if order_shops:
+        for item in OrderItem.objects.filter(
+            order_id__in=[order_shop.order_id for order_shop in order_shops],
+            product_info__shop_id=order_shops[0].shop_id
+        ).select_related(
+            'product_info__product__category'
+        ).prefetch_related(
+            'product_info__product_parameters__parameter'
+        ).order_by('id'):
+            ordered_items[item.order_id].append(item)
+    return ordered_items
 
 
 class PartnerViewSet(viewsets.GenericViewSet):
@@ -30,12 +59,16 @@ class PartnerViewSet(viewsets.GenericViewSet):
     queryset = User.objects.filter(type='shop')
     serializer_class = PartnerSerializer
     permission_classes = [IsAuthenticated, IsShop]
+    # задается для отдельных действий (RedisScopedRateThrottle)
+    throttle_scope = None
 
     @extend_schema(
         request=UserWithPasswordSerializer,
         responses={201: StatusTrueSerializer, 400: StatusFalseSerializer}
     )
-    @action(methods=['post'], detail=False, permission_classes=[])
+    @action(methods=['post'], detail=False, permission_classes=[],
+            throttle_scope='register')
+    @transaction.atomic
     def register(self, request):
         """
         Регистрация поставщика.
@@ -77,14 +110,13 @@ class PartnerViewSet(viewsets.GenericViewSet):
                 title = f"Password Reset Token for {token.user.email}"
                 message = token.key
                 addressee_list = [token.user.email]
-                send_email_task.delay(title, message, addressee_list)
+                enqueue_email(title, message, addressee_list)
 
-                # отправляем письмо администратору
+                # уведомляем администратора
                 title = f"Новый поставщик: {user}"
                 message = (f"Зарегистрировался новый поставщик: {user}. "
                            f"Для начала работы необходимо его активировать.")
-                addressee_list = [settings.ADMIN_EMAIL]
-                send_email_task.delay(title, message, addressee_list)
+                notify_admin('new_partner', title, message)
 
                 return JsonResponse({'Status': True},
                                     status=status.HTTP_201_CREATED)
@@ -133,12 +165,11 @@ class PartnerViewSet(viewsets.GenericViewSet):
         if shop_serializer.is_valid():
             shop_serializer.save()
 
-            # отправляем письмо администратору о новом прайс-листе
+            # уведомляем администратора о новом прайс-листе
             title = f"{shop_serializer.data['name']}: обновление прайса"
             message = (f"Пользователь {request.user} сообщил о новом "
                        f"прайс-листе магазина {shop_serializer.data['name']}")
-            addressee_list = [settings.ADMIN_EMAIL]
-            send_email_task.delay(title, message, addressee_list)
+            notify_admin('price_list', title, message)
 
             return JsonResponse({'Status': True})
         else:
@@ -194,31 +225,97 @@ class PartnerViewSet(viewsets.GenericViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-    @extend_schema(examples=[PARTNER_ORDERS_RESPONSE])
+    @extend_schema(examples=[PARTNER_ORDERS_RESPONSE],
+                   parameters=ORDER_HISTORY_PARAMETERS)
     @action(detail=False)
     def orders(self, request):
         """
-        Просмотр заказов поставщика
+        Просмотр заказов поставщика (постранично, от новых к старым).
+        Заказы можно отфильтровать по статусу и дате создания.
         """
 
-        order = Order.objects.filter(
-            ordered_items__product_info__shop__user_id=request.user.id
-        ).exclude(
-            state='basket'
-        ).prefetch_related(
-            'ordered_items__product_info__shop',
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter'
+        # заказы магазина выбираются по индексу (shop, dt) таблицы OrderShop,
+        # сумма и количество позиций зафиксированы при оформлении заказа
+        order_shops = OrderShop.objects.filter(
+            shop__user_id=request.user.id
         ).select_related(
-            'user'
-        ).annotate(
-            total_sum=Sum(F('ordered_items__quantity') *
-                          F('ordered_items__product_info__price'))
-        ).distinct()
-
-        serializer = PartnerOrderSerializer(order, partner_id=request.user.id,
-                                            many=True)
-        return Response(serializer.data)
+            'order__address'
+        )
+        try:
+            order_shops = filter_orders(order_shops, request.query_params,
+                                        state_lookup='order__state')
+        except ValueError as error:
+            return JsonResponse(
+                {'Status': False, 'Errors': str(error)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        paginator = OrderCursorPagination()
+        page = paginator.paginate_queryset(order_shops, request, view=self)
+
+        serializer = PartnerOrderSerializer(
+            page, ordered_items=_ordered_items(page), many=True
+        )
+        return paginator.get_paginated_response(serializer.data)
+
+    @extend_schema(examples=[PARTNER_ORDER_CHANGES_RESPONSE],
+                   parameters=ORDER_CHANGES_PARAMETERS)
+    @action(detail=False, url_path='orders/changes')
+    def order_changes(self, request):
+        """
+        Лента изменений заказов поставщика: заказы, оформленные
+        или изменившие статус после курсора, в порядке изменений.
+        Без курсора лента возвращается с начала. Курсор для следующего
+        запроса передается в ответе (cursor), has_more - есть ли
+        еще изменения после него.
+        """
+
+        try:
+            seq = OrderChangesCursor.decode(request.query_params.get('cursor'))
+        except ValueError as error:
+            return JsonResponse(
+                {'Status': False, 'Errors': str(error)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        page_size = request.query_params.get('page_size',
+                                             ORDER_CHANGES_PAGE_SIZE)
+        if not str(page_size).isdigit() or int(page_size) < 1:
+            return JsonResponse(
+                {'Status': False, 'Errors': 'Неверное значение page_size'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = min(int(page_size), ORDER_CHANGES_MAX_PAGE_SIZE)
+
+        # изменения выбираются по индексу (shop, id); недавние изменения
+        # пропускаются, пока не завершатся транзакции с меньшими номерами
+        settled = timezone.now() - datetime.timedelta(
+            seconds=settings.ORDER_CHANGES_SETTLE_SECONDS
+        )
+        changes = list(OrderChange.objects.filter(
+            shop__user_id=request.user.id, id__gt=seq, created_at__lte=settled
+        ).order_by('id').values_list('id', 'order_id')[:limit + 1])
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+
+        # заказ выводится один раз, по последнему изменению
+        last_change = {order_id: change_id for change_id, order_id in changes}
+        order_shops = sorted(
+            OrderShop.objects.filter(
+                shop__user_id=request.user.id, order_id__in=last_change
+            ).select_related('order__address'),
+            key=lambda order_shop: last_change[order_shop.order_id]
+        )
+
+        serializer = PartnerOrderSerializer(
+            order_shops, ordered_items=_ordered_items(order_shops), many=True
+        )
+        return Response({
+            'cursor': OrderChangesCursor.encode(
+                changes[-1][0] if changes else seq
+            ),
+            'has_more': has_more,
+            'results': serializer.data,
+        })
 
     @extend_schema(methods=['get'], description='Получение стоимости доставки',
                    responses=DeliverySerializer(many=True))
@@ -1,22 +1,30 @@
-from django.conf import settings
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.db.models import Sum, F, Q
 from django.http import JsonResponse
 from drf_spectacular.utils import extend_schema, inline_serializer
 from orders.schema import (MY_ORDERS_RESPONSE, BASKET_RESPONSE,
+                           ORDER_HISTORY_PARAMETERS,
                            StatusFalseSerializer, StatusTrueSerializer)
 from rest_framework import status, fields
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from ..models import Shop, ProductInfo, Order, OrderItem, Category, Delivery
+from ..basket import get_basket_store
+from ..checkout import InsufficientStock, InvalidDelivery, place_order
+from ..filters import filter_orders
+from ..mail import enqueue_email, notify_admin
+from ..models import Shop, ProductInfo, Order, OrderItem, Category
+from ..pagination import OrderCursorPagination
 
 from ..serializers import (ShopSerializer, OrderItemSerializer,
                            OrderSerializer, ProductInfoSerializer,
-                           CategorySerializer, ShopOrderSerializer)
-from ..tasks import send_email_task
+                           CategorySerializer, BasketSerializer)
+
+# наибольшее количество, которое помещается в OrderItem.quantity
+MAX_QUANTITY = 2147483647
 
 
 class CategoryView(ListAPIView):
@@ -60,6 +68,7 @@ class ProductInfoView(APIView):
         ).select_related(
             'shop', 'product__category'
         ).prefetch_related(
+            'shop__delivery',
             'product_parameters__parameter'
         ).distinct()
 
@@ -73,8 +82,9 @@ class BasketView(APIView):
     Класс для работы с корзиной пользователя
     """
     queryset = Order.objects.none()
-    serializer_class = OrderSerializer
+    serializer_class = BasketSerializer
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'basket'
 
     @extend_schema(examples=[BASKET_RESPONSE])
     def get(self, request, *args, **kwargs):
@@ -82,70 +92,154 @@ class BasketView(APIView):
         Получить корзину
         """
 
+        basket_store = get_basket_store()
+        if basket_store is not None:
+            return Response(basket_store.representation(request.user.id))
+
         basket = Order.objects.filter(
             user_id=request.user.id, state='basket'
         ).prefetch_related(
-            'ordered_items__product_info__shop',
+            'ordered_items__product_info__shop__delivery',
             'ordered_items__product_info__product__category',
             'ordered_items__product_info__product_parameters__parameter'
         ).annotate(
-            total_sum=Sum(F('ordered_items__quantity') *
-                          F('ordered_items__product_info__price'))
+            basket_sum=Sum(F('ordered_items__quantity') *
+                           F('ordered_items__product_info__price'))
         ).distinct()
 
-        serializer = OrderSerializer(basket, many=True)
+        serializer = BasketSerializer(basket, many=True)
         return Response(serializer.data)
 
     @extend_schema(
         request=inline_serializer(
             'BasketAddRequestSerializer',
-            {'items': fields.ListField(child=OrderItemSerializer())},
+            {'items': fields.ListField(child=OrderItemSerializer()),
+             'replace': fields.BooleanField(required=False)},
         ),
         responses={
-            200: inline_serializer('BasketAddResponseSerializer',
-                                   {'Status': fields.BooleanField(),
-                                    'Создано объектов': fields.IntegerField()}),
+            200: inline_serializer(
+                'BasketAddResponseSerializer',
+                {'Status': fields.BooleanField(),
+                 'Создано объектов': fields.IntegerField(),
+                 'Обновлено объектов': fields.IntegerField(),
+                 'items': fields.ListField(child=inline_serializer(
+                     'BasketAddItemResultSerializer',
+                     {'product_info': fields.IntegerField(),
+                      'quantity': fields.IntegerField(required=False),
+                      'Status': fields.BooleanField(),
+                      'Errors': fields.CharField(required=False)}
+                 ))}
+            ),
             400: StatusFalseSerializer
         },
     )
     def post(self, request, *args, **kwargs):
         """
-        Добавить позиции в корзину
+        Добавить позиции в корзину.
+        Если позиция уже есть в корзине, количество прибавляется к имеющемуся,
+        но не больше остатка на складе (или заменяется, если передан
+        параметр replace). Количество в запросе не может превышать остаток.
+        Для каждой позиции возвращается результат добавления.
         """
 
         items_list = request.data.get('items')
-        if not items_list:
+        if not items_list or type(items_list) != list:
             return JsonResponse(
                 {'Status': False,
                  'Errors': 'Не указаны все необходимые аргументы'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        try:
+            replace = fields.BooleanField().to_internal_value(
+                request.data.get('replace', False)
+            )
+        except ValidationError:
+            return JsonResponse(
+                {'Status': False,
+                 'Errors': 'Неправильно указан параметр replace'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        basket, _ = Order.objects.get_or_create(
-            user_id=request.user.id, state='basket'
-        )
-        objects_created = 0
+        # проверяем аргументы всех позиций до обращения к базе
+        results, quantities = [], {}
         for order_item in items_list:
-            order_item.update({'order': basket.id})
-            serializer = OrderItemSerializer(data=order_item)
-            if serializer.is_valid():
-                try:
-                    serializer.save()
-                except IntegrityError as error:
-                    return JsonResponse(
-                        {'Status': False, 'Errors': str(error)},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-                else:
-                    objects_created += 1
+            if type(order_item) != dict:
+                order_item = {}
+            product_info_id = order_item.get('product_info')
+            qty = order_item.get('quantity')
+            result = {'product_info': product_info_id}
+            if type(product_info_id) != int or type(qty) != int or qty < 1:
+                result.update(Status=False,
+                              Errors='Неправильно указаны аргументы')
+            elif replace:
+                quantities[product_info_id] = qty
             else:
-                return JsonResponse(
-                    {'Status': False, 'Errors': serializer.errors},
-                    status=status.HTTP_400_BAD_REQUEST
+                quantities[product_info_id] = (
+                    quantities.get(product_info_id, 0) + qty
                 )
+            results.append(result)
+
+        # проверяем существование товаров и остатки одним запросом
+        product_infos = {
+            product_info_id: (price, shop_id, stock)
+            for product_info_id, price, shop_id, stock
+            in ProductInfo.objects.filter(
+                id__in=quantities
+            ).values_list('id', 'price', 'shop_id', 'quantity')
+        }
+        over_stock = set()
+        for product_info_id in list(quantities):
+            if product_info_id not in product_infos:
+                del quantities[product_info_id]
+            elif quantities[product_info_id] > \
+                    product_infos[product_info_id][2]:
+                del quantities[product_info_id]
+                over_stock.add(product_info_id)
+
+        basket_store = get_basket_store()
+        objects_created, objects_updated = 0, 0
+        if quantities and basket_store is not None:
+            saved, objects_updated = basket_store.add(
+                request.user.id, quantities, product_infos, replace=replace
+            )
+            objects_created = len(saved) - objects_updated
+        elif quantities:
+            basket, _ = Order.objects.get_or_create(
+                user_id=request.user.id, state='basket'
+            )
+            with transaction.atomic():
+                already_in_basket = set(OrderItem.objects.filter(
+                    order_id=basket.id, product_info_id__in=quantities
+                ).values_list('product_info_id', flat=True))
+                saved = OrderItem.objects.bulk_upsert(basket.id, quantities,
+                                                      replace=replace)
+            objects_updated = len(already_in_basket)
+            objects_created = len(saved) - objects_updated
+        else:
+            saved = {}
+
+        for result in results:
+            if 'Status' in result:
+                continue
+            if result['product_info'] in over_stock:
+                result.update(Status=False,
+                              Errors='Недостаточно товара на складе')
+            elif result['product_info'] in saved:
+                result.update(quantity=saved[result['product_info']],
+                              Status=True)
+            else:
+                result.update(Status=False, Errors='Товар не найден')
+
+        if not saved:
+            return JsonResponse(
+                {'Status': False, 'Errors': 'Нет позиций для добавления',
+                 'items': results},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         return JsonResponse(
-            {'Status': True, 'Создано объектов': objects_created}
+            {'Status': True, 'Создано объектов': objects_created,
+             'Обновлено объектов': objects_updated, 'items': results}
         )
 
     @extend_schema(
@@ -158,10 +252,16 @@ class BasketView(APIView):
             }
         ),
         responses={
-            200: inline_serializer('BasketUpdateResponseSerializer',
-                                   {'Status': fields.BooleanField(),
-                                    'Обновлено объектов': fields.IntegerField(),
-                                    'Удалено объектов': fields.IntegerField()}),
+            200: inline_serializer(
+                'BasketUpdateResponseSerializer',
+                {'Status': fields.BooleanField(),
+                 'Обновлено объектов': fields.IntegerField(),
+                 'Удалено объектов': fields.IntegerField(),
+                 'updated': fields.ListField(child=fields.IntegerField()),
+                 'deleted': fields.ListField(child=fields.IntegerField()),
+                 'not_found': fields.ListField(child=fields.IntegerField()),
+                 'invalid': fields.ListField(child=fields.JSONField())}
+            ),
             400: StatusFalseSerializer
         },
     )
@@ -169,16 +269,40 @@ class BasketView(APIView):
         """
         Изменить в корзине количество у указанных позиций.
         Если новое количество равно 0, то позиция будет удалена из корзины.
+        В ответе перечислены id обновленных, удаленных и ненайденных позиций
+        и id позиций с неправильно указанными аргументами.
+        При хранении корзин в Redis id позиции совпадает с id товара.
         """
 
         items_list = request.data.get('items')
-        if not items_list:
+        if not items_list or type(items_list) != list:
             return JsonResponse(
                 {'Status': False,
                  'Errors': 'Не указаны все необходимые аргументы'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        # разбираем позиции: последнее указанное количество для id главнее
+        quantities, not_found, invalid = {}, [], []
+        for order_item in items_list:
+            if type(order_item) != dict:
+                order_item = {}
+            item_id, qty = order_item.get('id'), order_item.get('quantity')
+            if type(item_id) == int and type(qty) == int and \
+                    0 <= qty <= MAX_QUANTITY:
+                quantities[item_id] = qty
+            else:
+                invalid.append(item_id)
+
+        basket_store = get_basket_store()
+        if basket_store is not None:
+            # в Redis позиции корзины идентифицируются id товара
+            updated, ids_to_delete, not_found_in_basket = \
+                basket_store.update(request.user.id, quantities)
+            not_found.extend(not_found_in_basket)
+            return self._update_response(updated, ids_to_delete, not_found,
+                                         invalid)
+
         try:
             basket = Order.objects.get(user_id=request.user.id, state='basket')
         except Order.DoesNotExist:
@@ -188,35 +312,47 @@ class BasketView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        objects_updated, deleted_count = 0, 0
-        query = Q()
-        has_objects_to_delete = False
-
-        for order_item in items_list:
-            item_id, qty = order_item.get('id'), order_item.get('quantity')
-
-            if type(item_id) == int and type(qty) == int:
-                if qty == 0:
-                    query = query | Q(order_id=basket.id, id=item_id)
-                    has_objects_to_delete = True
+        # постоянное число запросов при любом количестве позиций:
+        # выборка, одно UPDATE ... CASE и одно DELETE
+        with transaction.atomic():
+            basket_items = OrderItem.objects.filter(
+                order_id=basket.id, id__in=quantities
+            ).only('id').order_by('id')
+            items_to_update, ids_to_delete = [], []
+            for item in basket_items:
+                if quantities[item.id] == 0:
+                    ids_to_delete.append(item.id)
                 else:
-                    objects_updated += OrderItem.objects.filter(
-                        order_id=basket.id, id=item_id
-                    ).update(
-                        quantity=qty
-                    )
-
-        if has_objects_to_delete:
-            deleted_count, _ = OrderItem.objects.filter(query).delete()
-
-        if objects_updated or deleted_count:
+                    item.quantity = quantities[item.id]
+                    items_to_update.append(item)
+
+            if items_to_update:
+                OrderItem.objects.bulk_update(items_to_update, ['quantity'])
+            if ids_to_delete:
+                OrderItem.objects.filter(
+                    order_id=basket.id, id__in=ids_to_delete
+                ).delete()
+
+        updated = [item.id for item in items_to_update]
+        found = set(updated) | set(ids_to_delete)
+        not_found.extend(item_id for item_id in quantities
+                         if item_id not in found)
+        return self._update_response(updated, ids_to_delete, not_found,
+                                     invalid)
+
+    @staticmethod
+    def _update_response(updated, ids_to_delete, not_found, invalid):
+        if updated or ids_to_delete:
             return JsonResponse(
-                {'Status': True, 'Обновлено объектов': objects_updated,
-                 'Удалено объектов': deleted_count}
+                {'Status': True, 'Обновлено объектов': len(updated),
+                 'Удалено объектов': len(ids_to_delete),
+                 'updated': updated, 'deleted': ids_to_delete,
+                 'not_found': not_found, 'invalid': invalid}
             )
         else:
             return JsonResponse(
-                {'Status': False, 'Errors': 'Нет таких позиций в корзине'},
+                {'Status': False, 'Errors': 'Нет таких позиций в корзине',
+                 'not_found': not_found, 'invalid': invalid},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
@@ -229,29 +365,38 @@ class OrderView(APIView):
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
 
-    @extend_schema(examples=[MY_ORDERS_RESPONSE])
+    @extend_schema(examples=[MY_ORDERS_RESPONSE],
+                   parameters=ORDER_HISTORY_PARAMETERS)
     def get(self, request, *args, **kwargs):
         """
-        Получить мои заказы
+        Получить мои заказы (постранично, от новых к старым).
+        Заказы можно отфильтровать по статусу и дате создания.
         """
 
+        # суммы зафиксированы при оформлении заказа, агрегация не нужна
         order = Order.objects.filter(
             user_id=request.user.id
         ).exclude(
             state='basket'
         ).prefetch_related(
-            'ordered_items__product_info__shop',
+            'order_shops__shop',
             'ordered_items__product_info__product__category',
             'ordered_items__product_info__product_parameters__parameter'
         ).select_related(
             'address'
-        ).annotate(
-            total_sum=Sum(F('ordered_items__quantity')
-                          * F('ordered_items__product_info__price'))
-        ).distinct()
+        )
+        try:
+            order = filter_orders(order, request.query_params)
+        except ValueError as error:
+            return JsonResponse(
+                {'Status': False, 'Errors': str(error)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        paginator = OrderCursorPagination()
+        page = paginator.paginate_queryset(order, request, view=self)
+        serializer = OrderSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     @extend_schema(
         request=inline_serializer('OrderFromBasketRequestSerializer',
@@ -260,11 +405,17 @@ class OrderView(APIView):
     )
     def post(self, request, *args, **kwargs):
         """
-        Разместить заказ из корзины с указанным адресом доставки.
+        Разместить заказ из корзины с указанным адресом доставки,
+        зафиксировав цены и суммы и зарезервировав товары на складе.
         Затем отправить почту администратору о новом заказе
         и клиенту об изменении статуса заказа.
         """
 
+        basket_store = get_basket_store()
+        if basket_store is not None:
+            # переносим корзину из Redis в таблицы заказов
+            basket_store.flush(request.user.id)
+
         try:
             basket = Order.objects.get(user_id=request.user.id, state='basket')
         except Order.DoesNotExist:
@@ -274,37 +425,6 @@ class OrderView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        invalid_deliveries = []
-        shops = Shop.objects.filter(
-            product_infos__ordered_items__order=basket.id
-        ).prefetch_related(
-            'product_infos__product__category',
-            'product_infos__product_parameters__parameter'
-
-        ).annotate(
-            shop_sum=Sum(F('product_infos__ordered_items__quantity')
-                         * F('product_infos__price'))
-        ).distinct()
-        for shop in shops:
-            shop_data = ShopOrderSerializer(shop, order_id=basket.id).data
-            shop_deliveries = Delivery.objects.filter(shop=shop)
-            if not shop_deliveries:
-                invalid_deliveries.append(f"{shop_data['name']}: "
-                                          f"стоимость доставки недоступна.")
-            else:
-                shop_delivery = shop_deliveries.filter(
-                    min_sum__lte=shop_data['shop_sum']
-                ).order_by('-min_sum').first()
-                if shop_delivery is None:
-                    invalid_deliveries.append(
-                        f"{shop_data['name']}: сумма заказа меньше минимальной"
-                    )
-        if invalid_deliveries:
-            return JsonResponse(
-                {'Status': False, 'Errors': invalid_deliveries},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
         address_id = request.data.get('address_id')
         if not address_id:
             return JsonResponse(
@@ -320,9 +440,31 @@ class OrderView(APIView):
             )
 
         try:
-            basket.address_id = address_id
-            basket.state = 'new'
-            basket.save()
+            with transaction.atomic():
+                place_order(basket, address_id)
+
+                # отправляем письмо пользователю об изменении статуса заказа
+                title = f"Обновление статуса заказа {basket.id}"
+                message = f'Заказ {basket.id} получил статус Новый.'
+                addressee_list = [basket.user.email]
+                enqueue_email(title, message, addressee_list)
+
+                # уведомляем администратора о новом заказе
+                title = f"Новый заказ от {basket.user}"
+                message = (f'Пользователем {basket.user} оформлен '
+                           f'новый заказ {basket.id}.')
+                notify_admin('new_order', title, message)
+        except InvalidDelivery as error:
+            return JsonResponse(
+                {'Status': False, 'Errors': error.errors},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except InsufficientStock as error:
+            return JsonResponse(
+                {'Status': False,
+                 'Errors': error.lines or 'Недостаточно товара на складе'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         except IntegrityError:
             # print(error)
             return JsonResponse(
@@ -330,17 +472,7 @@ class OrderView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         else:
-            # отправляем письмо пользователю об изменении статуса заказа
-            title = f"Обновление статуса заказа {basket.id}"
-            message = f'Заказ {basket.id} получил статус Новый.'
-            addressee_list = [basket.user.email]
-            send_email_task.delay(title, message, addressee_list)
-
-            # отправляем письмо администратору о новом заказе
-            title = f"Новый заказ от {basket.user}"
-            message = (f'Пользователем {basket.user} оформлен '
-                       f'новый заказ {basket.id}.')
-            addressee_list = [settings.ADMIN_EMAIL]
-            send_email_task.delay(title, message, addressee_list)
+            if basket_store is not None:
+                basket_store.clear(request.user.id)
 
             return JsonResponse({'Status': True})
@@ -1,6 +1,11 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
+from django.db import transaction
 from django.http import JsonResponse
+from django.utils import timezone
 from drf_spectacular.utils import (extend_schema_view, extend_schema,
                                    inline_serializer)
 from orders.schema import StatusTrueSerializer, StatusFalseSerializer
@@ -10,10 +15,10 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
+from ..mail import enqueue_email
 from ..models import ConfirmEmailToken, Address, User
 from ..serializers import (UserSerializer, AddressSerializer,
                            UserWithPasswordSerializer)
-from ..tasks import send_email_task
 
 
 class UserViewSet(viewsets.GenericViewSet):
@@ -23,12 +28,16 @@ class UserViewSet(viewsets.GenericViewSet):
     queryset = User.objects.filter(type='buyer')
     serializer_class = UserSerializer
     permission_classes = []
+    # задается для отдельных действий (RedisScopedRateThrottle)
+    throttle_scope = None
 
     @extend_schema(
         request=UserWithPasswordSerializer,
         responses={201: StatusTrueSerializer, 400: StatusFalseSerializer}
     )
-    @action(methods=['post'], detail=False, permission_classes=[])
+    @action(methods=['post'], detail=False, permission_classes=[],
+            throttle_scope='register')
+    @transaction.atomic
     def register(self, request, *args, **kwargs):
         """
         Регистрация покупателей
@@ -71,7 +80,7 @@ class UserViewSet(viewsets.GenericViewSet):
                 title = f"Password Reset Token for {token.user.email}"
                 message = token.key
                 addressee_list = [token.user.email]
-                send_email_task.delay(title, message, addressee_list)
+                enqueue_email(title, message, addressee_list)
                 return JsonResponse({'Status': True},
                                     status=status.HTTP_201_CREATED)
             else:
@@ -100,9 +109,15 @@ class UserViewSet(viewsets.GenericViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        # токены старше CONFIRM_EMAIL_TOKEN_EXPIRY_TIME часов недействительны
+        # (и удаляются задачей purge_expired_tokens_task)
+        expiry_time = timezone.now() - timedelta(
+            hours=settings.CONFIRM_EMAIL_TOKEN_EXPIRY_TIME
+        )
         token = ConfirmEmailToken.objects.filter(
             user__email=request.data['email'],
-            key=request.data['token']
+            key=request.data['token'],
+            created_at__gte=expiry_time
         ).first()
         if token:
             token.user.is_active = True
@@ -127,7 +142,7 @@ class UserViewSet(viewsets.GenericViewSet):
             400: StatusFalseSerializer
         },
     )
-    @action(methods=['post'], detail=False)
+    @action(methods=['post'], detail=False, throttle_scope='login')
     def login(self, request, *args, **kwargs):
         """
         Авторизация пользователей
@@ -154,6 +169,17 @@ class UserViewSet(viewsets.GenericViewSet):
             status=status.HTTP_400_BAD_REQUEST
         )
 
+    @extend_schema(request=None,
+                   responses={200: StatusTrueSerializer})
+    @action(methods=['post'], detail=False,
+            permission_classes=[IsAuthenticated])
+    def logout(self, request, *args, **kwargs):
+        """
+        Выход: токен пользователя удаляется
+        """
+        request.auth.delete()
+        return JsonResponse({'Status': True})
+
     @extend_schema(methods=['get'],
                    description='Получение данных пользователя.')
     @extend_schema(methods=['post'],
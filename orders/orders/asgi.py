@@ -0,0 +1,25 @@
+"""
+ASGI config for orders project.
+
+Поток событий заказов поставщика (backend.events) обслуживается
+асинхронно, остальные запросы передаются приложению Django.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orders.settings')
+# асинхронные представления чтения (backend.async_views) только под ASGI
+os.environ.setdefault('ROOT_URLCONF', 'orders.asgi_urls')
+
+django_application = get_asgi_application()
+
+from backend.events import EVENTS_PATH, order_events_app  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        await order_events_app(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
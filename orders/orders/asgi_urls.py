@@ -0,0 +1,13 @@
+"""
+URL-адреса ASGI-приложения (orders.asgi): те же, что orders.urls,
+но запросы на чтение каталога, корзины и заказов выполняются асинхронно
+(backend.async_views). Под WSGI эти представления вызываются напрямую.
+"""
+from django.urls import include, path
+
+from backend.urls import async_urlpatterns
+from .urls import urlpatterns as wsgi_urlpatterns
+
+urlpatterns = [
+    path('api/v1/', include(async_urlpatterns)),
+] + wsgi_urlpatterns
@@ -1,18 +1,48 @@
 from drf_spectacular.extensions import OpenApiViewExtension
+from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema, OpenApiExample, \
-    inline_serializer
+    OpenApiParameter, inline_serializer
 from rest_framework import serializers, fields
 
 MY_ORDERS_RESPONSE = OpenApiExample(
     name='order response', response_only=True,
+    value={
+        "next": "string", "previous": None,
+        "results": [{
+            "id": 0, "state": "new",
+            "dt": "2022-09-23T05:46:37.532422Z", "total_sum": 0,
+            "address": {
+                "id": 0, "city": "string", "street": "string",
+                "house": "string", "structure": "string",
+                "building": "string", "apartment": "string"
+            },
+            "shops": [{
+                "id": 0, "name": "string", "shop_sum": 0,
+                "ordered_items": [{
+                    "id": 0, "quantity": 0, "price": 0,
+                    "product_info": {
+                        "id": 0, "external_id": 0, "model": "string",
+                        "product": {
+                            "name": "string", "category": "string"
+                        },
+                        "product_parameters": [
+                            {"parameter": "string", "value": "string"},
+                        ],
+                        "price": 0, "price_rrc": 0
+                    }
+                }],
+                "delivery": 0
+            }],
+            "total_delivery": 0
+        }],
+    },
+)
+BASKET_RESPONSE = OpenApiExample(
+    name='basket response', response_only=True,
     value=[{
-        "id": 0, "state": "new",
+        "id": 0, "state": "basket",
         "dt": "2022-09-23T05:46:37.532422Z", "total_sum": 0,
-        "address": {
-            "id": 0, "city": "string", "street": "string",
-            "house": "string", "structure": "string",
-            "building": "string", "apartment": "string"
-        },
+        "address": None,
         "shops": [{
             "id": 0, "name": "string", "shop_sum": 0,
             "ordered_items": [{
@@ -33,16 +63,21 @@ MY_ORDERS_RESPONSE = OpenApiExample(
         "total_delivery": 0
     }],
 )
-BASKET_RESPONSE = OpenApiExample(
-    name='basket response', response_only=True,
-    value=[{
-        "id": 0, "state": "basket",
-        "dt": "2022-09-23T05:46:37.532422Z", "total_sum": 0,
-        "address": None,
-        "shops": [{
-            "id": 0, "name": "string", "shop_sum": 0,
+PARTNER_ORDERS_RESPONSE = OpenApiExample(
+    name='order response', response_only=True,
+    value={
+        "next": "string", "previous": None,
+        "results": [{
+            "id": 0, "state": "new",
+            "dt": "2022-09-23T05:46:37.532422Z", "total_sum": 0,
+            "items_count": 0,
+            "address": {
+                "id": 0, "city": "string", "street": "string",
+                "house": "string", "structure": "string",
+                "building": "string", "apartment": "string"
+            },
             "ordered_items": [{
-                "id": 0, "quantity": 0,
+                "id": 0, "quantity": 0, "price": 0,
                 "product_info": {
                     "id": 0, "external_id": 0, "model": "string",
                     "product": {
@@ -54,37 +89,38 @@ BASKET_RESPONSE = OpenApiExample(
                     "price": 0, "price_rrc": 0
                 }
             }],
-            "delivery": 0
         }],
-        "total_delivery": 0
-    }],
+    },
 )
-PARTNER_ORDERS_RESPONSE = OpenApiExample(
-    name='order response', response_only=True,
-    value=[{
-        "id": 0, "state": "new",
-        "dt": "2022-09-23T05:46:37.532422Z", "total_sum": 0,
-        "address": {
-            "id": 0, "city": "string", "street": "string",
-            "house": "string", "structure": "string",
-            "building": "string", "apartment": "string"
-        },
-        "ordered_items": [{
-            "id": 0, "quantity": 0,
-            "product_info": {
-                "id": 0, "external_id": 0, "model": "string",
-                "product": {
-                    "name": "string", "category": "string"
-                },
-                "product_parameters": [
-                    {"parameter": "string", "value": "string"},
-                ],
-                "price": 0, "price_rrc": 0
-            }
-        }],
-    }],
+
+PARTNER_ORDER_CHANGES_RESPONSE = OpenApiExample(
+    name='order changes response', response_only=True,
+    value={
+        "cursor": "string", "has_more": False,
+        "results": PARTNER_ORDERS_RESPONSE.value["results"],
+    },
 )
 
+ORDER_HISTORY_PARAMETERS = [
+    OpenApiParameter('state', OpenApiTypes.STR,
+                     description='Статус заказа'),
+    OpenApiParameter('dt_from', OpenApiTypes.DATETIME,
+                     description='Заказы, созданные не ранее указанной даты'),
+    OpenApiParameter('dt_to', OpenApiTypes.DATETIME,
+                     description='Заказы, созданные не позднее указанной даты'),
+    OpenApiParameter('cursor', OpenApiTypes.STR,
+                     description='Курсор страницы из ссылок next и previous'),
+    OpenApiParameter('page_size', OpenApiTypes.INT,
+                     description='Количество заказов на странице'),
+]
+
+ORDER_CHANGES_PARAMETERS = [
+    OpenApiParameter('cursor', OpenApiTypes.STR,
+                     description='Курсор из предыдущего ответа ленты'),
+    OpenApiParameter('page_size', OpenApiTypes.INT,
+                     description='Максимальное количество изменений'),
+]
+
 
 class StatusTrueSerializer(serializers.Serializer):
     Status = serializers.BooleanField()
@@ -55,6 +55,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend.middleware.PerformanceMiddleware',
+    'backend.middleware.TrafficCaptureMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,7 +66,9 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'orders.urls'
+# orders.asgi switches to orders.asgi_urls, where catalog, basket and order
+# reads run concurrently in a thread pool (backend.async_views)
+ROOT_URLCONF = env('ROOT_URLCONF', default='orders.urls')
 
 TEMPLATES = [
     {
@@ -146,29 +150,162 @@ AUTH_USER_MODEL = 'backend.User'
 # TODO send real emails
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 EMAIL_HOST_USER = env('EMAIL_HOST_USER')
+# Queued emails (backend.mail): messages per batch, send attempts,
+# delay in seconds before resending failed messages and seconds without
+# progress after which emails of a killed worker return to the queue
+MAIL_BATCH_SIZE = env.int('MAIL_BATCH_SIZE', default=100)
+MAIL_MAX_ATTEMPTS = env.int('MAIL_MAX_ATTEMPTS', default=3)
+MAIL_RETRY_DELAY = env.int('MAIL_RETRY_DELAY', default=60)
+MAIL_PROCESSING_TIMEOUT = env.int('MAIL_PROCESSING_TIMEOUT', default=60 * 10)
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication'
+        'backend.authentication.CachedTokenAuthentication'
     ],
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
-    'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle'
+    'DEFAULT_RENDERER_CLASSES': [
+        'backend.middleware.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer'
+    ],
+    # counters are kept in Redis and shared by all web processes;
+    # THROTTLE_DISABLED turns limits off for load tests (load_test command)
+    'DEFAULT_THROTTLE_CLASSES': [] if env.bool('THROTTLE_DISABLED',
+                                               default=False) else [
+        'backend.throttling.RedisAnonRateThrottle',
+        'backend.throttling.RedisUserRateThrottle',
+        'backend.throttling.RedisScopedRateThrottle'
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '100/day',
-        'user': '1000/day'
+        'user': '1000/day',
+        # per-endpoint limits (throttle_scope of the view or action)
+        'login': '10/min',
+        'register': '10/hour',
+        'basket': '120/min'
     }
 }
 
 # Celery settings
 REDIS_HOST = env('REDIS_HOST')
-CELERY_BROKER_URL = f'redis://{REDIS_HOST}:6379'
-CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:6379'
+REDIS_URL = f'redis://{REDIS_HOST}:6379'
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
+# Separate queues so that long price-list imports do not delay emails;
+# each queue has its own worker with its own concurrency, prefetch and
+# time limits (see docker-compose.yml)
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'backend.tasks.do_import_task': {'queue': 'imports'},
+    'backend.tasks.send_email_task': {'queue': 'emails'},
+    'backend.tasks.send_queued_emails_task': {'queue': 'emails'},
+    'backend.tasks.send_admin_digest_task': {'queue': 'notifications'},
+}
+CELERY_BEAT_SCHEDULE = {
+    'flush-baskets': {
+        'task': 'backend.tasks.flush_baskets_task',
+        'schedule': env.int('BASKET_FLUSH_INTERVAL', default=60),
+    },
+    # emails are normally sent as soon as they are queued,
+    # the periodic run picks up the queue after a failed send
+    'send-queued-emails': {
+        'task': 'backend.tasks.send_queued_emails_task',
+        'schedule': 60,
+    },
+    'send-admin-digest': {
+        'task': 'backend.tasks.send_admin_digest_task',
+        'schedule': env.int('ADMIN_DIGEST_INTERVAL', default=60 * 10),
+    },
+    'purge-expired-tokens': {
+        'task': 'backend.tasks.purge_expired_tokens_task',
+        'schedule': env.int('TOKEN_PURGE_INTERVAL', default=60 * 60),
+    },
+}
+
+# Transactional outbox (backend.outbox): messages per relay batch
+# and relay_outbox polling interval in seconds when the outbox is empty
+OUTBOX_BATCH_SIZE = env.int('OUTBOX_BATCH_SIZE', default=500)
+OUTBOX_POLL_INTERVAL = env.float('OUTBOX_POLL_INTERVAL', default=0.5)
+# how long consumers remember processed outbox messages (seconds),
+# so a batch published again after a failed commit is skipped
+OUTBOX_DEDUPE_TTL = env.int('OUTBOX_DEDUPE_TTL', default=60 * 60 * 24)
+
+# Price list imports (backend.tasks.do_import_task): the ImportRun
+# progress is saved every IMPORT_PROGRESS_EVERY goods
+IMPORT_PROGRESS_EVERY = env.int('IMPORT_PROGRESS_EVERY', default=100)
+
+# Basket storage: 'db' (Order/OrderItem tables) or 'redis'
+# (hashes in Redis, written to the tables at checkout and by flush_baskets_task)
+BASKET_STORAGE = env('BASKET_STORAGE', default='db')
+BASKET_REDIS_TTL = env.int('BASKET_REDIS_TTL', default=60 * 60 * 24 * 30)
+
+# Partner order change feed: changes younger than this are not returned yet,
+# so that transactions committing out of sequence order are not skipped
+ORDER_CHANGES_SETTLE_SECONDS = env.int('ORDER_CHANGES_SETTLE_SECONDS',
+                                       default=5)
+
+# Partner order event stream (SSE, served by orders.asgi):
+# seconds between keep-alive comments on idle connections
+ORDER_EVENTS_KEEPALIVE = env.int('ORDER_EVENTS_KEEPALIVE', default=15)
+
+# Thread pool for read views wrapped with backend.async_views.async_read_view
+# when served by orders.asgi
+ASYNC_READ_THREADS = env.int('ASYNC_READ_THREADS', default=32)
+
+# Per-request timings (backend.middleware.PerformanceMiddleware) exported
+# from /metrics; set METRICS_TOKEN to require "Authorization: Bearer <token>"
+PERF_METRICS_ENABLED = env.bool('PERF_METRICS_ENABLED', default=True)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Slow SQL queries (backend.slow_queries): queries slower than the threshold
+# (0 - disabled) are sampled into a Redis ring buffer with their
+# EXPLAIN (ANALYZE, BUFFERS) plans, viewable at admin/slow-queries/
+SLOW_QUERY_THRESHOLD_MS = env.float('SLOW_QUERY_THRESHOLD_MS', default=500)
+SLOW_QUERY_SAMPLE_RATE = env.float('SLOW_QUERY_SAMPLE_RATE', default=1.0)
+SLOW_QUERY_MAX_PER_MINUTE = env.int('SLOW_QUERY_MAX_PER_MINUTE', default=10)
+SLOW_QUERY_BUFFER_SIZE = env.int('SLOW_QUERY_BUFFER_SIZE', default=100)
+
+# Traffic capture (backend.traffic): a sample of API requests is written
+# with anonymized bodies to per-process rotating NDJSON files for replay
+# with the replay_traffic command
+TRAFFIC_CAPTURE_ENABLED = env.bool('TRAFFIC_CAPTURE_ENABLED', default=False)
+TRAFFIC_CAPTURE_SAMPLE_RATE = env.float('TRAFFIC_CAPTURE_SAMPLE_RATE',
+                                        default=0.01)
+TRAFFIC_CAPTURE_DIR = env('TRAFFIC_CAPTURE_DIR',
+                          default=os.path.join(BASE_DIR, 'traffic'))
+TRAFFIC_CAPTURE_PATH_PREFIX = '/api/v1/'
+TRAFFIC_CAPTURE_MAX_BODY = env.int('TRAFFIC_CAPTURE_MAX_BODY',
+                                   default=64 * 1024)
+TRAFFIC_CAPTURE_MAX_BYTES = env.int('TRAFFIC_CAPTURE_MAX_BYTES',
+                                    default=50 * 1024 * 1024)
+TRAFFIC_CAPTURE_BACKUP_COUNT = env.int('TRAFFIC_CAPTURE_BACKUP_COUNT',
+                                       default=10)
+
+# Cached token authentication (backend.authentication): seconds a token's
+# user is kept in Redis and in the per-process LRU, and the LRU size
+TOKEN_CACHE_TTL = env.int('TOKEN_CACHE_TTL', default=60 * 5)
+TOKEN_LOCAL_CACHE_TTL = env.int('TOKEN_LOCAL_CACHE_TTL', default=5)
+TOKEN_LOCAL_CACHE_SIZE = env.int('TOKEN_LOCAL_CACHE_SIZE', default=10000)
+
+# Hours before unconfirmed email tokens and password reset tokens expire;
+# expired tokens are deleted by purge_expired_tokens_task in batches
+CONFIRM_EMAIL_TOKEN_EXPIRY_TIME = env.int('CONFIRM_EMAIL_TOKEN_EXPIRY_TIME',
+                                          default=24 * 3)
+DJANGO_REST_MULTITOKENAUTH_RESET_TOKEN_EXPIRY_TIME = env.int(
+    'RESET_PASSWORD_TOKEN_EXPIRY_TIME', default=24
+)
+TOKEN_PURGE_BATCH_SIZE = env.int('TOKEN_PURGE_BATCH_SIZE', default=1000)
+
+# Admin changelists of large tables show estimated row counts
+# (backend.pagination.EstimatedCountPaginator); below this estimate
+# an exact COUNT(*) is used
+ADMIN_EXACT_COUNT_LIMIT = env.int('ADMIN_EXACT_COUNT_LIMIT', default=10000)
 
 ADMIN_EMAIL = env('ADMIN_EMAIL')
+# Admin notifications sent immediately; the rest (backend.mail.notify_admin)
+# are collected into a digest sent every ADMIN_DIGEST_INTERVAL seconds
+ADMIN_URGENT_NOTIFICATIONS = env.list('ADMIN_URGENT_NOTIFICATIONS',
+                                      default=['new_partner'])
 
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Orders API',
@@ -17,9 +17,15 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
+from backend.admin import slow_queries_view
+from backend.views import metrics_view
+
 urlpatterns = [
+    path('admin/slow-queries/', admin.site.admin_view(slow_queries_view),
+         name='slow-queries'),
     path('admin/', admin.site.urls),
     path('api/v1/', include('backend.urls')),
+    path('metrics', metrics_view, name='metrics'),
     # YOUR PATTERNS
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     # Optional UI: